@@ -0,0 +1,116 @@
+"""
+Serving book images straight out of their source EPUB (zero-copy image mode).
+
+Books imported with READER3_IMAGE_MODE=archive have no images/ folder; their
+manifest records the source archive and the member behind every image name.
+ArchivePool keeps a bounded number of archives open (zip directory parsed,
+file memory-mapped) and reopens one when its file changes on disk. Stored
+members are served from the mapping without reading them through zipfile;
+deflated members are decompressed while streaming.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Iterator, Optional, Tuple
+
+try:
+    DEFAULT_MAX_ARCHIVES = max(1, int(os.getenv("READER3_ARCHIVE_HANDLES", "16")))
+except ValueError:
+    DEFAULT_MAX_ARCHIVES = 16
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Local file header: signature .. file name length (26), extra field length (28).
+_LOCAL_HEADER = struct.Struct("<4s22xHH")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+class _Archive:
+    def __init__(self, path: str, stat_key: Tuple[int, int]):
+        self.stat_key = stat_key
+        self.zip = zipfile.ZipFile(path)
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def data_offset(self, info: zipfile.ZipInfo) -> int:
+        signature, name_len, extra_len = _LOCAL_HEADER.unpack_from(self.map, info.header_offset)
+        if signature != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+        return info.header_offset + _LOCAL_HEADER.size + name_len + extra_len
+
+
+class ArchivePool:
+    """LRU of open EPUB archives, keyed by path and checked against size/mtime.
+
+    Evicted archives are not closed explicitly: responses still streaming
+    from them keep them alive, and they are released with the last reference.
+    """
+
+    def __init__(self, max_open: int = DEFAULT_MAX_ARCHIVES):
+        self.max_open = max_open
+        self._archives: "OrderedDict[str, _Archive]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.opens = 0
+
+    def _get(self, path: str) -> Optional[_Archive]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stat_key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            archive = self._archives.get(path)
+            if archive is not None and archive.stat_key == stat_key:
+                self._archives.move_to_end(path)
+                self.hits += 1
+                return archive
+
+        try:
+            archive = _Archive(path, stat_key)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        with self._lock:
+            self.opens += 1
+            self._archives[path] = archive
+            self._archives.move_to_end(path)
+            while len(self._archives) > self.max_open:
+                self._archives.popitem(last=False)
+        return archive
+
+    def member(self, path: str, name: str) -> Optional[zipfile.ZipInfo]:
+        """The member's zip entry, or None if the archive or member is missing."""
+        archive = self._get(path)
+        if archive is None:
+            return None
+        try:
+            return archive.zip.getinfo(name)
+        except KeyError:
+            return None
+
+    def iter_member(self, path: str, name: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        archive = self._get(path)
+        if archive is None:
+            raise FileNotFoundError(path)
+        info = archive.zip.getinfo(name)
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            start = archive.data_offset(info)
+            end = start + info.file_size
+            view = archive.map
+            for pos in range(start, end, chunk_size):
+                yield view[pos:min(pos + chunk_size, end)]
+            return
+        with archive.zip.open(info) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def stats(self):
+        with self._lock:
+            return {"open": len(self._archives), "max_open": self.max_open, "hits": self.hits, "opens": self.opens}
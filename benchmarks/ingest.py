@@ -0,0 +1,458 @@
+"""
+Ingestion benchmark: synthesize EPUB/Markdown books, time every stage of
+process_epub / process_markdown (which save as they go), and record peak
+memory.
+
+Usage:
+    python benchmarks/ingest.py [--profile small|medium|large] [--langs latin,cjk]
+                                [--kinds epub,markdown] [--repeat 3]
+                                [--epub real.epub ...] [--output report.json]
+                                [--compare baseline.json] [--threshold 0.15]
+
+Stage times are exclusive: a stage nested in another (e.g. anchor
+registration inside spine assembly, or context indexing while the search
+index consumes the chapter stream) is not counted twice, so the stages plus
+"other" add up to the total. Spine documents are parsed in-process
+(workers=1) so their cost is attributed. Times are the best of --repeat runs;
+memory comes from one extra run per case in a fresh process (peak RSS) with
+tracemalloc enabled (peak Python allocations), which also measures the
+memory held by the loaded book manifest.
+
+With --compare, cases are matched by name against an earlier report and the
+exit status is 1 if any total regressed by more than --threshold.
+"""
+
+import argparse
+import functools
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import asdict, dataclass
+from multiprocessing import get_context
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ebooklib import epub
+
+import context
+import httpcache  # noqa: F401  -- imported lazily by write_nav_assets; keeps import time out of the stages
+import publish
+import reader3
+import search
+from images import ImageStore
+
+
+# --- Synthetic books ---
+
+@dataclass
+class BookSpec:
+    chapters: int = 10
+    sections: int = 4          # h2 per chapter
+    subsections: int = 2       # h3 per section
+    paragraphs: int = 5        # per (sub)section
+    words: int = 80            # per paragraph (characters / 2 for CJK)
+    anchor_every: int = 3      # every Nth paragraph gets an id (0: none)
+    images: int = 5
+    image_kb: int = 64
+    lang: str = "latin"        # 'latin' or 'cjk'
+    seed: int = 1
+
+
+PROFILES = {
+    "small": BookSpec(),
+    "medium": BookSpec(chapters=40, sections=6, paragraphs=8, words=120, images=40, image_kb=128),
+    "large": BookSpec(chapters=150, sections=8, paragraphs=10, words=150, images=150, image_kb=256),
+}
+
+_LATIN_WORDS = (
+    "the of and to in a is that for it as was with be by on not he this are or his from at which but "
+    "have an they you were her she there would their we him been has when who will more no if out so "
+    "said what up its about into than them can only other new some could time these two may then do "
+    "first any my now such like our over man me even most made after also did many before must through"
+).split()
+
+
+class _TextGen:
+    def __init__(self, spec: BookSpec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+
+    def paragraph(self) -> str:
+        if self.spec.lang == "cjk":
+            return "".join(chr(0x4E00 + self.rng.randrange(0x5000)) for _ in range(self.spec.words * 2)) + "。"
+        words = [self.rng.choice(_LATIN_WORDS) for _ in range(self.spec.words)]
+        return " ".join(words).capitalize() + "."
+
+    def title(self) -> str:
+        if self.spec.lang == "cjk":
+            return "".join(chr(0x4E00 + self.rng.randrange(0x5000)) for _ in range(4))
+        return " ".join(self.rng.choice(_LATIN_WORDS) for _ in range(3)).title()
+
+
+def _png(kb: int, seed: int) -> bytes:
+    """An incompressible RGB PNG of roughly kb kilobytes."""
+    side = max(4, int((kb * 1024 / 3) ** 0.5))
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(side * 3) for _ in range(side))
+
+    def chunk(tag, data):
+        c = struct.pack(">I", len(data)) + tag + data
+        return c + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def _chapter_blocks(spec: BookSpec, gen: _TextGen, c: int, image_for):
+    """Yield (kind, level, id, text) blocks of chapter c."""
+    n = 0
+    yield "h", 1, f"c{c}", f"Chapter {c + 1} {gen.title()}"
+    for s in range(spec.sections):
+        yield "h", 2, f"c{c}s{s}", gen.title()
+        for sub in range(spec.subsections + 1):
+            if sub:
+                yield "h", 3, f"c{c}s{s}u{sub}", gen.title()
+            for _ in range(spec.paragraphs):
+                n += 1
+                anchor = f"c{c}p{n}" if spec.anchor_every and n % spec.anchor_every == 0 else None
+                yield "p", 0, anchor, gen.paragraph()
+        image = image_for(c, s)
+        if image:
+            yield "img", 0, None, image
+
+
+def _image_slots(spec: BookSpec):
+    """Spread spec.images over (chapter, section) slots."""
+    slots = spec.chapters * spec.sections
+    every = max(1, slots // spec.images) if spec.images else 0
+    picked = {}
+    for i in range(spec.images):
+        slot = (i * every) % slots
+        picked[(slot // spec.sections, slot % spec.sections)] = i
+    return picked
+
+
+def make_epub(path: str, spec: BookSpec):
+    gen = _TextGen(spec)
+    book = epub.EpubBook()
+    book.set_identifier(f"bench-{spec.seed}")
+    book.set_title(f"Benchmark {spec.lang}")
+    book.set_language("zh" if spec.lang == "cjk" else "en")
+    book.add_author("reader3")
+
+    slots = _image_slots(spec)
+    for i in range(spec.images):
+        book.add_item(epub.EpubItem(
+            uid=f"img{i}", file_name=f"Images/img{i}.png", media_type="image/png",
+            content=_png(spec.image_kb, spec.seed * 100003 + i),
+        ))
+
+    def image_for(c, s):
+        i = slots.get((c, s))
+        return None if i is None else f"../Images/img{i}.png"
+
+    chapters, toc = [], []
+    for c in range(spec.chapters):
+        parts, links = [], []
+        for kind, level, anchor, text in _chapter_blocks(spec, gen, c, image_for):
+            id_attr = f' id="{anchor}"' if anchor else ""
+            if kind == "h":
+                parts.append(f"<h{level}{id_attr}>{text}</h{level}>")
+                if level == 2:
+                    links.append(epub.Link(f"Text/ch{c}.xhtml#{anchor}", text, anchor))
+            elif kind == "p":
+                parts.append(f"<p{id_attr}>{text}</p>")
+            else:
+                parts.append(f'<div class="figure"><img src="{text}" alt=""/></div>')
+        item = epub.EpubHtml(title=f"Chapter {c + 1}", file_name=f"Text/ch{c}.xhtml", lang=book.language)
+        item.content = f"<html><head><title>{c}</title></head><body><section>{''.join(parts)}</section></body></html>"
+        book.add_item(item)
+        chapters.append(item)
+        toc.append((epub.Section(f"Chapter {c + 1}", href=f"Text/ch{c}.xhtml"), links))
+
+    book.toc = toc
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    book.spine = ["nav"] + chapters
+    epub.write_epub(path, book)
+
+
+def make_markdown(path: str, spec: BookSpec):
+    gen = _TextGen(spec)
+    lines = []
+    for c in range(spec.chapters):
+        for kind, level, anchor, text in _chapter_blocks(spec, gen, c, lambda c, s: None):
+            if kind == "h":
+                lines.append(f"{'#' * level} {text}\n")
+            else:
+                lines.append(f"{text}\n{{: #{anchor} }}\n" if anchor else f"{text}\n")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+# --- Stage timing ---
+
+class StageTimer:
+    """Wraps functions as named stages and accumulates exclusive wall time."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self._stack: List[List[Any]] = []   # [stage, start, child seconds]
+        self._patches = []
+
+    def wrap(self, owner, attr: str, stage: str):
+        original = getattr(owner, attr)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            if self._stack and self._stack[-1][0] == stage:
+                return original(*args, **kwargs)    # recursion: time the outermost call only
+            frame = [stage, time.perf_counter(), 0.0]
+            self._stack.append(frame)
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._stack.pop()
+                elapsed = time.perf_counter() - frame[1]
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed - frame[2]
+                self.calls[stage] = self.calls.get(stage, 0) + 1
+                if self._stack:
+                    self._stack[-1][2] += elapsed
+
+        self._patches.append((owner, attr, original))
+        setattr(owner, attr, timed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for owner, attr, original in reversed(self._patches):
+            setattr(owner, attr, original)
+        self._patches.clear()
+
+
+def _instrument(timer: StageTimer):
+    timer.wrap(reader3, "hash_source_file", "hash")
+    timer.wrap(reader3._ManifestReader, "load", "load")
+    timer.wrap(reader3.EpubSource, "read", "load")
+    timer.wrap(reader3, "extract_metadata_robust", "metadata")
+    timer.wrap(ImageStore, "add", "images")
+    timer.wrap(reader3, "parse_toc_recursive", "toc_parse")
+    timer.wrap(reader3.md_lib, "markdown", "markdown")
+    timer.wrap(reader3, "parse_spine_document", "parse")
+    timer.wrap(reader3, "BeautifulSoup", "parse")
+    timer.wrap(reader3, "clean_html_content", "clean")
+    timer.wrap(reader3, "analyze_document", "analyze")
+    timer.wrap(reader3.LayoutWriter, "add", "layout_save")
+    timer.wrap(reader3, "segment_document", "split")
+    timer.wrap(reader3, "register_anchor_ids", "anchors")
+    timer.wrap(reader3, "register_file_keys", "anchors")
+    timer.wrap(reader3, "assemble_markdown", "assemble")
+    timer.wrap(reader3, "attach_chapter_indices_to_toc", "toc_attach")
+    timer.wrap(reader3.ChapterStoreWriter, "add", "save_chapters")
+    timer.wrap(reader3.ChapterStoreWriter, "patch_links", "link_patch")
+    timer.wrap(search, "build_book_index", "search_index")
+    timer.wrap(search, "write_book_index", "search_index")
+    timer.wrap(context.ContextIndexBuilder, "add", "context_index")
+    timer.wrap(context.ContextIndexBuilder, "finish", "context_index")
+    timer.wrap(context, "write_context_index", "context_index")
+    timer.wrap(reader3, "write_nav_assets", "nav_assets")
+    timer.wrap(reader3, "write_summary", "summary")
+    timer.wrap(reader3, "write_manifest", "save_manifest")
+
+
+def ingest_once(source: str, out_dir: str, split_level: int) -> Dict[str, Any]:
+    """Process and save source once; return stage timings and output counts."""
+    publish.remove_book(out_dir)
+    timer = StageTimer()
+    with timer, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        _instrument(timer)
+        start = time.perf_counter()
+        if reader3.source_kind(source) == "epub":
+            book = reader3.process_epub(source, out_dir, split_level=split_level, workers=1)
+        else:
+            book = reader3.process_markdown(source, out_dir, split_level=split_level)
+        total = time.perf_counter() - start
+
+    stages = {name: {"seconds": round(sec, 6), "calls": timer.calls[name]} for name, sec in timer.seconds.items()}
+    stages["other"] = {"seconds": round(max(0.0, total - sum(timer.seconds.values())), 6), "calls": 1}
+    output_bytes = sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(out_dir) for name in files
+    )
+    return {
+        "total_seconds": round(total, 6),
+        "stages": stages,
+        "chapters": len(book.spine),
+        "anchors": len(book.anchor_map),
+        "images": len(set(book.images.values())),
+        "output_bytes": output_bytes,
+    }
+
+
+def _memory_run(source: str, out_dir: str, split_level: int) -> Dict[str, int]:
+    """Run in a fresh process: peak RSS and traced Python allocations of one ingestion."""
+    tracemalloc.start()
+    ingest_once(source, out_dir, split_level)
+    _, peak = tracemalloc.get_traced_memory()
+    # What one book costs the server's book cache once loaded.
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    book = reader3.load_book(out_dir)
+    gc.collect()
+    book_bytes = tracemalloc.get_traced_memory()[0] - before
+    del book
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux, bytes on macOS.
+    return {
+        "peak_rss_bytes": rss if sys.platform == "darwin" else rss * 1024,
+        "peak_traced_bytes": peak,
+        "loaded_book_bytes": book_bytes,
+    }
+
+
+def run_case(name: str, source: str, work_dir: str, split_level: int, repeat: int, measure_memory: bool):
+    out_dir = os.path.join(work_dir, name + "_data")
+    best = None
+    for _ in range(repeat):
+        result = ingest_once(source, out_dir, split_level)
+        if best is None or result["total_seconds"] < best["total_seconds"]:
+            best = result
+    case = {"name": name, "source": os.path.basename(source), "source_bytes": os.path.getsize(source), **best}
+    if measure_memory:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            case.update(pool.submit(_memory_run, source, out_dir, split_level).result())
+    return case
+
+
+# --- Reporting ---
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_case(case: Dict[str, Any]):
+    mem = ""
+    if "peak_rss_bytes" in case:
+        mem = f", peak RSS {case['peak_rss_bytes'] / 2**20:.1f} MB, traced {case['peak_traced_bytes'] / 2**20:.1f} MB"
+        if "loaded_book_bytes" in case:
+            mem += f", loaded book {case['loaded_book_bytes'] / 1024:.0f} KB"
+    print(f"\n{case['name']}: {case['total_seconds']:.3f}s, {case['source_bytes'] / 1024:.0f} KB source, "
+          f"{case['chapters']} chapters, {case['anchors']} anchors, {case['images']} images{mem}")
+    for stage, s in sorted(case["stages"].items(), key=lambda kv: -kv[1]["seconds"]):
+        share = s["seconds"] / case["total_seconds"] * 100 if case["total_seconds"] else 0.0
+        print(f"  {stage:<14} {s['seconds'] * 1000:>10.1f} ms {share:>5.1f}%  ({s['calls']} calls)")
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    """Print per-case/stage changes against baseline; False if a total regressed."""
+    old_cases = {c["name"]: c for c in baseline.get("cases", [])}
+    ok = True
+    print(f"\nComparison with {baseline.get('git_revision') or 'baseline'} (threshold {threshold:.0%}):")
+    for case in report["cases"]:
+        old = old_cases.get(case["name"])
+        if old is None:
+            print(f"  {case['name']}: not in baseline")
+            continue
+        change = case["total_seconds"] / old["total_seconds"] - 1 if old["total_seconds"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"  {case['name']}: {old['total_seconds']:.3f}s -> {case['total_seconds']:.3f}s ({change:+.1%}){flag}")
+        for stage, s in case["stages"].items():
+            before = old["stages"].get(stage, {}).get("seconds")
+            if before and abs(s["seconds"] / before - 1) > threshold and max(s["seconds"], before) > 0.005:
+                print(f"      {stage:<14} {before * 1000:.1f} -> {s['seconds'] * 1000:.1f} ms "
+                      f"({s['seconds'] / before - 1:+.1%})")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="small")
+    parser.add_argument("--langs", default="latin,cjk", help="comma-separated: latin, cjk")
+    parser.add_argument("--kinds", default="epub,markdown", help="comma-separated: epub, markdown")
+    parser.add_argument("--chapters", type=int, help="override the profile's chapter count")
+    parser.add_argument("--images", type=int, help="override the profile's image count")
+    parser.add_argument("--epub", nargs="*", default=[], help="also benchmark these real files")
+    parser.add_argument("--split-level", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak-memory run")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown for --compare")
+    parser.add_argument("--keep", help="directory to keep generated sources and output in")
+    args = parser.parse_args()
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix="reader3-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    base = PROFILES[args.profile]
+    overrides = {k: v for k, v in (("chapters", args.chapters), ("images", args.images)) if v is not None}
+    sources = []
+    for lang in [l.strip() for l in args.langs.split(",") if l.strip()]:
+        spec = BookSpec(**{**asdict(base), **overrides, "lang": lang})
+        for kind in [k.strip() for k in args.kinds.split(",") if k.strip()]:
+            name = f"{args.profile}-{lang}-{kind}"
+            path = os.path.join(work_dir, name + (".epub" if kind == "epub" else ".md"))
+            (make_epub if kind == "epub" else make_markdown)(path, spec)
+            sources.append((name, path, asdict(spec)))
+    for path in args.epub:
+        sources.append((os.path.splitext(os.path.basename(path))[0], path, None))
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": _git_revision(),
+        "reader3_version": reader3.BOOK_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "split_level": args.split_level,
+        "repeat": args.repeat,
+        "cases": [],
+    }
+    try:
+        for name, path, spec in sources:
+            case = run_case(name, path, work_dir, args.split_level, args.repeat, not args.no_memory)
+            case["spec"] = spec
+            report["cases"].append(case)
+            print_case(case)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
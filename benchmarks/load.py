@@ -0,0 +1,425 @@
+"""
+Load test: run server.py against a synthetic shelf and replay reading traffic.
+
+Usage:
+    uv run --group bench benchmarks/load.py [--books 4] [--profile small] [--concurrency 16]
+                                            [--duration 15] [--scenarios library,reading,mixed]
+                                            [--think-ms 0] [--server-workers 1] [--output report.json]
+
+The harness builds a shelf of synthetic EPUBs (benchmarks/ingest.py) in a
+temporary directory and starts uvicorn on it in a separate process. The
+client side uses httpx, which is in the "bench" dependency group. Each
+scenario then runs --concurrency virtual readers for --duration seconds.
+
+Scenarios:
+    library   library page
+    reading   open a book, then turn pages through the chapter JSON API,
+              fetching the TOC asset and the chapter's images like the reader
+    toc       random chapter jumps (TOC clicks) and full chapter pages
+    images    image fetches
+    search    shelf search queries
+    mixed     all of the above plus occasional uploads and resplits
+
+Everything runs locally. For each scenario the report gives throughput,
+p50/p90/p99 latency per request type, error and rejection counts, and the
+server's resident memory (sampled from /proc). Answers a real client expects
+under this traffic count as rejections, not errors: 409/429 for uploads and
+resplits, and 404 for a chapter index made stale by a concurrent resplit.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from ingest import PROFILES, BookSpec, make_epub  # noqa: E402
+import reader3  # noqa: E402
+
+SCENARIOS = ("library", "reading", "toc", "images", "search", "mixed")
+
+# Relative weights of actions in the mixed scenario.
+MIXED_WEIGHTS = {"library": 5, "reading": 55, "toc": 15, "images": 12, "search": 8, "upload": 1, "resplit": 2}
+
+SEARCH_TERMS = ("the", "time", "would", "first", "made", "through", "there would", "made after")
+
+_IMG_RE = re.compile(r'<img[^>]+src="(images/[^"]+)"')
+
+
+# --- Shelf and server ---
+
+def build_shelf(work_dir: str, books: int, spec: BookSpec) -> List[Dict]:
+    """Write `books` synthetic EPUBs to books/hub and import them into books/shelf."""
+    hub = os.path.join(work_dir, "books", "hub")
+    shelf = os.path.join(work_dir, "books", "shelf")
+    os.makedirs(hub, exist_ok=True)
+    os.makedirs(shelf, exist_ok=True)
+    result = []
+    for i in range(books):
+        name = f"load{i}.epub"
+        path = os.path.join(hub, name)
+        make_epub(path, BookSpec(**{**asdict(spec), "seed": i + 1}))
+        summary, _ = reader3.ingest_source(path, os.path.join(shelf, f"load{i}_data"))
+        result.append({"book_id": f"load{i}_data", "chapters": summary["chapters"]})
+    # An extra source for upload traffic.
+    make_epub(os.path.join(work_dir, "upload.epub"), BookSpec(**{**asdict(spec), "seed": 999}))
+    return result
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(work_dir: str, workers: int) -> Tuple[subprocess.Popen, str]:
+    os.symlink(os.path.join(REPO_DIR, "templates"), os.path.join(work_dir, "templates"))
+    port = _free_port()
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=work_dir, env=env, stdout=subprocess.DEVNULL,
+        # Own process group, so stop_server() also reaches the ingest job workers.
+        start_new_session=True,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            httpx.get(base_url + "/api/cache/stats", timeout=1.0)
+            return proc, base_url
+        except httpx.TransportError:
+            time.sleep(0.1)
+    stop_server(proc)
+    raise RuntimeError("server did not start within 30s")
+
+
+def stop_server(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        pass
+    # Forked job workers inherit uvicorn's SIGTERM handler and outlive it.
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def _process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids.extend(_process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def server_rss(pid: int) -> Optional[int]:
+    """Resident bytes of the server and its child processes (Linux only)."""
+    total = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total or None
+
+
+# --- Traffic ---
+
+@dataclass
+class Stats:
+    latencies: Dict[str, List[float]] = field(default_factory=dict)
+    errors: Dict[str, int] = field(default_factory=dict)
+    rejected: Dict[str, int] = field(default_factory=dict)
+    bytes: int = 0
+
+    def record(self, kind: str, seconds: float, response: Optional[httpx.Response],
+               accept=(200, 202, 304), reject=(409, 429)):
+        if response is None or response.status_code not in accept:
+            if response is not None and response.status_code in reject:
+                self.rejected[kind] = self.rejected.get(kind, 0) + 1
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            return
+        self.latencies.setdefault(kind, []).append(seconds)
+        self.bytes += len(response.content)
+
+
+class Reader:
+    """One virtual user; every action issues one or more timed requests."""
+
+    def __init__(self, client: httpx.AsyncClient, books: List[Dict], stats: Stats, rng: random.Random,
+                 think: float, upload_path: str):
+        self.client = client
+        self.books = books
+        self.stats = stats
+        self.rng = rng
+        self.think = think
+        self.upload_path = upload_path
+        self.etags: Dict[str, str] = {}
+
+    async def get(self, kind: str, url: str, conditional: bool = False,
+                  book: Optional[Dict] = None) -> Optional[httpx.Response]:
+        """GET url; with `book`, a 404 means the chapter index went stale (a resplit
+        changed the chapter count) and the count is re-read."""
+        headers = {"Accept-Encoding": "gzip, br"}
+        if conditional and url in self.etags:
+            headers["If-None-Match"] = self.etags[url]
+        start = time.perf_counter()
+        try:
+            response = await self.client.get(url, headers=headers)
+        except httpx.HTTPError:
+            response = None
+        self.stats.record(kind, time.perf_counter() - start, response,
+                          reject=(404, 409, 429) if book is not None else (409, 429))
+        if response is not None and "etag" in response.headers:
+            self.etags[url] = response.headers["etag"]
+        if book is not None and response is not None and response.status_code == 404:
+            await self.refresh_chapters(book)
+        return response
+
+    async def refresh_chapters(self, book: Dict):
+        try:
+            response = await self.client.get(f"/api/books/{book['book_id']}/chapters/0")
+            book["chapters"] = response.json()["total"]
+        except (httpx.HTTPError, ValueError, KeyError):
+            pass
+
+    async def post(self, kind: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        self.stats.record(kind, time.perf_counter() - start, response)
+        return response
+
+    async def pause(self):
+        if self.think:
+            await asyncio.sleep(self.rng.expovariate(1 / self.think))
+
+    async def fetch_images(self, book_id: str, html: str, limit: int = 4):
+        # The browser caches images; revalidate the ones seen before.
+        for src in _IMG_RE.findall(html)[:limit]:
+            await self.get("image", f"/read/{book_id}/{src}", conditional=True)
+
+    # Actions
+
+    async def library(self):
+        await self.get("library", "/")
+
+    async def reading(self):
+        book = self.rng.choice(self.books)
+        book_id = book["book_id"]
+        index = self.rng.randrange(book["chapters"])
+        page = await self.get("chapter_page", f"/read/{book_id}/{index}", conditional=True, book=book)
+        await self.get("toc_asset", f"/read/{book_id}/nav/toc.html", conditional=True)
+        if page is not None and page.status_code == 200:
+            await self.fetch_images(book_id, page.text)
+        for _ in range(self.rng.randint(3, 10)):
+            await self.pause()
+            index += 1
+            if index >= book["chapters"]:
+                break
+            chapter = await self.get("chapter_json", f"/api/books/{book_id}/chapters/{index}",
+                                     conditional=True, book=book)
+            if chapter is not None and chapter.status_code == 200:
+                await self.fetch_images(book_id, chapter.json().get("content", ""))
+
+    async def toc(self):
+        book = self.rng.choice(self.books)
+        index = self.rng.randrange(book["chapters"])
+        if self.rng.random() < 0.3:
+            await self.get("chapter_page", f"/read/{book['book_id']}/{index}", book=book)
+        else:
+            await self.get("chapter_json", f"/api/books/{book['book_id']}/chapters/{index}", book=book)
+
+    async def images(self):
+        book = self.rng.choice(self.books)
+        chapter = await self.get("chapter_json", f"/api/books/{book['book_id']}/chapters/"
+                                                 f"{self.rng.randrange(book['chapters'])}", book=book)
+        if chapter is not None and chapter.status_code == 200:
+            await self.fetch_images(book["book_id"], chapter.json().get("content", ""), limit=8)
+
+    async def search(self):
+        await self.get("search", f"/api/search?q={self.rng.choice(SEARCH_TERMS)}")
+
+    async def upload(self):
+        name = f"upload{self.rng.randrange(2)}.epub"
+        with open(self.upload_path, "rb") as f:
+            await self.post("upload", "/api/upload_epub", files={"file": (name, f.read())}, data={"split_level": "2"})
+
+    async def resplit(self):
+        book = self.rng.choice(self.books)
+        await self.post("resplit", f"/api/books/{book['book_id']}/resplit",
+                        data={"split_level": str(self.rng.choice((1, 2, 3)))})
+
+    async def mixed(self):
+        actions = list(MIXED_WEIGHTS)
+        action = self.rng.choices(actions, weights=[MIXED_WEIGHTS[a] for a in actions])[0]
+        await getattr(self, action)()
+
+    async def run(self, scenario: str, deadline: float):
+        action = getattr(self, scenario)
+        while time.monotonic() < deadline:
+            await action()
+            await self.pause()
+
+
+async def run_scenario(base_url: str, pid: int, scenario: str, books: List[Dict], args) -> Dict:
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    rss_samples = []
+
+    async def sample_memory(deadline):
+        while time.monotonic() < deadline:
+            rss = server_rss(pid)
+            if rss:
+                rss_samples.append(rss)
+            await asyncio.sleep(0.5)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        start = time.monotonic()
+        deadline = start + args.duration
+        readers = [
+            Reader(client, books, stats, random.Random(args.seed * 1000 + i), args.think_ms / 1000,
+                   args.upload_path)
+            for i in range(args.concurrency)
+        ]
+        await asyncio.gather(sample_memory(deadline), *(r.run(scenario, deadline) for r in readers))
+        elapsed = time.monotonic() - start
+
+    def percentile(values, q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    requests = {}
+    for kind, values in sorted(stats.latencies.items()):
+        values.sort()
+        requests[kind] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.50),
+            "p90_ms": percentile(values, 0.90),
+            "p99_ms": percentile(values, 0.99),
+            "max_ms": round(values[-1] * 1000, 2),
+        }
+    ok = sum(r["count"] for r in requests.values())
+    return {
+        "scenario": scenario,
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 2),
+        "requests_ok": ok,
+        "throughput_rps": round(ok / elapsed, 1) if elapsed else 0.0,
+        "mb_per_s": round(stats.bytes / elapsed / 2**20, 2) if elapsed else 0.0,
+        "errors": stats.errors,
+        "rejected": stats.rejected,
+        "requests": requests,
+        "server_rss_peak_mb": round(max(rss_samples) / 2**20, 1) if rss_samples else None,
+        "server_rss_end_mb": round(rss_samples[-1] / 2**20, 1) if rss_samples else None,
+    }
+
+
+def print_result(result: Dict):
+    print(f"\n{result['scenario']}: {result['throughput_rps']} req/s ({result['requests_ok']} ok in "
+          f"{result['duration_s']}s, {result['concurrency']} readers, {result['mb_per_s']} MB/s), "
+          f"server RSS peak {result['server_rss_peak_mb']} MB")
+    print(f"  {'request':<14} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind, r in result["requests"].items():
+        print(f"  {kind:<14} {r['count']:>7} {r['p50_ms']:>9} {r['p90_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9}")
+    if result["errors"]:
+        print(f"  errors: {result['errors']}")
+    if result["rejected"]:
+        print(f"  rejected: {result['rejected']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="small")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per scenario")
+    parser.add_argument("--scenarios", default="library,reading,toc,images,search,mixed")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a reader's actions")
+    parser.add_argument("--server-workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--keep", help="directory to keep the shelf in")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix="reader3-load-")
+    os.makedirs(work_dir, exist_ok=True)
+    args.upload_path = os.path.join(work_dir, "upload.epub")
+    proc = None
+    try:
+        print(f"Building shelf of {args.books} '{args.profile}' books in {work_dir}...")
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                books = build_shelf(work_dir, args.books, PROFILES[args.profile])
+        finally:
+            os.chdir(cwd)
+
+        proc, base_url = start_server(work_dir, args.server_workers)
+        print(f"Server at {base_url} (pid {proc.pid}), idle RSS {server_rss(proc.pid) / 2**20:.1f} MB")
+
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "books": args.books,
+            "profile": args.profile,
+            "server_workers": args.server_workers,
+            "think_ms": args.think_ms,
+            "results": [],
+        }
+        for scenario in scenarios:
+            result = asyncio.run(run_scenario(base_url, proc.pid, scenario, books, args))
+            report["results"].append(result)
+            print_result(result)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Compare the old regex-based spine segmentation with the single-parse
+segmenter in reader3 (parse_spine_document + segment_document).
+
+Usage:
+    python benchmarks/segmenter.py book1.epub [book2.epub ...] [--split-level 2] [--repeat 3]
+
+For every EPUB the script runs both pipelines over all spine documents and
+reports how many BeautifulSoup parses each one performed, wall time, and the
+number of segments produced. The last column is the time to re-cut the
+already parsed layouts, which is all a resplit of a saved book costs.
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ebooklib
+from ebooklib import epub
+from bs4 import BeautifulSoup
+
+import reader3
+
+
+class CountingSoup(BeautifulSoup):
+    """BeautifulSoup that counts how many documents it parsed."""
+    parses = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingSoup.parses += 1
+        super().__init__(*args, **kwargs)
+
+
+def legacy_process_spine_document(raw, image_map, split_level):
+    """The regex pipeline process_epub used before the single-parse segmenter.
+
+    The heading backreference is written as \\2 here (the old code escaped it
+    twice, so it never matched and never split); this measures what the regex
+    approach costs when it actually splits.
+    """
+    soup = CountingSoup(raw.decode('utf-8', errors='ignore'), 'html.parser')
+    for img in soup.find_all('img'):
+        src = img.get('src', '')
+        if src:
+            name = os.path.basename(src)
+            if src in image_map:
+                img['src'] = image_map[src]
+            elif name in image_map:
+                img['src'] = image_map[name]
+    soup = reader3.clean_html_content(soup)
+    body = soup.find('body')
+    content_root = body if body else soup
+    full_html = "".join(str(x) for x in content_root.contents)
+
+    pattern = re.compile(r"(<h([1-{}])[^>]*>.*?</h\2>)".format(split_level), flags=re.IGNORECASE | re.DOTALL)
+    matches = list(pattern.finditer(full_html))
+    segments = []
+    if not matches:
+        segments.append((None, full_html))
+    else:
+        pre_html = full_html[:matches[0].start()]
+        if pre_html.strip():
+            segments.append((None, pre_html))
+        for i, m in enumerate(matches):
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(full_html)
+            title = CountingSoup(m.group(1), 'html.parser').get_text(separator=" ", strip=True) or None
+            segments.append((title, full_html[m.start():end]))
+
+    result = []
+    for title, seg_html in segments:
+        section_soup = CountingSoup(seg_html, 'html.parser')
+        anchors = [(el.get("id"), 0) for el in section_soup.find_all(attrs={"id": True}) if el.get("id")]
+        result.append(reader3.DocumentSegment(title, seg_html, reader3.extract_plain_text(section_soup), anchors))
+    return result
+
+
+def current_process_spine_document(raw, image_map, split_level):
+    return reader3.segment_document(reader3.parse_spine_document(raw, image_map), split_level)
+
+
+def run_resplit(docs, split_level, repeat):
+    layouts = [reader3.parse_spine_document(raw, {}) for raw in docs]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for layout in layouts:
+            reader3.segment_document(layout, split_level)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def load_documents(epub_path):
+    book = epub.read_epub(epub_path)
+    docs = []
+    for item_id, _ in book.spine:
+        item = book.get_item_with_id(item_id)
+        if item and item.get_type() == ebooklib.ITEM_DOCUMENT:
+            docs.append(item.get_content())
+    return docs
+
+
+def run(fn, docs, split_level, repeat):
+    best = None
+    for _ in range(repeat):
+        CountingSoup.parses = 0
+        start = time.perf_counter()
+        segments = sum(len(fn(raw, {}, split_level)) for raw in docs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return CountingSoup.parses, best, segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("epubs", nargs="+")
+    parser.add_argument("--split-level", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Route the new pipeline's parses through the counter as well.
+    reader3.BeautifulSoup = CountingSoup
+
+    print(f"{'book':<30} {'docs':>5} {'parses old/new':>15} {'time old/new (s)':>18} {'segments old/new':>17} {'resplit (ms)':>13}")
+    for path in args.epubs:
+        docs = load_documents(path)
+        old = run(legacy_process_spine_document, docs, args.split_level, args.repeat)
+        new = run(current_process_spine_document, docs, args.split_level, args.repeat)
+        resplit = run_resplit(docs, args.split_level, args.repeat)
+        print(f"{os.path.basename(path)[:30]:<30} {len(docs):>5} "
+              f"{old[0]:>7}/{new[0]:<7} {old[1]:>8.3f}/{new[1]:<8.3f} {old[2]:>8}/{new[2]:<8} {resplit * 1000:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
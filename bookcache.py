@@ -0,0 +1,161 @@
+"""
+Memory-bounded cache of loaded book manifests.
+
+Entries are weighed by an estimate of the memory the loaded book holds: a
+recursive sys.getsizeof over the Book and every object it references, each
+counted once (see estimate_size). The pickle on disk is several times
+smaller than that, so it cannot serve as the weight. Each lookup stats the
+manifest (or legacy book.pkl), so a book reprocessed outside the server (CLI,
+another process) is reloaded on the next request without any explicit
+invalidation.
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from reader3 import Book, book_data_path, load_book
+
+try:
+    DEFAULT_MAX_BYTES = int(os.getenv("READER3_BOOK_CACHE_MB", "256")) * 1024 * 1024
+except ValueError:
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+_ATOMIC = (str, bytes, bytearray, int, float, complex, bool, type(None), type)
+
+
+def estimate_size(obj: Any) -> int:
+    """Approximate bytes held by obj and everything reachable from it through
+    containers, instance dicts and slots; shared objects are counted once."""
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, _ATOMIC):
+            continue
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        else:
+            if hasattr(o, "__dict__"):
+                stack.append(o.__dict__)
+            for cls in type(o).__mro__:
+                slots = cls.__dict__.get("__slots__", ())
+                for name in (slots,) if isinstance(slots, str) else slots:
+                    value = getattr(o, name, None)
+                    if value is not None:
+                        stack.append(value)
+    return total
+
+
+@dataclass
+class _Entry:
+    book: Book
+    path: str
+    mtime_ns: int
+    size: int       # estimate_size(book)
+
+
+class BookCache:
+    """LRU cache of Book manifests keyed by shelf folder name, bounded by the
+    estimated in-memory size of the cached books."""
+
+    def __init__(self, shelf_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.shelf_dir = shelf_dir
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, book_id: str) -> Optional[Book]:
+        book_id = os.path.basename(book_id)
+        output_dir = os.path.join(self.shelf_dir, book_id)
+        path = book_data_path(output_dir)
+        if path is None:
+            self.invalidate(book_id)
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(book_id)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(book_id)
+            if entry is not None:
+                if entry.path == path and entry.mtime_ns == st.st_mtime_ns:
+                    self._entries.move_to_end(book_id)
+                    self.hits += 1
+                    return entry.book
+                self._remove(book_id)
+                self.stale += 1
+            self.misses += 1
+
+        # Loaded outside the lock so a slow unpickle doesn't block other books.
+        try:
+            book = load_book(output_dir)
+        except Exception as e:
+            print(f"Error loading book {book_id}: {e}")
+            return None
+        if book is None:
+            return None
+        size = estimate_size(book)
+
+        with self._lock:
+            self._remove(book_id)
+            if size <= self.max_bytes:
+                self._entries[book_id] = _Entry(book, path, st.st_mtime_ns, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    oldest = next(iter(self._entries))
+                    self._remove(oldest)
+                    self.evictions += 1
+        return book
+
+    def _remove(self, book_id: str):
+        entry = self._entries.pop(book_id, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def invalidate(self, book_id: str):
+        with self._lock:
+            if book_id in self._entries:
+                self._remove(book_id)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "stale_reloads": self.stale,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "books": {book_id: e.size for book_id, e in self._entries.items()},
+            }
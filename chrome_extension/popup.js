@@ -9,6 +9,28 @@ document.addEventListener("DOMContentLoaded", () => {
     statusEl.style.color = isError ? "#fca5a5" : "#d1d5db";
   }
 
+  // The server parses uploads in a background job; poll until it is done.
+  async function waitForJob(jobId) {
+    while (true) {
+      const res = await fetch("http://localhost:8123/api/jobs/" + encodeURIComponent(jobId));
+      if (!res.ok) {
+        throw new Error("查询任务失败，HTTP 状态码：" + res.status);
+      }
+      const job = await res.json();
+      if (job.status === "done") {
+        return job;
+      }
+      if (job.status === "error") {
+        throw new Error(job.error || "解析失败");
+      }
+      const p = job.progress;
+      if (p && p.stage === "chapters" && p.total) {
+        setStatus(`正在解析章节 ${p.done}/${p.total}……`);
+      }
+      await new Promise((resolve) => setTimeout(resolve, 800));
+    }
+  }
+
   async function uploadFile(file) {
     if (!file) return;
     setStatus("正在上传并解析 EPUB……");
@@ -29,7 +51,8 @@ document.addEventListener("DOMContentLoaded", () => {
       }
 
       const data = await res.json();
-      const title = data.title || "书籍";
+      const job = await waitForJob(data.job_id);
+      const title = (job.result && job.result.title) || "书籍";
       setStatus(`完成：${title} 已加入本地书库`);
 
       if (typeof chrome !== "undefined" && chrome.tabs && chrome.tabs.create) {
@@ -0,0 +1,230 @@
+"""
+Token-budgeted text windows for LLM context.
+
+Each book gets a context index (context.pkl) written next to its search index
+at save time: the chapters' plain text cut into paragraphs at block element
+starts, with book-wide prefix sums of estimated tokens and characters. The
+largest window that fits a token budget, starting at any chapter, paragraph
+or anchor, is then found with one bisection, and its text is read straight
+from chapters.bin (only the byte range it covers).
+
+Token counts are estimates, not the output of a model tokenizer: a CJK
+character counts as one token and other text as one token per four
+characters, which is close to what BPE tokenizers produce for prose.
+"""
+
+import math
+import os
+import pickle
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from reader3 import CHAPTERS_FILE
+from search import _CJK_RE
+
+CONTEXT_INDEX_FILE = "context.pkl"
+
+CHARS_PER_TOKEN = 4
+# Paragraphs estimated above this are cut (at spaces where possible), so that
+# any budget of at least this size is filled without truncating a paragraph.
+MAX_PARAGRAPH_TOKENS = 256
+
+PARAGRAPH_SEPARATOR = "\n\n"
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = 0 if text.isascii() else len(text) - len(_CJK_RE.sub("", text))
+    return cjk + math.ceil((len(text) - cjk) / CHARS_PER_TOKEN)
+
+
+@dataclass
+class ContextIndex:
+    """Paragraphs of a book with prefix sums over their token and char counts.
+
+    Paragraphs are numbered book-wide; chapter c holds paragraphs
+    chapter_paragraphs[c] up to chapter_paragraphs[c + 1]. token_prefix[p] is
+    the number of tokens before paragraph p (so it has one entry more than
+    there are paragraphs), likewise char_prefix.
+    """
+    chapter_paragraphs: array    # first paragraph of each chapter, plus the total
+    text_offsets: array          # byte offset of each chapter's text in chapters.bin
+    text_sizes: array            # byte size of each chapter's text
+    paragraph_offsets: array     # byte offset of each paragraph in its chapter's text
+    token_prefix: array
+    char_prefix: array
+    anchors: List[Dict[str, int]]   # per chapter: element id -> paragraph
+
+    @property
+    def paragraphs(self) -> int:
+        return len(self.paragraph_offsets)
+
+    @property
+    def tokens(self) -> int:
+        return self.token_prefix[-1]
+
+    def chapter_of(self, paragraph: int) -> int:
+        """Chapter holding a paragraph (the last chapter for the end position)."""
+        return bisect_right(self.chapter_paragraphs, paragraph, 0, len(self.text_offsets)) - 1
+
+    def position(self, paragraph: int) -> Dict[str, int]:
+        chapter = self.chapter_of(paragraph)
+        return {"chapter": chapter, "paragraph": paragraph - self.chapter_paragraphs[chapter]}
+
+    def chapter_stats(self, chapter: int) -> Dict[str, int]:
+        first, end = self.chapter_paragraphs[chapter], self.chapter_paragraphs[chapter + 1]
+        return {
+            "paragraphs": end - first,
+            "tokens": self.token_prefix[end] - self.token_prefix[first],
+            "chars": self.char_prefix[end] - self.char_prefix[first],
+        }
+
+    def locate(self, chapter: int, paragraph: int = 0, anchor: Optional[str] = None) -> int:
+        """Book-wide paragraph for a chapter and a paragraph or anchor inside it.
+
+        Raises KeyError for an unknown anchor and IndexError for a position
+        outside the book.
+        """
+        if not 0 <= chapter < len(self.text_offsets):
+            raise IndexError(chapter)
+        if anchor:
+            return self.anchors[chapter][anchor]
+        first, end = self.chapter_paragraphs[chapter], self.chapter_paragraphs[chapter + 1]
+        if not 0 <= paragraph < max(1, end - first):
+            raise IndexError(paragraph)
+        return first + paragraph
+
+    def window(self, start: int, budget: int, end: Optional[int] = None) -> int:
+        """End (exclusive) of the largest window from paragraph start whose
+        tokens fit the budget; it holds at least one paragraph."""
+        end = self.paragraphs if end is None else end
+        if start >= end:
+            return start
+        prefix = self.token_prefix
+        stop = bisect_right(prefix, prefix[start] + budget, start + 1, end + 1) - 1
+        return max(stop, start + 1)
+
+    def chunks(self, start: int, budget: int, overlap: int = 0, count: int = 1,
+               end: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Up to count consecutive (start, end) windows, each starting so that
+        it repeats at most overlap tokens of the previous one."""
+        end = self.paragraphs if end is None else end
+        prefix = self.token_prefix
+        windows = []
+        while start < end and len(windows) < count:
+            stop = self.window(start, budget, end)
+            windows.append((start, stop))
+            if stop >= end:
+                break
+            nxt = bisect_left(prefix, prefix[stop] - overlap, start + 1, stop) if overlap > 0 else stop
+            start = max(nxt, start + 1)
+        return windows
+
+    def read(self, output_dir: str, start: int, end: int) -> str:
+        """Text of paragraphs [start, end), one paragraph per block."""
+        parts = []
+        with open(os.path.join(output_dir, CHAPTERS_FILE), "rb") as f:
+            for chapter in range(self.chapter_of(start), len(self.text_offsets)):
+                first, last = self.chapter_paragraphs[chapter], self.chapter_paragraphs[chapter + 1]
+                if first >= end:
+                    break
+                lo, hi = max(start, first), min(end, last)
+                if lo >= hi:
+                    continue
+                bounds = [self.paragraph_offsets[p] for p in range(lo, hi)]
+                bounds.append(self.paragraph_offsets[hi] if hi < last else self.text_sizes[chapter])
+                f.seek(self.text_offsets[chapter] + bounds[0])
+                data = f.read(bounds[-1] - bounds[0])
+                for a, b in zip(bounds, bounds[1:]):
+                    text = data[a - bounds[0]:b - bounds[0]].decode("utf-8", errors="ignore").strip()
+                    if text:
+                        parts.append(text)
+        return PARAGRAPH_SEPARATOR.join(parts)
+
+
+def _paragraph_spans(text: str, breaks: Iterable[int]) -> List[Tuple[int, int]]:
+    """(start, end) char spans of a chapter's paragraphs, long ones cut up."""
+    starts = sorted({0, *(b for b in breaks if 0 < b < len(text))}) if text else []
+    spans = []
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        pieces = math.ceil(estimate_tokens(text[start:end]) / MAX_PARAGRAPH_TOKENS)
+        step = math.ceil((end - start) / max(1, pieces))
+        while end - start > step:
+            cut = text.rfind(" ", start + step // 2, start + step)
+            cut = cut + 1 if cut > start else start + step
+            spans.append((start, cut))
+            start = cut
+        spans.append((start, end))
+    return spans
+
+
+class ContextIndexBuilder:
+    """Accumulates a ContextIndex one chapter at a time, in spine order."""
+
+    def __init__(self):
+        self.chapter_paragraphs = array("q", [0])
+        self.text_offsets = array("q")
+        self.text_sizes = array("q")
+        self.paragraph_offsets = array("q")
+        self.token_prefix = array("q", [0])
+        self.char_prefix = array("q", [0])
+        self.anchors: List[Dict[str, int]] = []
+
+    def add(self, text_offset: int, text_size: int, text: str,
+            breaks: Optional[Iterable[int]] = None, anchors: Optional[Iterable[Tuple[str, int]]] = None):
+        """Add a chapter: where its text lives in chapters.bin, the text itself,
+        block start offsets and (id, char offset) anchors into it."""
+        first = len(self.paragraph_offsets)
+        spans = _paragraph_spans(text, breaks or ())
+        ascii_text = text.isascii()
+        byte_pos = char_pos = 0
+        tokens, chars = self.token_prefix[-1], self.char_prefix[-1]
+        for start, end in spans:
+            if not ascii_text:
+                byte_pos += len(text[char_pos:start].encode("utf-8"))
+                char_pos = start
+            self.paragraph_offsets.append(byte_pos if not ascii_text else start)
+            tokens += max(1, estimate_tokens(text[start:end]))
+            chars += end - start
+            self.token_prefix.append(tokens)
+            self.char_prefix.append(chars)
+
+        starts = [start for start, _ in spans]
+        chapter_anchors = {}
+        for anchor_id, offset in anchors or ():
+            p = max(0, bisect_right(starts, offset) - 1)
+            chapter_anchors.setdefault(anchor_id, first + p)
+        self.anchors.append(chapter_anchors)
+        self.text_offsets.append(text_offset)
+        self.text_sizes.append(text_size)
+        self.chapter_paragraphs.append(len(self.paragraph_offsets))
+
+    def finish(self) -> ContextIndex:
+        return ContextIndex(
+            chapter_paragraphs=self.chapter_paragraphs,
+            text_offsets=self.text_offsets,
+            text_sizes=self.text_sizes,
+            paragraph_offsets=self.paragraph_offsets,
+            token_prefix=self.token_prefix,
+            char_prefix=self.char_prefix,
+            anchors=self.anchors,
+        )
+
+
+def write_context_index(index: ContextIndex, output_dir: str):
+    path = os.path.join(output_dir, CONTEXT_INDEX_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def read_context_index(output_dir: str) -> Optional[ContextIndex]:
+    path = os.path.join(output_dir, CONTEXT_INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
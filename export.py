@@ -0,0 +1,185 @@
+"""
+Bulk text export of the shelf as JSON Lines, for offline LLM/RAG pipelines.
+
+One record per chapter: book id, book metadata, chapter order, title and
+href, the chapter's anchors ([id, char offset into text]) and its plain text.
+Records are produced as a stream: books are read from their manifests and
+chapters.bin a chapter at a time, several books in parallel, each feeding a
+small bounded queue. Books are emitted in shelf order, so memory stays at a
+few chapters per worker however large the shelf is.
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from reader3 import CHAPTERS_FILE, book_files_dir, load_book, load_chapter, read_summary
+from search import read_book_index
+
+try:
+    DEFAULT_EXPORT_WORKERS = max(1, int(os.getenv("READER3_EXPORT_WORKERS", "4")))
+except ValueError:
+    DEFAULT_EXPORT_WORKERS = 4
+
+# Encoded records buffered per book being read.
+EXPORT_QUEUE_RECORDS = 32
+
+_END = object()
+
+
+def parse_since(value: Union[str, float, int, datetime, None]) -> Optional[datetime]:
+    """A cut-off as a naive local datetime (the form of Book.processed_at).
+
+    Accepts a datetime, Unix seconds, or an ISO 8601 string (with or
+    without a timezone).
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        since = value
+    elif isinstance(value, (int, float)):
+        since = datetime.fromtimestamp(value)
+    else:
+        try:
+            since = datetime.fromtimestamp(float(value))
+        except ValueError:
+            since = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if since.tzinfo is not None:
+        since = since.astimezone().replace(tzinfo=None)
+    return since
+
+
+def _processed_at(folder: str) -> Optional[datetime]:
+    summary = read_summary(folder)
+    if summary is None:
+        # Legacy folder without summary.json.
+        book = load_book(folder)
+        summary = {"processed_at": book.processed_at} if book else None
+    try:
+        return datetime.fromisoformat(summary["processed_at"]) if summary else None
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def list_export_books(shelf_dir: str, since: Optional[datetime] = None,
+                      book_ids: Optional[List[str]] = None) -> List[str]:
+    """Book folders to export, sorted; with since, only those processed after it."""
+    if book_ids is None:
+        names = os.listdir(shelf_dir) if os.path.isdir(shelf_dir) else []
+    else:
+        names = [os.path.basename(b) for b in book_ids]
+    result = []
+    for name in sorted(names):
+        folder = os.path.join(shelf_dir, name)
+        if not name.endswith("_data") or not os.path.isdir(folder):
+            continue
+        if since is not None:
+            processed_at = _processed_at(folder)
+            if processed_at is None or processed_at <= since:
+                continue
+        result.append(name)
+    return result
+
+
+def iter_book_records(folder: str, book_id: str) -> Iterator[Dict[str, Any]]:
+    """One record per chapter of a book, reading chapters.bin sequentially."""
+    book = load_book(folder)
+    if book is None:
+        return
+    metadata = asdict(book.metadata)
+    files_dir = book_files_dir(folder, book)
+    index = read_book_index(files_dir)
+    anchors = [c.anchors for c in index.chapters] if index and len(index.chapters) == len(book.spine) else None
+
+    store = None
+    if any(ch.offset >= 0 for ch in book.spine):
+        store = open(os.path.join(files_dir, CHAPTERS_FILE), "rb")
+    try:
+        for i, chapter in enumerate(book.spine):
+            if chapter.offset >= 0:
+                store.seek(chapter.offset + chapter.content_size)
+                text = store.read(chapter.text_size).decode("utf-8", errors="ignore")
+            else:
+                text = load_chapter(folder, book, i).text
+            yield {
+                "book_id": book_id,
+                "metadata": metadata,
+                "processed_at": book.processed_at,
+                "chapter": i,
+                "title": chapter.title,
+                "href": chapter.href,
+                "anchors": [[anchor_id, offset] for offset, anchor_id in anchors[i]] if anchors else [],
+                "text": text,
+            }
+    finally:
+        if store is not None:
+            store.close()
+
+
+def encode_record(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _put(q: "queue.Queue", item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_book(shelf_dir: str, book_id: str, q: "queue.Queue", stop: threading.Event):
+    try:
+        for record in iter_book_records(os.path.join(shelf_dir, book_id), book_id):
+            if not _put(q, encode_record(record), stop):
+                return
+    except Exception as e:
+        print(f"Error exporting {book_id}: {e}", file=sys.stderr)
+    finally:
+        _put(q, _END, stop)
+
+
+def export_shelf(
+    shelf_dir: str,
+    since: Optional[datetime] = None,
+    book_ids: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+) -> Iterator[bytes]:
+    """JSON Lines (one encoded record per chapter) for the books on a shelf.
+
+    Up to `workers` books are read ahead in threads while the current one is
+    being consumed. Closing the generator stops the readers.
+    """
+    workers = max(1, workers or DEFAULT_EXPORT_WORKERS)
+    names = iter(list_export_books(shelf_dir, since, book_ids))
+    stop = threading.Event()
+    pending: "deque[queue.Queue]" = deque()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+
+    def submit():
+        book_id = next(names, None)
+        if book_id is not None:
+            q = queue.Queue(maxsize=EXPORT_QUEUE_RECORDS)
+            pool.submit(_read_book, shelf_dir, book_id, q, stop)
+            pending.append(q)
+
+    try:
+        for _ in range(workers):
+            submit()
+        while pending:
+            q = pending.popleft()
+            while (line := q.get()) is not _END:
+                yield line
+            submit()
+    finally:
+        stop.set()
+        pool.shutdown(wait=False)
@@ -0,0 +1,185 @@
+"""
+HTTP caching helpers: validators, precompressed variants and a rendered-page cache.
+
+Bodies are stored together with their gzip (and, when the optional `brotli`
+package is installed, brotli) variants, so a cached page or asset is
+compressed once and then served to every client that accepts it. Each
+variant gets its own strong ETag (`"<etag>"`, `"<etag>-gzip"`, `"<etag>-br"`);
+conditional requests match on the shared part.
+"""
+
+import gzip
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+# Bodies smaller than this are not worth compressing.
+MIN_COMPRESS_SIZE = 512
+
+# File suffixes of precompressed variants written next to an asset.
+VARIANT_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+try:
+    DEFAULT_PAGE_CACHE_BYTES = int(os.getenv("READER3_PAGE_CACHE_MB", "64")) * 1024 * 1024
+except ValueError:
+    DEFAULT_PAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def compress_variants(body: bytes, best: bool = False) -> Dict[str, bytes]:
+    """gzip/brotli encodings of body, keeping only those that are smaller.
+
+    best=True uses maximum compression, for assets compressed once at
+    ingestion; otherwise a fast level suitable for request time.
+    """
+    if len(body) < MIN_COMPRESS_SIZE:
+        return {}
+    variants = {"gzip": gzip.compress(body, compresslevel=9 if best else 6, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11 if best else 5)
+    return {enc: data for enc, data in variants.items() if len(data) < len(body)}
+
+
+def write_variants(path: str, body: bytes):
+    """Write precompressed variants of an asset as path.gz / path.br."""
+    for encoding, data in compress_variants(body, best=True).items():
+        variant_path = path + VARIANT_SUFFIXES[encoding]
+        tmp_path = variant_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, variant_path)
+
+
+def read_variants(path: str) -> Dict[str, bytes]:
+    """Load the precompressed variants of path that exist on disk."""
+    variants = {}
+    for encoding, suffix in VARIANT_SUFFIXES.items():
+        try:
+            with open(path + suffix, "rb") as f:
+                variants[encoding] = f.read()
+        except OSError:
+            continue
+    return variants
+
+
+def choose_encoding(accept_encoding: Optional[str], available) -> Optional[str]:
+    """Pick the best of `available` encodings the client accepts (br over gzip)."""
+    if not accept_encoding or not available:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ("br", "gzip"):
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if If-None-Match names etag or one of its encoded variants."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag == etag or tag.startswith(etag + "-"):
+            return True
+    return False
+
+
+@dataclass
+class CachedBody:
+    body: bytes
+    etag: str
+    media_type: str
+    variants: Dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(v) for v in self.variants.values())
+
+
+def cached_response(request: Request, entry: CachedBody, cache_control: str) -> Response:
+    """Answer with 304, or with the best encoding of entry the client accepts."""
+    headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag_matches(request, entry.etag):
+        headers["ETag"] = f'"{entry.etag}"'
+        return Response(status_code=304, headers=headers)
+
+    encoding = choose_encoding(request.headers.get("accept-encoding"), entry.variants)
+    if encoding:
+        headers["ETag"] = f'"{entry.etag}-{encoding}"'
+        headers["Content-Encoding"] = encoding
+        return Response(content=entry.variants[encoding], media_type=entry.media_type, headers=headers)
+    headers["ETag"] = f'"{entry.etag}"'
+    return Response(content=entry.body, media_type=entry.media_type, headers=headers)
+
+
+class RenderCache:
+    """LRU of rendered responses (with their compressed variants), bounded by bytes."""
+
+    def __init__(self, max_bytes: int = DEFAULT_PAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, CachedBody]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[CachedBody]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: CachedBody):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            self._entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,214 @@
+"""
+Image stage of EPUB ingestion.
+
+Images are stored under content-hash names, so identical images are written
+once per book (and, with READER3_IMAGE_SHARED_DIR, once per shelf via hard
+links) and two different images with the same basename no longer overwrite
+each other. When Pillow is installed, large images are transcoded to
+WebP/AVIF, capped to a maximum width, and given narrower width variants for
+`srcset`. Without Pillow images are stored as-is (deduplicated).
+
+Configuration (environment):
+    READER3_IMAGE_FORMAT       webp (default), avif, or keep
+    READER3_IMAGE_QUALITY      encoder quality, default 80
+    READER3_IMAGE_MAX_WIDTH    wider images are downscaled, default 1600
+    READER3_IMAGE_WIDTHS       srcset variant widths, default "480,960"
+    READER3_IMAGE_MIN_BYTES    smaller images are kept as-is, default 100000
+    READER3_IMAGE_SHARED_DIR   shelf-wide store to hard-link images from
+"""
+
+import hashlib
+import io
+import os
+import re
+import shutil
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+try:
+    from PIL import Image, features
+except ImportError:  # optional dependency
+    Image = None
+    features = None
+
+# Rendered width of the reader's content column, for the sizes attribute.
+CONTENT_WIDTH = 760
+SIZES = f"(max-width: {CONTENT_WIDTH + 60}px) 100vw, {CONTENT_WIDTH}px"
+
+# Formats that are never transcoded (vector, possibly animated).
+_PASSTHROUGH_EXTS = {".svg", ".gif"}
+_EXTENSIONS = {"webp": ".webp", "avif": ".avif"}
+
+# Names written by ImageStore: "<digest>.ext" or "<digest>-<width>w.ext".
+_HASHED_NAME_RE = re.compile(r"^[0-9a-f]{16}(-\d+w)?\.[a-z0-9]+$")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+@dataclass
+class ImageOptions:
+    format: str = "webp"             # 'webp', 'avif' or 'keep'
+    quality: int = 80
+    max_width: int = 1600
+    widths: Tuple[int, ...] = (480, 960)
+    min_bytes: int = 100_000
+    shared_dir: Optional[str] = None
+
+    @classmethod
+    def from_env(cls) -> "ImageOptions":
+        widths = []
+        for part in os.getenv("READER3_IMAGE_WIDTHS", "480,960").split(","):
+            try:
+                widths.append(int(part))
+            except ValueError:
+                continue
+        return cls(
+            format=os.getenv("READER3_IMAGE_FORMAT", "webp").lower(),
+            quality=_env_int("READER3_IMAGE_QUALITY", 80),
+            max_width=_env_int("READER3_IMAGE_MAX_WIDTH", 1600),
+            widths=tuple(sorted(w for w in widths if w > 0)),
+            min_bytes=_env_int("READER3_IMAGE_MIN_BYTES", 100_000),
+            shared_dir=os.getenv("READER3_IMAGE_SHARED_DIR") or None,
+        )
+
+
+@dataclass
+class StoredImage:
+    src: str                                    # path relative to the book folder
+    attrs: Dict[str, str] = field(default_factory=dict)   # extra <img> attributes
+
+
+def is_content_addressed(filename: str) -> bool:
+    """True for image names derived from their content (safe to cache forever)."""
+    return bool(_HASHED_NAME_RE.match(filename))
+
+
+def archive_image_name(info) -> str:
+    """Name for an image served from its EPUB (zipfile.ZipInfo), from the zip
+    directory's CRC-32 and size, so the member need not be read."""
+    ext = os.path.splitext(info.filename)[1].lower()
+    return f"{info.CRC:08x}{info.file_size & 0xffffffff:08x}{ext}"
+
+
+def _can_encode(fmt: str) -> bool:
+    if Image is None or fmt not in _EXTENSIONS:
+        return False
+    return bool(features.check(fmt))
+
+
+class ImageStore:
+    """Writes a book's images into images_dir under content-hash names."""
+
+    def __init__(self, images_dir: str, options: Optional[ImageOptions] = None):
+        self.images_dir = images_dir
+        self.options = options or ImageOptions.from_env()
+        self._by_hash: Dict[str, StoredImage] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.duplicates = 0
+        self.transcoded = 0
+
+    def add(self, name: str, data: bytes) -> StoredImage:
+        """Store one image (name is its path inside the EPUB)."""
+        self.bytes_in += len(data)
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        stored = self._by_hash.get(digest)
+        if stored is not None:
+            self.duplicates += 1
+            return stored
+
+        ext = os.path.splitext(name)[1].lower()
+        stored = None
+        if ext not in _PASSTHROUGH_EXTS and _can_encode(self.options.format):
+            stored = self._transcode(digest, data, ext)
+        if stored is None:
+            stored = StoredImage(src=self._write(f"{digest}{ext}", data))
+        self._by_hash[digest] = stored
+        return stored
+
+    def _transcode(self, digest: str, data: bytes, ext: str) -> Optional[StoredImage]:
+        opts = self.options
+        try:
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        except Exception:
+            return None
+
+        width, height = img.size
+        attrs = {"width": str(width), "height": str(height)}
+        if len(data) < opts.min_bytes and width <= opts.max_width:
+            return StoredImage(src=self._write(f"{digest}{ext}", data), attrs=attrs)
+
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        resized = width > opts.max_width
+        if resized:
+            height = round(height * opts.max_width / width)
+            width = opts.max_width
+            img = img.resize((width, height), Image.LANCZOS)
+            attrs = {"width": str(width), "height": str(height)}
+
+        out_ext = _EXTENSIONS[opts.format]
+        encoded = self._encode(img)
+        if encoded is None or (len(encoded) >= len(data) and not resized):
+            # Transcoding did not help; keep the original bytes.
+            main_src = self._write(f"{digest}{ext}", data)
+        else:
+            main_src = self._write(f"{digest}{out_ext}", encoded)
+            self.transcoded += 1
+
+        srcset = []
+        for w in opts.widths:
+            if w >= width:
+                break
+            variant = img.resize((w, max(1, round(height * w / width))), Image.LANCZOS)
+            encoded_variant = self._encode(variant)
+            if encoded_variant is None:
+                break
+            srcset.append(f"{self._write(f'{digest}-{w}w{out_ext}', encoded_variant)} {w}w")
+        if srcset:
+            srcset.append(f"{main_src} {width}w")
+            attrs["srcset"] = ", ".join(srcset)
+            attrs["sizes"] = SIZES
+        return StoredImage(src=main_src, attrs=attrs)
+
+    def _encode(self, img) -> Optional[bytes]:
+        buf = io.BytesIO()
+        try:
+            img.save(buf, format=self.options.format.upper(), quality=self.options.quality)
+        except Exception:
+            return None
+        return buf.getvalue()
+
+    def _write(self, filename: str, data: bytes) -> str:
+        path = os.path.join(self.images_dir, filename)
+        self.bytes_out += len(data)
+        shared_dir = self.options.shared_dir
+        if shared_dir:
+            # Content-addressed names make the shelf-wide store safe to share.
+            shared_path = os.path.join(shared_dir, filename)
+            if not os.path.exists(shared_path):
+                os.makedirs(shared_dir, exist_ok=True)
+                tmp_path = shared_path + f".{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, shared_path)
+            try:
+                os.link(shared_path, path)
+                return f"images/{filename}"
+            except OSError:
+                shutil.copyfile(shared_path, path)
+                return f"images/{filename}"
+        with open(path, "wb") as f:
+            f.write(data)
+        return f"images/{filename}"
+
+    def summary(self) -> str:
+        return (f"{len(self._by_hash)} unique images ({self.duplicates} duplicates, "
+                f"{self.transcoded} transcoded), {self.bytes_in // 1024} KB -> {self.bytes_out // 1024} KB")
+
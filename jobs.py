@@ -0,0 +1,325 @@
+"""
+Background ingestion jobs.
+
+EPUB/Markdown processing is CPU-bound (BeautifulSoup parsing), so it runs in a
+process pool instead of inside the server's event loop. Endpoints submit a job
+and return its id immediately; clients poll /api/jobs/{id} for status and
+per-spine-item progress.
+
+A "hub_sync" job imports every new or changed file in books/hub; it uses the
+book id ALL_BOOKS and conflicts with every other job.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+from metrics import SpanCollector
+from reader3 import book_summary, ingest_source, resplit_saved_book, save_book, sync_hub
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.getenv(name, str(default))))
+    except ValueError:
+        return default
+
+
+# How many books are parsed at once, and how many may wait in the queue.
+INGEST_WORKERS = _env_int("READER3_INGEST_WORKERS", min(4, os.cpu_count() or 1))
+MAX_PENDING_JOBS = _env_int("READER3_MAX_PENDING_JOBS", 16)
+# How many finished jobs are kept around for polling clients.
+MAX_FINISHED_JOBS = 200
+
+# book_id of jobs that touch the whole shelf.
+ALL_BOOKS = "*"
+
+
+class QueueFullError(Exception):
+    """Raised when too many ingestion jobs are already queued or running."""
+
+
+class JobConflictError(Exception):
+    """Raised when a job for the same book is already queued or running."""
+
+    def __init__(self, job: "Job"):
+        if job.book_id == ALL_BOOKS:
+            message = f"Hub sync job {job.id} is running"
+        else:
+            message = f"Book {job.book_id} is already being processed by job {job.id}"
+        super().__init__(message)
+        self.job = job
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str            # 'epub', 'markdown', 'resplit' or 'hub_sync'
+    book_id: str         # target folder under books/shelf, ALL_BOOKS for hub_sync
+    source_path: str     # source file (books/hub for hub_sync)
+    output_dir: str      # book folder (books/shelf for hub_sync)
+    split_level: Optional[int]   # None for hub_sync: keep each book's level
+    workers: Optional[int] = None   # spine-document processes (EPUB only)
+    force: bool = False      # reprocess even if the source is unchanged
+    source_hash: Optional[str] = None   # sha256 of source_path, if already known
+    status: str = "queued"   # queued -> running -> done | error
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def conflicts_with(self, book_id: str) -> bool:
+        return ALL_BOOKS in (self.book_id, book_id) or self.book_id == book_id
+
+
+def run_ingest(
+    job_id: str,
+    kind: str,
+    source_path: str,
+    output_dir: str,
+    split_level: int,
+    workers: Optional[int] = None,
+    progress_store=None,
+    force: bool = False,
+    source_hash: Optional[str] = None,
+    started=None,
+) -> Dict[str, Any]:
+    """Worker-side entry point: process one source file and save it.
+
+    job_id is put on the started queue as soon as a worker picks the job up.
+    The result carries per-stage timings ("timings": span name -> seconds).
+    """
+    if started is not None:
+        started.put(job_id)
+    with SpanCollector() as spans:
+        result = _run_ingest(job_id, kind, source_path, output_dir, split_level, workers, progress_store,
+                             force, source_hash)
+    result["timings"] = spans.totals()
+    return result
+
+
+def _run_ingest(
+    job_id: str,
+    kind: str,
+    source_path: str,
+    output_dir: str,
+    split_level: int,
+    workers: Optional[int],
+    progress_store,
+    force: bool,
+    source_hash: Optional[str],
+) -> Dict[str, Any]:
+    def report(stage: str, done: int, total: int, item: Optional[str] = None):
+        if progress_store is not None:
+            progress_store[job_id] = {"stage": stage, "done": done, "total": total, "item": item}
+
+    report("started", 0, 0)
+    if kind == "hub_sync":
+        return sync_hub(source_path, output_dir, split_level=split_level, workers=workers, progress=report, force=force)
+
+    if kind in ("epub", "markdown"):
+        summary, processed = ingest_source(
+            source_path, output_dir, split_level=split_level, workers=workers, progress=report,
+            force=force, source_hash=source_hash,
+        )
+    elif kind == "resplit":
+        book = resplit_saved_book(output_dir, split_level)
+        if book is None:
+            raise ValueError(f"No saved layout in {output_dir}, re-import the source instead")
+        report("saving", 0, 0)
+        save_book(book, output_dir)
+        summary, processed = book_summary(book), True
+    else:
+        raise ValueError(f"Unknown job kind: {kind}")
+
+    return {
+        "title": summary["title"],
+        "split_level": summary["split_level"],
+        "chapters": summary["chapters"],
+        "cached": not processed,
+    }
+
+
+class JobManager:
+    """Bounded process-pool queue for ingestion jobs.
+
+    on_complete(job) is called (from a pool thread) after a job finishes
+    successfully, so the server can invalidate caches for that book.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = INGEST_WORKERS,
+        max_pending: int = MAX_PENDING_JOBS,
+        on_complete: Optional[Callable[[Job], None]] = None,
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.on_complete = on_complete
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._progress = None
+        self._started = None
+        self._watcher: Optional[threading.Thread] = None
+        self.finished = Counter()   # (kind, status) -> finished job count
+
+    def _ensure_started(self):
+        # Started lazily so importing the server does not spawn processes.
+        if self._executor is None:
+            self._manager = multiprocessing.Manager()
+            self._progress = self._manager.dict()
+            self._started = self._manager.Queue()
+            self._watcher = threading.Thread(target=self._watch_started, args=(self._started,), daemon=True)
+            self._watcher.start()
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def _watch_started(self, started):
+        # Flip jobs to "running" when a worker reports it picked them up, so
+        # the status does not depend on anyone polling.
+        while True:
+            try:
+                job_id = started.get()
+            except (EOFError, OSError):
+                return
+            if job_id is None:
+                return
+            with self._lock:
+                job = self._jobs.get(job_id)
+                # A fast job may have finished before its start event is read.
+                if job is not None and job.status == "queued" and job.finished_at is None:
+                    job.status = "running"
+                    job.started_at = time.time()
+
+    def submit(
+        self,
+        kind: str,
+        book_id: str,
+        source_path: str,
+        output_dir: str,
+        split_level: int,
+        workers: Optional[int] = None,
+        force: bool = False,
+        source_hash: Optional[str] = None,
+    ) -> Job:
+        with self._lock:
+            active = [j for j in self._jobs.values() if j.active]
+            for j in active:
+                if j.conflicts_with(book_id):
+                    raise JobConflictError(j)
+            if len(active) >= self.max_pending:
+                raise QueueFullError(f"{len(active)} ingestion jobs pending, try again later")
+
+            self._ensure_started()
+            job = Job(
+                id=uuid.uuid4().hex,
+                kind=kind,
+                book_id=book_id,
+                source_path=source_path,
+                output_dir=output_dir,
+                split_level=split_level,
+                workers=workers,
+                force=force,
+                source_hash=source_hash,
+            )
+            self._jobs[job.id] = job
+            self._prune()
+
+            future = self._executor.submit(
+                run_ingest, job.id, kind, source_path, output_dir, split_level, workers,
+                self._progress, force, source_hash, self._started,
+            )
+        # Outside the lock: a future that is already done runs _finish inline.
+        future.add_done_callback(lambda f, job=job: self._finish(job, f))
+        return job
+
+    def _finish(self, job: Job, future: Future):
+        try:
+            result, error = future.result(), None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        # Under the lock so _watch_started cannot flip the job back to running.
+        with self._lock:
+            job.result = result
+            job.error = error
+            job.status = "done" if error is None else "error"
+            job.finished_at = time.time()
+            self.finished[(job.kind, job.status)] += 1
+
+        if job.status == "done" and self.on_complete:
+            try:
+                self.on_complete(job)
+            except Exception as e:
+                print(f"Error in job completion hook for {job.id}: {e}")
+
+    def _prune(self):
+        finished = [j.id for j in self._jobs.values() if not j.active]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+            if self._progress is not None:
+                self._progress.pop(job_id, None)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def active_job(self, book_id: str) -> Optional[Job]:
+        with self._lock:
+            for job in self._jobs.values():
+                if job.active and job.conflicts_with(book_id):
+                    return job
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            active = Counter(j.status for j in self._jobs.values() if j.active)
+        return {
+            "queued": active.get("queued", 0),
+            "running": active.get("running", 0),
+            "finished": [
+                {"kind": kind, "status": status, "count": n} for (kind, status), n in sorted(self.finished.items())
+            ],
+        }
+
+    def status(self, job: Job) -> Dict[str, Any]:
+        progress = None
+        if self._progress is not None:
+            progress = self._progress.get(job.id)
+        return {
+            "job_id": job.id,
+            "kind": job.kind,
+            "book_id": job.book_id,
+            "split_level": job.split_level,
+            "workers": job.workers,
+            "force": job.force,
+            "status": job.status,
+            "progress": progress,
+            "submitted_at": job.submitted_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "result": job.result,
+            "error": job.error,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._started.put(None)
+            self._watcher.join(timeout=1)
+            self._manager.shutdown()
+            self._executor = None
+            self._manager = None
+            self._progress = None
+            self._started = None
+            self._watcher = None
@@ -0,0 +1,308 @@
+"""
+Lightweight instrumentation: timing spans, counters/histograms and the
+Prometheus text format.
+
+Spans mark stages of work:
+
+    with span("epub.parse", documents=n) as sp:
+        ...
+        sp.set(bytes=total)
+
+and cost a single list check when nobody listens: span() returns a shared
+no-op object unless a sink is registered. Sinks receive (name, seconds,
+attrs) for every finished span. SpanCollector gathers the spans of one
+ingestion, which is how per-stage timings travel from job worker processes
+back to the server.
+
+The server keeps a Registry of counters, histograms and callback metrics and
+renders it at /metrics; RequestMetricsMiddleware records request latency per
+handler.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+SpanSink = Callable[[str, float, Dict[str, Any]], None]
+
+_sinks: List[SpanSink] = []
+
+
+class Span:
+    __slots__ = ("name", "attrs", "_start")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+        self._start = 0.0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        for sink in list(_sinks):
+            sink(self.name, elapsed, self.attrs)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attrs):
+    """Time a stage; attrs (counts, sizes) are passed to the sinks with it."""
+    if not _sinks:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+
+def collecting() -> bool:
+    """True while any sink receives spans; guards span attrs that are costly
+    to compute."""
+    return bool(_sinks)
+
+
+def add_sink(sink: SpanSink):
+    _sinks.append(sink)
+
+
+def remove_sink(sink: SpanSink):
+    try:
+        _sinks.remove(sink)
+    except ValueError:
+        pass
+
+
+class SpanCollector:
+    """Records the spans finished while it is active (use as a context manager)."""
+
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+
+    def __call__(self, name: str, seconds: float, attrs: Dict[str, Any]):
+        self.spans.append({"name": name, "seconds": round(seconds, 6), **attrs})
+
+    def __enter__(self) -> "SpanCollector":
+        add_sink(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_sink(self)
+
+    def totals(self) -> Dict[str, float]:
+        """Seconds per span name, summed over repeats (e.g. one per book in a hub sync)."""
+        totals: Dict[str, float] = {}
+        for s in self.spans:
+            totals[s["name"]] = round(totals.get(s["name"], 0.0) + s["seconds"], 6)
+        return totals
+
+
+# --- Metrics registry ---
+
+# Request latencies, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, List[Any]] = {}   # key -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, [list(s[0]), s[1], s[2]]) for key, s in self._series.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """A gauge or counter whose samples are read from fn() at render time.
+
+    fn returns a number, or a list of (labels dict, value) pairs.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Any], type: str = "gauge",
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            samples = self.fn()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            return []
+        if samples is None:
+            return []
+        if isinstance(samples, (int, float)):
+            samples = [({}, samples)]
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, self._key(labels))} {_format_value(value)}"
+            for labels, value in samples if value is not None
+        ]
+
+
+class Registry:
+    """Named metrics rendered together in the Prometheus text format (0.0.4)."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, fn: Callable[[], Any], type: str = "gauge",
+                 labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self._add(CallbackMetric(name, help, fn, type, labelnames))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware observing request latency per handler (endpoint function
+    name), method and status into a Histogram with those labels."""
+
+    def __init__(self, app, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router fills in the endpoint on this same scope dict.
+            endpoint = scope.get("endpoint")
+            handler: Optional[str] = getattr(endpoint, "__name__", None) or "unmatched"
+            self.histogram.observe(
+                time.perf_counter() - start, handler=handler, method=scope.get("method", ""), status=status[0],
+            )
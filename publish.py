@@ -0,0 +1,228 @@
+"""
+Atomic, versioned publication of processed books.
+
+A book folder on the shelf is a symlink to its current generation:
+
+    foo_data -> .foo_data.generations/7
+    .foo_data.generations/6/           previous generation
+    .foo_data.generations/7/           current generation
+    .foo_data.generations/8.staging/   being written
+
+Ingestion and resplits write a complete book into a staging directory,
+rename it to its generation number and then swap the symlink with a single
+rename(2). Readers therefore see either the old book or the new one, never a
+missing or half-written folder. The manifest records its generation
+(Book.generation), so a reader holding a manifest reads chapters from that
+same generation even after a newer one is published (see
+reader3.book_files_dir). The previous generation is kept until the next
+publication so in-flight requests can finish; older ones are removed. The
+symlink is relative, so a shelf on a shared filesystem can be written by one
+node and served by others.
+
+Folders written before generations existed are plain directories; the first
+publication moves such a folder to generation 0 and links the new one. Where
+renameat2(RENAME_EXCHANGE) is available (Linux) the move is a pair of atomic
+swaps, so neither the book folder nor generation 0 is ever missing; elsewhere
+the folder is briefly absent between two renames.
+"""
+
+import errno
+import os
+import shutil
+import time
+from typing import Iterable, List, Optional
+
+try:
+    import ctypes
+
+    _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    _renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    _renameat2.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError, TypeError):
+    _renameat2 = None
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+GENERATIONS_SUFFIX = ".generations"
+STAGING_SUFFIX = ".staging"
+
+try:
+    KEEP_PREVIOUS_GENERATIONS = max(0, int(os.getenv("READER3_KEEP_GENERATIONS", "1")))
+except ValueError:
+    KEEP_PREVIOUS_GENERATIONS = 1
+
+# Staging directories left behind by a crashed ingestion are removed after this long.
+STALE_STAGING_SECONDS = 24 * 3600
+
+
+def generations_dir(book_dir: str) -> str:
+    book_dir = os.path.normpath(book_dir)
+    parent, name = os.path.split(book_dir)
+    return os.path.join(parent, f".{name}{GENERATIONS_SUFFIX}")
+
+
+def generation_dir(book_dir: str, generation: int) -> str:
+    return os.path.join(generations_dir(book_dir), str(generation))
+
+
+def current_generation(book_dir: str) -> Optional[int]:
+    """Generation the book folder links to; None for a plain (or missing) folder."""
+    try:
+        target = os.readlink(book_dir)
+    except OSError:
+        return None
+    try:
+        return int(os.path.basename(os.path.normpath(target)))
+    except ValueError:
+        return None
+
+
+def _generations(book_dir: str) -> List[int]:
+    try:
+        names = os.listdir(generations_dir(book_dir))
+    except OSError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def exchange_paths(a: str, b: str) -> bool:
+    """Atomically swap two existing paths; False where the platform or
+    filesystem does not support it."""
+    if _renameat2 is None:
+        return False
+    if _renameat2(_AT_FDCWD, os.fsencode(a), _AT_FDCWD, os.fsencode(b), _RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(err, os.strerror(err), a, None, b)
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class BookStaging:
+    """A staging directory for the next generation of a book folder.
+
+    Use as a context manager: the staging directory is published when the
+    block completes and removed if it raises. `inherit` names files or
+    directories of the current generation to carry over (hard-linked where
+    the filesystem allows) for writers that only replace part of a book.
+    """
+
+    def __init__(self, book_dir: str, inherit: Iterable[str] = ()):
+        self.book_dir = os.path.normpath(book_dir)
+        self.inherit = tuple(inherit)
+        self.generation = 0
+        self.path = ""
+
+    def __enter__(self) -> "BookStaging":
+        gens_dir = generations_dir(self.book_dir)
+        os.makedirs(gens_dir, exist_ok=True)
+        generation = max([current_generation(self.book_dir) or 0, *_generations(self.book_dir)]) + 1
+        while True:
+            path = os.path.join(gens_dir, f"{generation}{STAGING_SUFFIX}")
+            try:
+                os.mkdir(path)
+                break
+            except FileExistsError:
+                # Another writer is staging this generation.
+                generation += 1
+        self.generation = generation
+        self.path = path
+
+        for name in self.inherit:
+            src = os.path.join(self.book_dir, name)
+            dst = os.path.join(self.path, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, copy_function=_link_or_copy)
+            elif os.path.exists(src):
+                _link_or_copy(src, dst)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return False
+        self.publish()
+        return False
+
+    def publish(self):
+        final = generation_dir(self.book_dir, self.generation)
+        os.rename(self.path, final)
+        self.path = final
+
+        parent = os.path.dirname(self.book_dir) or "."
+        link_tmp = f"{self.book_dir}.link-{os.getpid()}-{self.generation}"
+        os.symlink(os.path.relpath(final, parent), link_tmp)
+        try:
+            if os.path.isdir(self.book_dir) and not os.path.islink(self.book_dir):
+                # A folder written in place before generations: it becomes generation 0.
+                self._migrate_legacy(link_tmp)
+            else:
+                os.replace(link_tmp, self.book_dir)
+        except OSError:
+            if os.path.islink(link_tmp):
+                os.unlink(link_tmp)
+            raise
+        prune_generations(self.book_dir)
+
+    def _migrate_legacy(self, link_tmp: str):
+        """Move the plain book folder to generation 0 and put link_tmp in its
+        place. Readers of a generation-0 manifest switch from the folder to
+        generation 0 (reader3.book_files_dir) once book_dir is a link, so
+        generation 0 must exist by then: it starts as a link to where the
+        folder lands after the first swap, and the second swap moves the
+        folder into it."""
+        gen0 = generation_dir(self.book_dir, 0)
+        os.symlink(os.path.relpath(link_tmp, os.path.dirname(gen0)), gen0)
+        try:
+            swapped = exchange_paths(self.book_dir, link_tmp)
+        except OSError:
+            os.unlink(gen0)
+            raise
+        if not swapped:
+            os.unlink(gen0)
+            os.rename(self.book_dir, gen0)
+            os.replace(link_tmp, self.book_dir)
+            return
+        # book_dir now links to the new generation and link_tmp is the folder.
+        exchange_paths(gen0, link_tmp)
+        os.unlink(link_tmp)
+
+
+def prune_generations(book_dir: str, keep: int = KEEP_PREVIOUS_GENERATIONS):
+    """Remove all but the current and the `keep` newest older generations,
+    and staging directories abandoned long ago."""
+    current = current_generation(book_dir)
+    if current is None:
+        return
+    gens_dir = generations_dir(book_dir)
+    older = [g for g in _generations(book_dir) if g < current]
+    for generation in older[:max(0, len(older) - keep)]:
+        shutil.rmtree(os.path.join(gens_dir, str(generation)), ignore_errors=True)
+
+    cutoff = time.time() - STALE_STAGING_SECONDS
+    for name in os.listdir(gens_dir):
+        path = os.path.join(gens_dir, name)
+        if name.endswith(STAGING_SUFFIX):
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+
+def remove_book(book_dir: str):
+    """Delete a book folder with all its generations."""
+    book_dir = os.path.normpath(book_dir)
+    if os.path.islink(book_dir):
+        os.unlink(book_dir)
+    elif os.path.isdir(book_dir):
+        shutil.rmtree(book_dir)
+    shutil.rmtree(generations_dir(book_dir), ignore_errors=True)
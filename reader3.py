@@ -2,23 +2,61 @@
 Parses an EPUB file into a structured object that can be used to serve the book via a web interface.
 """
 
+import hashlib
+import html
+import json
 import os
 import pickle
+import posixpath
 import re
-import shutil
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Any
+import sys
+import zipfile
+import xml.etree.ElementTree as ET
+from dataclasses import MISSING, dataclass, field, fields, replace
+from typing import List, Dict, Optional, Any, Callable, Iterable, Iterator, Tuple
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from urllib.parse import unquote
+from urllib.parse import quote, unquote, urlsplit
 
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup, Comment, Tag
+from bs4 import BeautifulSoup, CData, Comment, NavigableString, Tag
 import markdown as md_lib
 
+from images import ImageStore, archive_image_name
+from metrics import collecting, span
+from publish import BookStaging, generation_dir
+
 # --- Data structures ---
+#
+# The records below are slotted: a server caches many manifests, and per-instance
+# __dict__s were a large share of each one. They pickle as plain field dicts
+# and accept the dict state of pickles written before they had __slots__.
+
+def _record_getstate(self) -> Dict[str, Any]:
+    return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+def _record_setstate(self, state):
+    if isinstance(state, tuple):    # (dict state, slot state)
+        state = {**(state[0] or {}), **(state[1] or {})}
+    for f in fields(self):
+        if f.name in state:
+            value = state[f.name]
+        elif f.default is not MISSING:
+            value = f.default
+        elif f.default_factory is not MISSING:
+            value = f.default_factory()
+        else:
+            continue
+        if f.name in self._INTERNED and isinstance(value, str):
+            value = sys.intern(value)
+        object.__setattr__(self, f.name, value)
 
-@dataclass
+
+@dataclass(slots=True)
 class ChapterContent:
     """
     Represents a physical file in the EPUB (Spine Item).
@@ -31,8 +69,27 @@ class ChapterContent:
     text: str         # Plain text for search/LLM context
     order: int        # Linear reading order
 
+    # Byte span inside chapters.bin when stored in the split layout.
+    # offset == -1 means content/text are held inline (legacy book.pkl);
+    # for those, text_size == -1 means text was dropped and is derived from
+    # content on demand.
+    offset: int = -1
+    content_size: int = 0
+    text_size: int = 0
 
-@dataclass
+    # (id, char offset into text) for elements with an id; consumed by the
+    # search index at save time and not kept in the manifest.
+    anchors: Optional[List[Tuple[str, int]]] = None
+    # Char offsets into text where block elements (paragraphs, list items,
+    # headings, ...) start; consumed by the context index like anchors.
+    breaks: Optional[List[int]] = None
+
+    _INTERNED = ("href",)
+    __getstate__ = _record_getstate
+    __setstate__ = _record_setstate
+
+
+@dataclass(slots=True)
 class TOCEntry:
     """Represents a logical entry in the navigation sidebar."""
     title: str
@@ -43,8 +100,12 @@ class TOCEntry:
     depth: int = 0
     chapter_index: Optional[int] = None
 
+    _INTERNED = ("file_href",)
+    __getstate__ = _record_getstate
+    __setstate__ = _record_setstate
 
-@dataclass
+
+@dataclass(slots=True)
 class BookMetadata:
     """Metadata"""
     title: str
@@ -56,8 +117,109 @@ class BookMetadata:
     identifiers: List[str] = field(default_factory=list)
     subjects: List[str] = field(default_factory=list)
 
+    _INTERNED = ()
+    __getstate__ = _record_getstate
+    __setstate__ = _record_setstate
 
-@dataclass
+
+class AnchorTable(Mapping):
+    """href -> spine index for chapter files and the element ids inside them.
+
+    Answers the same keys as the flat dict it replaces: full paths
+    ('OEBPS/Text/ch01.xhtml', 'OEBPS/Text/ch01.xhtml#note3') and their
+    basename variants ('ch01.xhtml#note3'). Each id is stored once, under its
+    file; a basename key resolves through the files sharing that basename in
+    the order they were registered, so the first registration wins as before.
+    """
+
+    __slots__ = ("_files", "_anchors", "_by_basename")
+
+    def __init__(self):
+        self._files: Dict[str, int] = {}                # path -> spine index
+        self._anchors: Dict[str, Dict[str, int]] = {}  # path -> {id: spine index}
+        self._by_basename: Dict[str, List[str]] = {}   # basename -> paths, in registration order
+
+    @classmethod
+    def from_dict(cls, mapping: Dict[str, int]) -> "AnchorTable":
+        """Convert a flat anchor_map (books saved before 3.5) without changing any lookup."""
+        table = cls()
+        for key, index in mapping.items():
+            if "/" in key.partition("#")[0]:
+                table._add_key(key, index)
+        # Basename keys are only kept where they do not already resolve the same way.
+        for key, index in mapping.items():
+            if "/" not in key.partition("#")[0] and table.get(key) != index:
+                table._add_key(key, index)
+        return table
+
+    def _path(self, path: str) -> str:
+        if path not in self._anchors:
+            path = sys.intern(path)
+            self._anchors[path] = {}
+            self._by_basename.setdefault(os.path.basename(path), []).append(path)
+        return path
+
+    def _add_key(self, key: str, index: int):
+        path, sep, anchor_id = key.partition("#")
+        if sep:
+            self.add_anchor(path, anchor_id, index)
+        else:
+            self.add_file(path, index)
+
+    def add_file(self, path: str, index: int):
+        self._files.setdefault(self._path(path), index)
+
+    def add_anchor(self, path: str, anchor_id: str, index: int):
+        self._anchors[self._path(path)].setdefault(anchor_id, index)
+
+    def _find(self, path: str, anchor_id: Optional[str]) -> Optional[int]:
+        if anchor_id is None:
+            return self._files.get(path)
+        ids = self._anchors.get(path)
+        return ids.get(anchor_id) if ids else None
+
+    def __getitem__(self, key: str) -> int:
+        path, sep, anchor_id = key.partition("#")
+        anchor_id = anchor_id if sep else None
+        index = self._find(path, anchor_id)
+        if index is None and "/" not in path:
+            for full_path in self._by_basename.get(path, ()):
+                index = self._find(full_path, anchor_id)
+                if index is not None:
+                    break
+        if index is None:
+            raise KeyError(key)
+        return index
+
+    def __iter__(self) -> Iterator[str]:
+        seen = set()
+        for path, ids in self._anchors.items():
+            base = os.path.basename(path)
+            for prefix in (path, base) if base != path else (path,):
+                keys = [prefix] if path in self._files else []
+                keys.extend(f"{prefix}#{anchor_id}" for anchor_id in ids)
+                for key in keys:
+                    if key not in seen:
+                        seen.add(key)
+                        yield key
+
+    def __len__(self) -> int:
+        # Walks every key; not for hot paths.
+        return sum(1 for _ in self)
+
+    def __bool__(self) -> bool:
+        return bool(self._anchors)
+
+    def __repr__(self) -> str:
+        return f"AnchorTable({len(self._anchors)} files, {sum(map(len, self._anchors.values()))} ids)"
+
+
+# Format version of processed books; part of the ingestion cache key. (Book
+# is slotted, so its field defaults are not readable as class attributes.)
+BOOK_VERSION = "3.9"
+
+
+@dataclass(slots=True)
 class Book:
     """The Master Object to be pickled."""
     metadata: BookMetadata
@@ -68,9 +230,32 @@ class Book:
     # Meta info
     source_file: str
     processed_at: str
-    anchor_map: Dict[str, int] = field(default_factory=dict)
+    anchor_map: AnchorTable = field(default_factory=AnchorTable)
     split_level: int = 1
-    version: str = "3.1"
+    # Size cut limit the book was split with; 0: none, None: saved before
+    # size cuts existed.
+    max_chapter_kb: Optional[int] = None
+    version: str = BOOK_VERSION
+
+    # Identity of the source file, for skipping unchanged re-imports.
+    source_hash: Optional[str] = None           # sha256 hex digest
+    source_stat: Optional[List[int]] = None     # [size, mtime_ns] when hashed
+
+    # Zero-copy image mode: images are served from this EPUB instead of images/.
+    image_archive: Optional[str] = None         # absolute path of the source EPUB
+    image_members: Dict[str, str] = field(default_factory=dict)   # image file name -> zip member
+
+    # Generation directory the book was published to (see publish.py);
+    # 0 for folders written in place.
+    generation: int = 0
+
+    _INTERNED = ()
+    __getstate__ = _record_getstate
+
+    def __setstate__(self, state):
+        _record_setstate(self, state)
+        if isinstance(self.anchor_map, dict):
+            self.anchor_map = AnchorTable.from_dict(self.anchor_map)
 
 
 # --- Utilities ---
@@ -99,25 +284,69 @@ def extract_plain_text(soup: BeautifulSoup) -> str:
     return ' '.join(text.split())
 
 
-def register_anchors_from_soup(soup: BeautifulSoup, file_name: str, order: int, anchor_map: Dict[str, int]):
+class _TextCollector:
+    """Builds the same collapsed text as extract_plain_text() incrementally,
+    remembering where each id'd element starts in that text."""
+
+    def __init__(self):
+        self.words: List[str] = []
+        self.length = 0
+        self.anchors: List[Tuple[str, int]] = []
+        self.breaks: List[int] = []
+
+    def add_string(self, s: str):
+        for word in s.split():
+            if self.words:
+                self.length += 1
+            self.words.append(word)
+            self.length += len(word)
+
+    def add_anchor(self, anchor_id: str):
+        self.anchors.append((anchor_id, self.length + 1 if self.words else 0))
+
+    def add_break(self):
+        offset = self.length + 1 if self.words else 0
+        if not self.breaks or self.breaks[-1] != offset:
+            self.breaks.append(offset)
+
+    @property
+    def text(self) -> str:
+        return ' '.join(self.words)
+
+
+def extract_text_and_anchors(soup: BeautifulSoup) -> Tuple[str, List[Tuple[str, int]]]:
+    """Plain text plus (id, text offset) for every element with an id, in one walk."""
+    collector = _TextCollector()
+    for node in soup.descendants:
+        if isinstance(node, Tag):
+            anchor_id = node.get("id")
+            if anchor_id:
+                collector.add_anchor(anchor_id)
+        elif type(node) in (NavigableString, CData):
+            collector.add_string(node)
+    return collector.text, collector.anchors
+
+
+def register_anchors_from_soup(soup: BeautifulSoup, file_name: str, order: int, anchor_map: AnchorTable):
     """Register anchors for both full path and basename variants.
 
     Some EPUB TOC hrefs use shortened paths (e.g. "Text/ch01.xhtml#foo") while
     spine item names may include a longer prefix (e.g. "OEBPS/Text/ch01.xhtml").
     To make lookups robust we register both variants.
     """
-    basename = os.path.basename(file_name)
+    anchor_ids = [el.get("id") for el in soup.find_all(attrs={"id": True}) if el.get("id")]
+    register_anchor_ids(anchor_ids, file_name, order, anchor_map)
+
+
+def register_anchor_ids(anchor_ids: List[str], file_name: str, order: int, anchor_map: AnchorTable):
+    """Register already-collected anchor ids (full path and basename keys, first wins)."""
+    for anchor_id in anchor_ids:
+        anchor_map.add_anchor(file_name, anchor_id, order)
 
-    for el in soup.find_all(attrs={"id": True}):
-        anchor_id = el.get("id")
-        if not anchor_id:
-            continue
-        full_key = f"{file_name}#{anchor_id}"
-        base_key = f"{basename}#{anchor_id}"
-        if full_key not in anchor_map:
-            anchor_map[full_key] = order
-        if base_key not in anchor_map:
-            anchor_map[base_key] = order
+
+def register_file_keys(file_name: str, order: int, anchor_map: AnchorTable):
+    """Point the bare file keys (full path and basename) at a chapter, first wins."""
+    anchor_map.add_file(file_name, order)
 
 
 def parse_toc_recursive(toc_list, depth=0) -> List[TOCEntry]:
@@ -200,7 +429,7 @@ def extract_metadata_robust(book_obj) -> BookMetadata:
     )
 
 
-def _resolve_toc_entry_index(entry: TOCEntry, anchor_map: Dict[str, int]) -> Optional[int]:
+def _resolve_toc_entry_index(entry: TOCEntry, anchor_map: AnchorTable) -> Optional[int]:
     """Resolve which spine index a TOC entry should point to using anchor_map.
 
     We try several key variants to be robust against path differences, mimicking
@@ -240,7 +469,7 @@ def _resolve_toc_entry_index(entry: TOCEntry, anchor_map: Dict[str, int]) -> Opt
 
 def attach_chapter_indices_to_toc(
     toc_entries: List[TOCEntry],
-    anchor_map: Dict[str, int],
+    anchor_map: AnchorTable,
     max_depth: Optional[int] = None,
     _ancestors: Optional[List[TOCEntry]] = None,
 ) -> None:
@@ -275,22 +504,538 @@ def attach_chapter_indices_to_toc(
             attach_chapter_indices_to_toc(entry.children, anchor_map, max_depth=max_depth, _ancestors=new_ancestors)
 
 
+# --- Internal Links ---
+#
+# Links between the book's own documents (footnotes, cross-references) are
+# rewritten at parse time to a placeholder naming their target: the path
+# inside the book and the fragment. ChapterStoreWriter resolves them against
+# anchor_map and writes relative links to the chapter page holding the target
+# ("12#note3", or "#note3" within the same chapter), so the reader follows
+# them without any href lookup tables. Layouts keep the placeholders, so a
+# resplit resolves them again for its own chapter numbering.
+
+_LINK_PREFIX = "reader3-link:"
+_LINK_PREFIX_BYTES = _LINK_PREFIX.encode()
+_LINK_RE = re.compile(rb'href="' + _LINK_PREFIX_BYTES + rb'([^"]*)"')
+
+
+def mark_internal_links(content_root: Tag, href: str):
+    """Replace relative <a href>s of the document at href with link placeholders."""
+    base_dir = posixpath.dirname(href)
+    for a in content_root.find_all("a", href=True):
+        target = a["href"].strip()
+        if not target or target == "#" or target.startswith("/"):
+            continue
+        parts = urlsplit(target)
+        if parts.scheme or parts.netloc:
+            continue
+        path = posixpath.normpath(posixpath.join(base_dir, unquote(parts.path))) if parts.path else href
+        a["href"] = _LINK_PREFIX + quote(path) + (f"#{parts.fragment}" if parts.fragment else "")
+
+
+def resolve_link(placeholder: bytes, anchor_map: AnchorTable, index: int, final: bool = False) -> Optional[bytes]:
+    """The href attribute replacing a link placeholder in chapter index.
+
+    Returns None while the target's document has not been registered in
+    anchor_map yet (unless final); a target that never resolves loses its
+    href, leaving the link text in place.
+    """
+    path, sep, fragment = placeholder.decode("utf-8").partition("#")
+    path = unquote(path)
+    file_index = anchor_map.get(path)
+    if file_index is None:
+        return None if not final else b""
+    target = anchor_map.get(f"{path}#{unquote(html.unescape(fragment))}", file_index) if sep else file_index
+    link = "" if target == index and sep else str(target)
+    if sep:
+        link += f"#{fragment}"
+    return f'href="{link}"'.encode("utf-8")
+
+
+# --- Spine Documents ---
+
+@dataclass
+class DocumentSegment:
+    """One logical chapter cut out of a spine document."""
+    title: Optional[str]
+    content: str
+    text: str
+    anchors: List[Tuple[str, int]]   # (id, char offset into text)
+    level: Optional[int] = None      # level of the heading that starts the segment
+    anchor: Optional[str] = None     # id of that heading
+    breaks: List[int] = field(default_factory=list)   # block start offsets into text
+    part: int = 0                    # > 0 for the later pieces of a chapter cut by size
+
+
+HEADING_LEVELS = {f"h{i}": i for i in range(1, 7)}
+
+# Elements whose start begins a new paragraph of the plain text.
+BLOCK_TAGS = frozenset({
+    "p", "div", "section", "article", "aside", "blockquote", "pre", "li", "dt", "dd",
+    "tr", "figure", "figcaption", "caption", "table", *HEADING_LEVELS,
+})
+
+# Block boundaries where an oversized chapter may be cut are recorded as marks
+# of this level, which no split level matches, once the piece before them
+# holds at least BLOCK_MARK_INTERVAL characters of HTML.
+BLOCK_MARK_LEVEL = 7
+BLOCK_MARK_INTERVAL = 8 * 1024
+# Elements a size cut may be placed before, and the only elements it may be
+# nested in (closed before the cut and re-opened after it).
+SPLIT_BLOCK_TAGS = frozenset({
+    "p", "div", "section", "article", "blockquote", "pre", "table", "ul", "ol", "dl", "figure", "hr",
+})
+SPLIT_WRAPPER_TAGS = frozenset({"div", "section", "article", "main"})
+
+# Placeholder comments inserted before marked headings and blocks so their
+# offsets can be found in the serialized HTML. Source comments are stripped by clean_html_content.
+_MARK_PREFIX = "reader3-mark-"
+_MARK_RE = re.compile(r"<!--" + _MARK_PREFIX + r"\d+-->")
+
+
+@dataclass
+class HeadingMark:
+    """Position of a heading (or of a block boundary, at BLOCK_MARK_LEVEL)
+    inside DocumentLayout.html."""
+    offset: int                      # char offset where the heading tag starts
+    level: int                       # 1-6, or BLOCK_MARK_LEVEL
+    title: Optional[str]
+    wrappers: List[Tuple[str, str]]  # (tag name, opening tag) of enclosing elements, outermost first
+    anchor: Optional[str] = None     # the heading's id, if any
+
+
+@dataclass
+class DocumentLayout:
+    """A cleaned spine document cut at every heading (h1-h6) and at block
+    boundaries spaced for size cuts.
+
+    pieces[0] is the HTML before the first mark; pieces[k + 1] runs from
+    marks[k] to the next mark. Text and anchors are kept per piece so that
+    segments at any split level are assembled without parsing.
+    """
+    html: str
+    marks: List[HeadingMark]
+    piece_texts: List[str]
+    piece_anchors: List[List[Tuple[str, int]]]   # (id, char offset into the piece text)
+    piece_tags: List[int]            # number of elements opened in each piece
+    # Block start offsets into each piece text; missing from layouts saved
+    # before paragraph breaks were recorded.
+    piece_breaks: List[List[int]] = field(default_factory=list)
+
+
+def _opening_tag(tag: Tag) -> str:
+    """Serialized opening tag, without id so re-opened wrappers stay unique."""
+    attrs = {k: v for k, v in tag.attrs.items() if k != "id"}
+    clone = Tag(name=tag.name, attrs=attrs)
+    html = str(clone)
+    close = f"</{tag.name}>"
+    return html[:-len(close)] if html.endswith(close) else html
+
+
+def _is_split_point(node: Tag, content_root: Tag) -> bool:
+    """True if a size cut may be placed right before node."""
+    if node.name not in SPLIT_BLOCK_TAGS:
+        return False
+    for parent in node.parents:
+        if parent is content_root:
+            return True
+        if parent.name not in SPLIT_WRAPPER_TAGS:
+            return False
+    return False
+
+
+def _tag_size(tag: Tag) -> int:
+    """Approximate length of a tag's serialized start and end tags."""
+    return 2 * len(tag.name) + 5 + sum(len(k) + len(v) + 4 for k, v in tag.attrs.items() if isinstance(v, str))
+
+
+def analyze_document(content_root: Tag) -> DocumentLayout:
+    """Walk a parsed document once, collecting headings, text and anchors.
+
+    Headings nested in wrapper elements (<div>, <section>, ...) are handled by
+    recording the enclosing tags, which segment_document() closes before a cut
+    and re-opens after it. Block boundaries where a chapter may be cut by
+    size are marked the same way, about every BLOCK_MARK_INTERVAL characters.
+    """
+    cut_nodes: List[Tuple[Tag, int]] = []
+    pieces: List[_TextCollector] = [_TextCollector()]
+    tags: List[int] = [0]
+    size = 0    # approximate HTML length of the current piece
+
+    for node in content_root.descendants:
+        if isinstance(node, Tag):
+            level = HEADING_LEVELS.get(node.name)
+            if level is None and size >= BLOCK_MARK_INTERVAL and _is_split_point(node, content_root):
+                level = BLOCK_MARK_LEVEL
+            if level is not None:
+                cut_nodes.append((node, level))
+                pieces.append(_TextCollector())
+                tags.append(0)
+                size = 0
+            tags[-1] += 1
+            size += _tag_size(node)
+            if node.name in BLOCK_TAGS:
+                pieces[-1].add_break()
+            anchor_id = node.get("id")
+            if anchor_id:
+                pieces[-1].add_anchor(anchor_id)
+        elif type(node) in (NavigableString, CData):
+            pieces[-1].add_string(node)
+            size += len(node)
+
+    marks = []
+    for k, (node, level) in enumerate(cut_nodes):
+        wrappers = []
+        for parent in node.parents:
+            if parent is content_root:
+                break
+            wrappers.append((parent.name, _opening_tag(parent)))
+        wrappers.reverse()
+        heading = level != BLOCK_MARK_LEVEL
+        marks.append(HeadingMark(
+            offset=0,
+            level=level,
+            title=(node.get_text(separator=" ", strip=True) or None) if heading else None,
+            wrappers=wrappers,
+            anchor=node.get("id") if heading else None,
+        ))
+        node.insert_before(Comment(f"{_MARK_PREFIX}{k}"))
+
+    marked_html = content_root.decode_contents()
+    parts = []
+    pos = 0
+    length = 0
+    for k, m in enumerate(_MARK_RE.finditer(marked_html)):
+        parts.append(marked_html[pos:m.start()])
+        length += m.start() - pos
+        marks[k].offset = length
+        pos = m.end()
+    parts.append(marked_html[pos:])
+
+    return DocumentLayout(
+        html="".join(parts),
+        marks=marks,
+        piece_texts=[p.text for p in pieces],
+        piece_anchors=[p.anchors for p in pieces],
+        piece_tags=tags,
+        piece_breaks=[p.breaks for p in pieces],
+    )
+
+
+def _join_pieces(layout: DocumentLayout, start: int, end: int) -> Tuple[str, List[Tuple[str, int]], List[int]]:
+    """Concatenate piece texts, shifting anchor and break offsets into the joined text."""
+    parts = []
+    anchors = []
+    breaks = []
+    piece_breaks = getattr(layout, "piece_breaks", None) or [()] * len(layout.piece_texts)
+    length = 0
+    for i in range(start, end):
+        piece_text = layout.piece_texts[i]
+        base = length + 1 if (length and piece_text) else length
+        for anchor_id, offset in layout.piece_anchors[i]:
+            anchors.append((anchor_id, base + offset if piece_text else length))
+        for offset in piece_breaks[i]:
+            offset = base + offset if piece_text else length
+            if not breaks or breaks[-1] != offset:
+                breaks.append(offset)
+        if piece_text:
+            parts.append(piece_text)
+            length = base + len(piece_text)
+    return " ".join(parts), anchors, breaks
+
+
+def _close_tags(wrappers: List[Tuple[str, str]]) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(wrappers))
+
+
+def _size_cuts(layout: DocumentLayout, cuts: List[int], max_size: int) -> List[int]:
+    """Further marks to cut at so that, where the marks allow, no segment
+    between the heading cuts holds more than max_size characters of HTML."""
+    cut_set = set(cuts)
+    result = []
+    start, last = 0, None
+    ends = [(k, mark.offset) for k, mark in enumerate(layout.marks)]
+    ends.append((None, len(layout.html)))
+    for k, offset in ends:
+        if offset - start > max_size and last is not None:
+            result.append(last)
+            start = layout.marks[last].offset
+        if k is None or k in cut_set:
+            start, last = offset, None
+        else:
+            last = k
+    return result
+
+
+def segment_document(layout: DocumentLayout, split_level: int, max_size: int = 0) -> List[DocumentSegment]:
+    """Cut a document at headings of level <= split_level. No HTML parsing.
+
+    With max_size, a segment holding more than max_size characters of HTML
+    is cut further at deeper headings or block boundaries (its later pieces
+    are numbered by DocumentSegment.part).
+    """
+    heading_cuts = [k for k, mark in enumerate(layout.marks) if mark.level <= split_level]
+    cuts = heading_cuts
+    if max_size > 0 and len(layout.html) > max_size:
+        cuts = sorted(heading_cuts + _size_cuts(layout, heading_cuts, max_size))
+    if not cuts:
+        text, anchors, breaks = _join_pieces(layout, 0, len(layout.piece_texts))
+        return [DocumentSegment(title=None, content=layout.html, text=text, anchors=anchors, breaks=breaks)]
+
+    segments = []
+
+    # Content before the first cut, unless it is only the opening tags of
+    # the first heading's wrappers (whose ids then move to the next segment).
+    first = layout.marks[cuts[0]]
+    text, pre_anchors, breaks = _join_pieces(layout, 0, cuts[0] + 1)
+    pre_tags = sum(layout.piece_tags[:cuts[0] + 1])
+    pre_html = layout.html[:first.offset]
+    if text or pre_tags > len(first.wrappers):
+        segments.append(DocumentSegment(
+            title=None,
+            content=pre_html + _close_tags(first.wrappers),
+            text=text,
+            anchors=pre_anchors,
+            breaks=breaks,
+        ))
+        pre_html = None
+        pre_anchors = []
+
+    heading_set = set(heading_cuts)
+    chapter_title = None
+    part = 0
+    for i, k in enumerate(cuts):
+        mark = layout.marks[k]
+        if i + 1 < len(cuts):
+            end_k = cuts[i + 1]
+            end_offset = layout.marks[end_k].offset
+            end_wrappers = layout.marks[end_k].wrappers
+        else:
+            end_k = len(layout.marks)
+            end_offset = len(layout.html)
+            end_wrappers = []
+
+        if i == 0 and pre_html is not None:
+            # Keep the original wrapper tags (with their ids).
+            opening = pre_html
+        else:
+            opening = "".join(tag for _, tag in mark.wrappers)
+        html = opening + layout.html[mark.offset:end_offset] + _close_tags(end_wrappers)
+        text, anchors, breaks = _join_pieces(layout, k + 1, end_k + 1)
+        if i == 0 and pre_anchors:
+            anchors = [(anchor_id, 0) for anchor_id, _ in pre_anchors] + anchors
+        if k in heading_set:
+            chapter_title, part = mark.title, 0
+            title, level, anchor = mark.title, mark.level, mark.anchor
+        else:
+            part += 1
+            title = f"{chapter_title} ({part + 1})" if chapter_title else None
+            level = anchor = None
+        segments.append(DocumentSegment(
+            title=title,
+            content=html,
+            text=text,
+            anchors=anchors,
+            level=level,
+            anchor=anchor,
+            breaks=breaks,
+            part=part,
+        ))
+
+    return segments
+
+
+def resolve_workers(workers: Optional[int] = None) -> int:
+    """Number of processes used to parse spine documents.
+
+    Priority: explicit argument, then READER3_SPINE_WORKERS, then 1 (in-process).
+    """
+    if workers is None:
+        try:
+            workers = int(os.getenv("READER3_SPINE_WORKERS", "1"))
+        except ValueError:
+            workers = 1
+    return max(1, min(int(workers), os.cpu_count() or 1))
+
+
+def parse_spine_document(
+    raw: bytes,
+    image_map: Dict[str, str],
+    image_attrs: Optional[Dict[str, Dict[str, str]]] = None,
+    href: str = "",
+) -> DocumentLayout:
+    """Parse and clean one spine document into a split-level independent layout.
+
+    href is the document's path inside the EPUB, used to resolve relative
+    image paths and links; image_attrs maps a stored image to extra <img> attributes
+    (srcset, sizes, width, height).
+    """
+    raw_content = raw.decode('utf-8', errors='ignore')
+    soup = BeautifulSoup(raw_content, 'html.parser')
+
+    # A. Fix Images
+    base_dir = posixpath.dirname(href)
+    for img in soup.find_all('img'):
+        src = img.get('src', '')
+        if not src:
+            continue
+
+        # Decode URL (part01/image%201.jpg -> part01/image 1.jpg)
+        src_decoded = unquote(src)
+        resolved = posixpath.normpath(posixpath.join(base_dir, src_decoded))
+        filename = os.path.basename(src_decoded)
+
+        # Try to find in map: exact src, path relative to this document, basename
+        for key in (src_decoded, resolved, filename):
+            if key in image_map:
+                img['src'] = image_map[key]
+                break
+
+        if image_attrs:
+            for name, value in image_attrs.get(img['src'], {}).items():
+                img[name] = value
+        img['loading'] = 'lazy'
+        img['decoding'] = 'async'
+
+    # B. Clean HTML
+    soup = clean_html_content(soup)
+
+    # C. Extract Body Content only
+    body = soup.find('body')
+    content_root = body if body else soup
+
+    # D. Point links into the book at placeholders resolved once chapters are numbered
+    mark_internal_links(content_root, href)
+
+    # E. Record headings, text and anchors in one walk
+    return analyze_document(content_root)
+
+
+# Per-process state for parallel spine parsing, set once by the pool initializer
+# so the image map is not re-sent with every document.
+_worker_image_map: Dict[str, str] = {}
+_worker_image_attrs: Dict[str, Dict[str, str]] = {}
+
+
+def _init_spine_worker(image_map: Dict[str, str], image_attrs: Dict[str, Dict[str, str]]):
+    global _worker_image_map, _worker_image_attrs
+    _worker_image_map = image_map
+    _worker_image_attrs = image_attrs
+
+
+def _parse_spine_document_in_worker(href: str, raw: bytes) -> DocumentLayout:
+    return parse_spine_document(raw, _worker_image_map, _worker_image_attrs, href)
+
+
+def _iter_parsed_documents(
+    raw_documents: Iterable[Tuple[str, bytes]],
+    image_map: Dict[str, str],
+    image_attrs: Dict[str, Dict[str, str]],
+    workers: int,
+):
+    """Yield a DocumentLayout for each (href, raw) document, in input order.
+
+    raw_documents is consumed lazily: with a process pool at most
+    2 * workers documents are in flight at once.
+    """
+    if workers <= 1:
+        for href, raw in raw_documents:
+            yield parse_spine_document(raw, image_map, image_attrs, href)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_spine_worker,
+        initargs=(image_map, image_attrs),
+    ) as pool:
+        pending = deque()
+        for href, raw in raw_documents:
+            pending.append(pool.submit(_parse_spine_document_in_worker, href, raw))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+@dataclass
+class SpineDocument:
+    """A parsed spine document as persisted in layout.pkl."""
+    item_id: str
+    href: str
+    layout: DocumentLayout
+
+
+@dataclass
+class BookLayout:
+    """Everything needed to re-split a book without re-reading its source."""
+    kind: str                        # 'epub' or 'markdown'
+    documents: List[SpineDocument]
+
+
+def iter_epub_chapters(
+    documents: Iterable[SpineDocument],
+    split_level: int,
+    anchor_map: AnchorTable,
+    max_chapter_kb: int = 0,
+) -> Iterator[ChapterContent]:
+    """Cut every document at split_level and yield its chapters in spine order,
+    registering their anchors in anchor_map as they are produced.
+
+    A document's anchors are all registered before its first chapter is
+    yielded, so once a file is in anchor_map every id inside it is too.
+    """
+    order_counter = 0
+    for doc in documents:
+        segments = segment_document(doc.layout, split_level, max_chapter_kb * 1024)
+        for seg_idx, segment in enumerate(segments):
+            register_anchor_ids([a for a, _ in segment.anchors], doc.href, order_counter + seg_idx, anchor_map)
+        register_file_keys(doc.href, order_counter, anchor_map)
+
+        for seg_idx, segment in enumerate(segments):
+            if len(segments) == 1:
+                chapter_id = doc.item_id
+                title = f"Section {order_counter+1}"
+            else:
+                chapter_id = f"{doc.item_id}_{seg_idx}"
+                title = segment.title or f"Section {order_counter+1}"
+            yield ChapterContent(
+                id=chapter_id,
+                href=doc.href,
+                title=title,
+                content=segment.content,
+                text=segment.text,
+                order=order_counter,
+                anchors=segment.anchors,
+                breaks=segment.breaks,
+            )
+            order_counter += 1
+
+
+def assemble_epub_spine(
+    documents: Iterable[SpineDocument],
+    split_level: int,
+    max_chapter_kb: int = 0,
+) -> Tuple[List[ChapterContent], AnchorTable]:
+    """Cut every document at split_level and number the chapters in spine order."""
+    anchor_map = AnchorTable()
+    spine_chapters = list(iter_epub_chapters(documents, split_level, anchor_map, max_chapter_kb))
+    return spine_chapters, anchor_map
+
+
 # --- Main Conversion Logic ---
 
-def process_epub(epub_path: str, output_dir: str, split_level: Optional[int] = None) -> Book:
+# Optional progress hook: progress(stage, done, total, item_name).
+ProgressCallback = Callable[[str, int, int, Optional[str]], None]
 
-    # 1. Load Book
-    print(f"Loading {epub_path}...")
-    book = epub.read_epub(epub_path)
 
-    # 2. Extract Metadata
-    metadata = extract_metadata_robust(book)
+def resolve_split_level(split_level: Optional[int] = None) -> int:
+    """Determine heading split level (1-6) for logical chapter splitting.
 
-    # Determine heading split level (1-6) for logical chapter splitting.
-    # Priority:
-    #   1) explicit split_level argument from caller (API)
-    #   2) READER3_SPLIT_HEADING_LEVEL env var (CLI / legacy)
-    #   3) fallback default = 2
+    Priority:
+      1) explicit split_level argument from caller (API)
+      2) READER3_SPLIT_HEADING_LEVEL env var (CLI / legacy)
+      3) fallback default = 2
+    """
     if split_level is None:
         try:
             split_level = int(os.getenv("READER3_SPLIT_HEADING_LEVEL", "2"))
@@ -299,185 +1044,453 @@ def process_epub(epub_path: str, output_dir: str, split_level: Optional[int] = N
     else:
         try:
             split_level = int(split_level)
-        except ValueError:
+        except (TypeError, ValueError):
             split_level = 2
 
     if split_level < 1:
         split_level = 1
     elif split_level > 6:
         split_level = 6
+    return split_level
 
-    # 3. Prepare Output Directories
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
+
+DEFAULT_MAX_CHAPTER_KB = 256
+MIN_MAX_CHAPTER_KB = 16
+
+
+def resolve_max_chapter_kb(max_chapter_kb: Optional[int] = None) -> int:
+    """Largest chapter, in KB (1024 characters) of HTML, before it is cut
+    further at block boundaries; 0 turns size cuts off.
+
+    Priority: explicit argument, then READER3_MAX_CHAPTER_KB, then 256.
+    """
+    if max_chapter_kb is None:
+        try:
+            max_chapter_kb = int(os.getenv("READER3_MAX_CHAPTER_KB", str(DEFAULT_MAX_CHAPTER_KB)))
+        except ValueError:
+            max_chapter_kb = DEFAULT_MAX_CHAPTER_KB
+    try:
+        max_chapter_kb = int(max_chapter_kb)
+    except (TypeError, ValueError):
+        max_chapter_kb = DEFAULT_MAX_CHAPTER_KB
+    if max_chapter_kb <= 0:
+        return 0
+    return max(MIN_MAX_CHAPTER_KB, max_chapter_kb)
+
+
+IMAGE_MODES = ("extract", "archive")
+
+
+def resolve_image_mode(image_mode: Optional[str] = None) -> str:
+    """'extract' (copy images into images/) or 'archive' (serve them from the EPUB).
+
+    Priority: explicit argument, then READER3_IMAGE_MODE, then 'extract'.
+    """
+    if image_mode is None:
+        image_mode = os.getenv("READER3_IMAGE_MODE", "extract")
+    image_mode = str(image_mode).strip().lower()
+    return image_mode if image_mode in IMAGE_MODES else "extract"
+
+
+_CONTAINER_NS = {"c": "urn:oasis:names:tc:opendocument:xmlns:container"}
+
+
+def _open_image_archive(epub_path: str) -> Optional[Tuple[zipfile.ZipFile, str]]:
+    """(zip, OPF directory) of a zipped EPUB, or None if it cannot be served from."""
+    try:
+        zf = zipfile.ZipFile(epub_path)
+        container = ET.fromstring(zf.read("META-INF/container.xml"))
+    except (OSError, KeyError, ET.ParseError, zipfile.BadZipFile):
+        return None
+    rootfile = container.find(".//c:rootfile", _CONTAINER_NS)
+    if rootfile is None or not rootfile.get("full-path"):
+        zf.close()
+        return None
+    return zf, posixpath.dirname(rootfile.get("full-path"))
+
+
+class _DeferredContent(bytes):
+    """Empty stand-in for an item body that is still in the archive at `member`."""
+    member: str
+
+
+class _ManifestReader(epub.EpubReader):
+    """EpubReader that loads metadata, manifest, spine and TOC but leaves item
+    bodies in the archive (ebooklib itself reads every item up front)."""
+
+    _deferring = False
+
+    def _load_manifest(self):
+        self._deferring = True
+        try:
+            super()._load_manifest()
+        finally:
+            self._deferring = False
+        # ebooklib parses the nav document itself once the manifest is loaded.
+        for item in self.book.get_items():
+            if isinstance(item, (epub.EpubNav, epub.EpubNcx)) and isinstance(item.content, _DeferredContent):
+                item.content = self.read_file(item.content.member)
+
+    def read_file(self, name):
+        if self._deferring:
+            content = _DeferredContent()
+            content.member = posixpath.normpath(name)
+            return content
+        return super().read_file(name)
+
+
+class EpubSource:
+    """An EPUB opened for streaming: the ebooklib book without item bodies,
+    plus read() to fetch one item's bytes when it is needed."""
+
+    def __init__(self, epub_path: str):
+        self.path = epub_path
+        self.book = _ManifestReader(epub_path).load()
+        self._zip = None if os.path.isdir(epub_path) else zipfile.ZipFile(epub_path)
+
+    def read(self, item) -> bytes:
+        """item.get_content() as ebooklib would return it, read from the archive."""
+        deferred = item.content
+        member = getattr(deferred, "member", None)
+        if member is None:
+            return item.get_content()
+        if self._zip is None:
+            with open(os.path.join(self.path, member), "rb") as f:
+                item.content = f.read()
+        else:
+            item.content = self._zip.read(member)
+        try:
+            # EpubHtml re-serializes its body here; keep that behaviour.
+            return item.get_content()
+        finally:
+            item.content = deferred
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def process_epub(
+    epub_path: str,
+    output_dir: str,
+    split_level: Optional[int] = None,
+    progress: Optional[ProgressCallback] = None,
+    workers: Optional[int] = None,
+    source_hash: Optional[str] = None,
+    image_mode: Optional[str] = None,
+    max_chapter_kb: Optional[int] = None,
+) -> Book:
+    """Convert an EPUB and save it to output_dir; returns the saved manifest.
+
+    Chapters are streamed: each spine document is read from the archive,
+    parsed, cut into chapters and written to chapters.bin, layout.pkl and the
+    search index before the next one is read, so only the TOC, anchor map and
+    chapter stubs stay in memory. The returned Book's spine holds the stubs.
+    """
+
+    # 1. Load Book (metadata, manifest, spine and TOC; item bodies stay in the archive)
+    print(f"Loading {epub_path}...")
+    stat = source_stat(epub_path)
+    if source_hash is None:
+        with span("epub.hash", bytes=stat[0]):
+            source_hash = hash_source_file(epub_path)
+    with span("epub.load", bytes=stat[0]) as sp:
+        source = EpubSource(epub_path)
+        book = source.book
+        sp.set(items=len(book.items))
+
+    # Written to a staging directory and published as a new generation once
+    # complete; a failed import leaves the current book untouched.
+    with source, BookStaging(output_dir) as staging:
+        return _process_epub_source(
+            source, staging.path, staging.generation, split_level, progress, workers, source_hash, stat,
+            image_mode, max_chapter_kb,
+        )
+
+
+def _process_epub_source(
+    source: EpubSource,
+    output_dir: str,
+    generation: int,
+    split_level: Optional[int],
+    progress: Optional[ProgressCallback],
+    workers: Optional[int],
+    source_hash: str,
+    stat: List[int],
+    image_mode: Optional[str],
+    max_chapter_kb: Optional[int],
+) -> Book:
+    book = source.book
+    epub_path = source.path
+
+    # 2. Extract Metadata
+    metadata = extract_metadata_robust(book)
+
+    split_level = resolve_split_level(split_level)
+    max_chapter_kb = resolve_max_chapter_kb(max_chapter_kb)
+
+    image_archive = None
+    if resolve_image_mode(image_mode) == "archive":
+        image_archive = _open_image_archive(epub_path)
+        if image_archive is None:
+            print("Warning: not a zipped EPUB, extracting images instead")
+
+    # 3. Prepare Output Directories (output_dir is an empty staging directory)
     images_dir = os.path.join(output_dir, 'images')
-    os.makedirs(images_dir, exist_ok=True)
+    if not image_archive:
+        os.makedirs(images_dir, exist_ok=True)
 
     # 4. Extract Images & Build Map
-    print("Extracting images...")
     image_map = {} # Key: internal_path, Value: local_relative_path
+    image_attrs = {} # Key: local_relative_path, Value: extra <img> attributes
+    image_members = {} # Key: image file name, Value: zip member (archive mode)
+
+    with span("epub.images", mode="archive" if image_archive else "extract") as sp:
+        if image_archive:
+            # Zero-copy: only names are assigned (from the zip directory's CRC and
+            # size); the server streams each member out of the EPUB on request.
+            print("Mapping images to the source archive...")
+            zf, opf_dir = image_archive
+            with zf:
+                for item in book.get_items():
+                    if item.get_type() != ebooklib.ITEM_IMAGE:
+                        continue
+                    member = posixpath.normpath(posixpath.join(opf_dir, item.get_name()))
+                    try:
+                        info = zf.getinfo(member)
+                    except KeyError:
+                        continue
+                    fname = archive_image_name(info)
+                    image_members.setdefault(fname, member)
+                    image_map[item.get_name()] = f"images/{fname}"
+                    image_map.setdefault(os.path.basename(item.get_name()), f"images/{fname}")
+        else:
+            print("Extracting images...")
+            store = ImageStore(images_dir)
 
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_IMAGE:
-            # Normalize filename
-            original_fname = os.path.basename(item.get_name())
-            # Sanitize filename for OS
-            safe_fname = "".join([c for c in original_fname if c.isalpha() or c.isdigit() or c in '._-']).strip()
-
-            # Save to disk
-            local_path = os.path.join(images_dir, safe_fname)
-            with open(local_path, 'wb') as f:
-                f.write(item.get_content())
-
-            # Map keys: We try both the full internal path and just the basename
-            # to be robust against messy HTML src attributes
-            rel_path = f"images/{safe_fname}"
-            image_map[item.get_name()] = rel_path
-            image_map[original_fname] = rel_path
+            for item in book.get_items():
+                if item.get_type() != ebooklib.ITEM_IMAGE:
+                    continue
+                # Stored under a content-hash name: duplicates are written once and
+                # same-named images from different folders no longer collide.
+                stored = store.add(item.get_name(), source.read(item))
+
+                # Map keys: We try both the full internal path and just the basename
+                # to be robust against messy HTML src attributes (first one wins)
+                image_map[item.get_name()] = stored.src
+                image_map.setdefault(os.path.basename(item.get_name()), stored.src)
+                image_attrs[stored.src] = stored.attrs
+            print(store.summary())
+            sp.set(duplicates=store.duplicates, transcoded=store.transcoded,
+                   bytes_in=store.bytes_in, bytes_out=store.bytes_out)
+        sp.set(images=len(set(image_map.values())))
 
     # 5. Process TOC
     print("Parsing Table of Contents...")
-    toc_structure = parse_toc_recursive(book.toc)
-    if not toc_structure:
-        print("Warning: Empty TOC, building fallback from Spine...")
-        toc_structure = get_fallback_toc(book)
+    with span("epub.toc"):
+        toc_structure = parse_toc_recursive(book.toc)
+        if not toc_structure:
+            print("Warning: Empty TOC, building fallback from Spine...")
+            toc_structure = get_fallback_toc(book)
 
     # 6. Process Content (Spine-based to preserve HTML validity)
     print("Processing chapters...")
-    spine_chapters = []
-    anchor_map: Dict[str, int] = {}
 
-    # We iterate over the spine (linear reading order)
-    order_counter = 0
-    for i, spine_item in enumerate(book.spine):
+    # Spine documents in linear reading order. Each one is read, parsed
+    # (optionally in a process pool) into a split-level independent layout,
+    # appended to layout.pkl, cut into chapters and written out before it is
+    # dropped. Order numbers and anchor_map are assigned while assembling, so
+    # the result does not depend on the number of workers.
+    spine_items = []
+    for spine_item in book.spine:
         item_id, linear = spine_item
         item = book.get_item_with_id(item_id)
+        if item and item.get_type() == ebooklib.ITEM_DOCUMENT:
+            spine_items.append(item)
+
+    spine_total = len(spine_items)
+    workers = resolve_workers(workers) if spine_total > 1 else 1
+    raw_bytes = [0]
+
+    def raw_documents():
+        for item in spine_items:
+            raw = source.read(item)
+            raw_bytes[0] += len(raw)
+            yield item.get_name(), raw
+
+    def documents(layout_writer: LayoutWriter):
+        layouts = _iter_parsed_documents(raw_documents(), image_map, image_attrs, workers)
+        for i, (item, layout) in enumerate(zip(spine_items, layouts)):
+            if progress:
+                progress("chapters", i, spine_total, item.get_name())
+            doc = SpineDocument(item_id=item.get_id(), href=item.get_name(), layout=layout)
+            # Kept so resplit_saved_book() can re-cut the book without parsing.
+            layout_writer.add(doc)
+            yield doc
+
+    anchor_map = AnchorTable()
+    with span("epub.parse", documents=spine_total, workers=workers, split_level=split_level) as sp:
+        with LayoutWriter(output_dir, "epub") as layout_writer:
+            stubs = write_chapter_store(
+                iter_epub_chapters(documents(layout_writer), split_level, anchor_map, max_chapter_kb),
+                output_dir, metadata.title, anchor_map,
+            )
+        sp.set(bytes=raw_bytes[0], chapters=len(stubs))
+        if collecting():
+            sp.set(anchors=len(anchor_map))
 
-        if not item:
-            continue
-
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            # Raw content
-            raw_content = item.get_content().decode('utf-8', errors='ignore')
-            soup = BeautifulSoup(raw_content, 'html.parser')
-
-            # A. Fix Images
-            for img in soup.find_all('img'):
-                src = img.get('src', '')
-                if not src:
-                    continue
-
-                # Decode URL (part01/image%201.jpg -> part01/image 1.jpg)
-                src_decoded = unquote(src)
-                filename = os.path.basename(src_decoded)
-
-                # Try to find in map
-                if src_decoded in image_map:
-                    img['src'] = image_map[src_decoded]
-                elif filename in image_map:
-                    img['src'] = image_map[filename]
-
-            # B. Clean HTML
-            soup = clean_html_content(soup)
-
-            # C. Extract Body Content only
-            body = soup.find('body')
-            content_root = body if body else soup
-
-            full_html = "".join(str(x) for x in content_root.contents)
-
-            segments = []
-            if split_level >= 1:
-                pattern = re.compile(
-                    r"(<h([1-{}])[^>]*>.*?</h\\2>)".format(split_level),
-                    flags=re.IGNORECASE | re.DOTALL,
-                )
-                matches = list(pattern.finditer(full_html))
-                if not matches:
-                    segments.append((None, full_html))
-                else:
-                    first_start = matches[0].start()
-                    if first_start > 0:
-                        pre_html = full_html[:first_start]
-                        if pre_html.strip():
-                            segments.append((None, pre_html))
-                    for idx_m, m in enumerate(matches):
-                        start = m.start()
-                        end = matches[idx_m + 1].start() if idx_m + 1 < len(matches) else len(full_html)
-                        seg_html = full_html[start:end]
-                        heading_html = m.group(1)
-                        heading_soup = BeautifulSoup(heading_html, 'html.parser')
-                        heading_text = heading_soup.get_text(separator=" ", strip=True) or None
-                        segments.append(heading_text and (heading_text, seg_html) or (None, seg_html))
-            else:
-                segments.append((None, full_html))
-
-            print(f"[reader3] split_level={split_level}, file={item.get_name()}, segments={len(segments) if segments else 0}")
-
-            if not segments or len(segments) == 1:
-                final_html = segments[0][1] if segments else full_html
-                section_soup = BeautifulSoup(final_html, 'html.parser')
-                chapter = ChapterContent(
-                    id=item_id,
-                    href=item.get_name(),
-                    title=f"Section {order_counter+1}",
-                    content=final_html,
-                    text=extract_plain_text(section_soup),
-                    order=order_counter
-                )
-                spine_chapters.append(chapter)
-                register_anchors_from_soup(section_soup, item.get_name(), order_counter, anchor_map)
-                fname = item.get_name()
-                base = os.path.basename(fname)
-                if fname not in anchor_map:
-                    anchor_map[fname] = order_counter
-                if base not in anchor_map:
-                    anchor_map[base] = order_counter
-                order_counter += 1
-            else:
-                for seg_idx, (seg_title, seg_html) in enumerate(segments):
-                    final_html = seg_html
-                    section_soup = BeautifulSoup(final_html, 'html.parser')
-                    chapter = ChapterContent(
-                        id=f"{item_id}_{seg_idx}",
-                        href=item.get_name(),
-                        title=seg_title or f"Section {order_counter+1}",
-                        content=final_html,
-                        text=extract_plain_text(section_soup),
-                        order=order_counter
-                    )
-                    spine_chapters.append(chapter)
-                    register_anchors_from_soup(section_soup, item.get_name(), order_counter, anchor_map)
-                    if seg_idx == 0:
-                        fname = item.get_name()
-                        base = os.path.basename(fname)
-                        if fname not in anchor_map:
-                            anchor_map[fname] = order_counter
-                        if base not in anchor_map:
-                            anchor_map[base] = order_counter
-                    order_counter += 1
+    if progress:
+        progress("chapters", spine_total, spine_total, None)
 
     # 7. Attach TOC → chapter index mapping now that anchor_map is complete.
     #    这里使用 split_level 作为“最大 TOC 深度”，决定哪些目录层级拥有独立页面。
-    attach_chapter_indices_to_toc(toc_structure, anchor_map, max_depth=split_level)
+    with span("epub.toc_attach"):
+        attach_chapter_indices_to_toc(toc_structure, anchor_map, max_depth=split_level)
 
     # 8. Final Assembly
     final_book = Book(
         metadata=metadata,
-        spine=spine_chapters,
+        spine=stubs,
         toc=toc_structure,
         images=image_map,
         source_file=os.path.basename(epub_path),
         processed_at=datetime.now().isoformat(),
         anchor_map=anchor_map,
         split_level=split_level,
+        max_chapter_kb=max_chapter_kb,
+        source_hash=source_hash,
+        source_stat=stat,
+        image_archive=os.path.abspath(epub_path) if image_archive else None,
+        image_members=image_members,
+        generation=generation,
     )
 
+    if progress:
+        progress("saving", 0, 0, None)
+    write_manifest(final_book, output_dir)
     return final_book
 
 
-def process_markdown(md_path: str, output_dir: str, split_level: Optional[int] = None) -> Book:
+MARKDOWN_FILE_NAME = "index.html"
+
+
+def assemble_markdown(
+    layout: DocumentLayout,
+    split_level: int,
+    title: str,
+    progress: Optional[ProgressCallback] = None,
+    max_chapter_kb: int = 0,
+) -> Tuple[List[ChapterContent], List[TOCEntry], AnchorTable]:
+    """Cut a markdown document at split_level and build its chapters and TOC.
+
+    The later pieces of a chapter cut by size get no TOC entry of their own.
+    """
+    file_name = MARKDOWN_FILE_NAME
+    segments = segment_document(layout, split_level, max_chapter_kb * 1024)
+
+    if len(segments) == 1 and segments[0].title is None:
+        segment = segments[0]
+        spine_chapters = [
+            ChapterContent(
+                id="markdown_0",
+                href=file_name,
+                title=title,
+                content=segment.content,
+                text=segment.text,
+                order=0,
+                anchors=segment.anchors,
+                breaks=segment.breaks,
+            )
+        ]
+        anchor_map = AnchorTable()
+        register_anchor_ids([a for a, _ in segment.anchors], file_name, 0, anchor_map)
+        register_file_keys(file_name, 0, anchor_map)
+        toc_entries = [
+            TOCEntry(
+                title=title,
+                href=file_name,
+                file_href=file_name,
+                anchor="",
+                depth=0,
+            )
+        ]
+        if progress:
+            progress("chapters", 1, 1, None)
+        return spine_chapters, toc_entries, anchor_map
+
+    spine_chapters = []
+    anchor_map = AnchorTable()
+    for idx, segment in enumerate(segments):
+        if progress:
+            progress("chapters", idx, len(segments), segment.title)
+        chapter = ChapterContent(
+            id=f"markdown_{idx}",
+            href=file_name,
+            title=segment.title or f"Section {idx + 1}",
+            content=segment.content,
+            text=segment.text,
+            order=idx,
+            anchors=segment.anchors,
+            breaks=segment.breaks,
+        )
+        spine_chapters.append(chapter)
+        register_anchor_ids([a for a, _ in segment.anchors], file_name, idx, anchor_map)
+        register_file_keys(file_name, idx, anchor_map)
+
+    toc_entries: List[TOCEntry] = []
+    stack: List[Any] = []
+    for idx, segment in enumerate(segments):
+        if segment.part:
+            continue
+        seg_title = segment.title or f"Section {idx + 1}"
+        anchor = segment.anchor
+        level = max(1, min(split_level, segment.level or 1))
+        href = file_name
+        if anchor:
+            href = f"{file_name}#{anchor}"
+        entry = TOCEntry(
+            title=seg_title,
+            href=href,
+            file_href=file_name,
+            anchor=anchor or "",
+            depth=0,
+        )
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        if not stack:
+            entry.depth = 0
+            toc_entries.append(entry)
+        else:
+            parent_level, parent_entry = stack[-1]
+            entry.depth = parent_entry.depth + 1
+            parent_entry.children.append(entry)
+        stack.append((level, entry))
+
+    if progress:
+        progress("chapters", len(spine_chapters), len(spine_chapters), None)
+    return spine_chapters, toc_entries, anchor_map
+
+
+def process_markdown(
+    md_path: str,
+    output_dir: str,
+    split_level: Optional[int] = None,
+    progress: Optional[ProgressCallback] = None,
+    source_hash: Optional[str] = None,
+    max_chapter_kb: Optional[int] = None,
+) -> Book:
+    """Convert a Markdown file and save it to output_dir; returns the saved manifest."""
     print(f"Loading markdown {md_path}...")
+    stat = source_stat(md_path)
+    if source_hash is None:
+        with span("markdown.hash", bytes=stat[0]):
+            source_hash = hash_source_file(md_path)
     with open(md_path, "r", encoding="utf-8") as f:
         md_text = f.read()
 
@@ -514,177 +1527,55 @@ def process_markdown(md_path: str, output_dir: str, split_level: Optional[int] =
         subjects=[],
     )
 
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir, exist_ok=True)
-
-    html = md_lib.markdown(
-        md_text,
-        extensions=[
-            "fenced_code",
-            "tables",
-            "toc",
-            "attr_list",
-        ],
-    )
-
-    soup = BeautifulSoup(html, "html.parser")
-    soup = clean_html_content(soup)
-
-    body = soup.body if soup.body is not None else soup
-
-    segments_html: List[str] = []
-    segment_titles: List[Optional[str]] = []
-    segment_anchors: List[Optional[str]] = []
-    segment_levels: List[Optional[int]] = []
-
-    current_nodes: List[Any] = []
-    current_title: Optional[str] = None
-    current_anchor: Optional[str] = None
-    current_level: Optional[int] = None
-    used_ids: Dict[str, bool] = {}
-    heading_levels = {f"h{i}": i for i in range(1, 7)}
-
-    def flush_segment() -> None:
-        nonlocal current_nodes, current_title, current_anchor, current_level
-        if not current_nodes:
-            current_nodes = []
-            return
-        html_seg = "".join(str(n) for n in current_nodes)
-        segments_html.append(html_seg)
-        segment_titles.append(current_title)
-        segment_anchors.append(current_anchor)
-        segment_levels.append(current_level)
-        current_nodes = []
-        current_title = None
-        current_anchor = None
-        current_level = None
-
-    for node in body.children:
-        if isinstance(node, str):
-            if not node.strip() and not current_nodes:
+    with span("markdown.render", bytes=stat[0]):
+        html = md_lib.markdown(
+            md_text,
+            extensions=[
+                "fenced_code",
+                "tables",
+                "toc",
+                "attr_list",
+            ],
+        )
+
+    with span("markdown.parse", bytes=len(html)):
+        soup = BeautifulSoup(html, "html.parser")
+        soup = clean_html_content(soup)
+
+        body = soup.body if soup.body is not None else soup
+
+        # The toc extension gives headings ids already; cover any it missed so
+        # every chapter has a TOC anchor whatever level the book is split at.
+        used_ids = {tag["id"] for tag in body.find_all(id=True)}
+        for node in body.find_all(list(HEADING_LEVELS)):
+            heading_text = node.get_text(separator=" ", strip=True)
+            if node.get("id") or not heading_text:
                 continue
-            current_nodes.append(node)
-            continue
-        if isinstance(node, Comment):
-            continue
-        if isinstance(node, Tag) and node.name in heading_levels:
-            level = heading_levels[node.name]
-            if level <= split_level:
-                flush_segment()
-                heading_text = node.get_text(separator=" ", strip=True) or None
-                if heading_text is None:
-                    continue
-                anchor = node.get("id")
-                if not anchor:
-                    base = re.sub(r"[^a-zA-Z0-9]+", "-", heading_text).strip("-").lower() or "section"
-                    anchor = base
-                    counter = 2
-                    while anchor in used_ids:
-                        anchor = f"{base}-{counter}"
-                        counter += 1
-                    node["id"] = anchor
-                used_ids[anchor] = True
-                current_title = heading_text
-                current_anchor = anchor
-                current_level = level
-                current_nodes.append(node)
-                continue
-            # heading deeper than split level -> do not start new segment, keep inline
-            current_nodes.append(node)
-            continue
-        else:
-            current_nodes.append(node)
-
-    flush_segment()
-
-    file_name = "index.html"
-
-    if not segments_html:
-        full_html = str(body)
-        chapter_id = "markdown_0"
-        section_soup = BeautifulSoup(full_html, "html.parser")
-        text = extract_plain_text(section_soup)
-        spine_chapters: List[ChapterContent] = [
-            ChapterContent(
-                id=chapter_id,
-                href=file_name,
-                title=title,
-                content=full_html,
-                text=text,
-                order=0,
-            )
-        ]
-        anchor_map: Dict[str, int] = {}
-        register_anchors_from_soup(section_soup, file_name, 0, anchor_map)
-        base = os.path.basename(file_name)
-        if file_name not in anchor_map:
-            anchor_map[file_name] = 0
-        if base not in anchor_map:
-            anchor_map[base] = 0
-        toc_entries: List[TOCEntry] = [
-            TOCEntry(
-                title=title,
-                href=file_name,
-                file_href=file_name,
-                anchor="",
-                depth=0,
-            )
-        ]
-    else:
-        spine_chapters = []
-        anchor_map = {}
-        for idx, html_seg in enumerate(segments_html):
-            seg_html = html_seg
-            section_soup = BeautifulSoup(seg_html, "html.parser")
-            seg_title = segment_titles[idx] or f"Section {idx + 1}"
-            text = extract_plain_text(section_soup)
-            chapter = ChapterContent(
-                id=f"markdown_{idx}",
-                href=file_name,
-                title=seg_title,
-                content=seg_html,
-                text=text,
-                order=idx,
-            )
-            spine_chapters.append(chapter)
-            register_anchors_from_soup(section_soup, file_name, idx, anchor_map)
-            fname = file_name
-            base = os.path.basename(fname)
-            if fname not in anchor_map:
-                anchor_map[fname] = idx
-            if base not in anchor_map:
-                anchor_map[base] = idx
-
-        toc_entries: List[TOCEntry] = []
-        stack: List[Any] = []
-        for idx in range(len(segments_html)):
-            seg_title = segment_titles[idx] or f"Section {idx + 1}"
-            anchor = segment_anchors[idx]
-            seg_level = segment_levels[idx] or 1
-            level = max(1, min(split_level, seg_level))
-            href = file_name
-            if anchor:
-                href = f"{file_name}#{anchor}"
-            entry = TOCEntry(
-                title=seg_title,
-                href=href,
-                file_href=file_name,
-                anchor=anchor or "",
-                depth=0,
-            )
-            while stack and stack[-1][0] >= level:
-                stack.pop()
-            if not stack:
-                entry.depth = 0
-                toc_entries.append(entry)
-            else:
-                parent_level, parent_entry = stack[-1]
-                entry.depth = parent_entry.depth + 1
-                parent_entry.children.append(entry)
-            stack.append((level, entry))
-
-    attach_chapter_indices_to_toc(toc_entries, anchor_map, max_depth=split_level)
+            base = re.sub(r"[^a-zA-Z0-9]+", "-", heading_text).strip("-").lower() or "section"
+            anchor = base
+            counter = 2
+            while anchor in used_ids:
+                anchor = f"{base}-{counter}"
+                counter += 1
+            node["id"] = anchor
+            used_ids.add(anchor)
+
+        for img in body.find_all("img"):
+            img["loading"] = "lazy"
+            img["decoding"] = "async"
+
+        mark_internal_links(body, MARKDOWN_FILE_NAME)
+        layout = analyze_document(body)
+
+    max_chapter_kb = resolve_max_chapter_kb(max_chapter_kb)
+    with span("markdown.assemble", split_level=split_level) as sp:
+        spine_chapters, toc_entries, anchor_map = assemble_markdown(
+            layout, split_level, title, progress, max_chapter_kb,
+        )
+        attach_chapter_indices_to_toc(toc_entries, anchor_map, max_depth=split_level)
+        sp.set(chapters=len(spine_chapters))
+        if collecting():
+            sp.set(anchors=len(anchor_map))
 
     final_book = Book(
         metadata=metadata,
@@ -695,36 +1586,776 @@ def process_markdown(md_path: str, output_dir: str, split_level: Optional[int] =
         processed_at=datetime.now().isoformat(),
         anchor_map=anchor_map,
         split_level=split_level,
+        max_chapter_kb=max_chapter_kb,
+        source_hash=source_hash,
+        source_stat=stat,
     )
 
-    return final_book
+    if progress:
+        progress("saving", 0, 0, None)
+    with BookStaging(output_dir) as staging:
+        # Kept so resplit_saved_book() can re-cut the book without parsing.
+        with span("markdown.layout_save"):
+            save_layout(BookLayout(kind="markdown", documents=[
+                SpineDocument(item_id="markdown", href=MARKDOWN_FILE_NAME, layout=layout),
+            ]), staging.path)
+        return write_book_files(replace(final_book, generation=staging.generation), staging.path)
 
 
 def save_to_pickle(book: Book, output_dir: str):
-    p_path = os.path.join(output_dir, 'book.pkl')
+    """Legacy monolithic layout: the whole Book (all chapter bodies) in book.pkl."""
+    p_path = os.path.join(output_dir, LEGACY_PICKLE_FILE)
     with open(p_path, 'wb') as f:
         pickle.dump(book, f)
     print(f"Saved structured data to {p_path}")
 
 
-# --- CLI ---
+# --- Split Storage ---
+#
+# <book>_data/
+#     manifest.pkl   Book with metadata, TOC, anchor_map and chapter stubs
+#     chapters.bin   concatenated UTF-8 chapter bodies (content then text)
+#     summary.json   few-hundred-byte summary used by the library page
+#     search.pkl     inverted index over chapter text (see search.py)
+#     context.pkl    paragraph token counts for LLM context windows (see context.py)
+#     images/
+#
+# The manifest is small, so the server can open a book and serve chapter N by
+# seeking into chapters.bin instead of unpickling every chapter.
+#
+# <book>_data is a symlink to the book's current generation directory, which
+# holds the files above; each import or resplit publishes a new one (see
+# publish.py).
+
+MANIFEST_FILE = "manifest.pkl"
+CHAPTERS_FILE = "chapters.bin"
+LEGACY_PICKLE_FILE = "book.pkl"
+SUMMARY_FILE = "summary.json"
+LAYOUT_FILE = "layout.pkl"
+TOC_HTML_FILE = "toc.html"
+
+
+class ChapterStoreWriter:
+    """Appends chapter bodies to chapters.bin and returns body-less stubs.
+
+    With an anchor_map, link placeholders (see mark_internal_links) are
+    resolved as chapters are added. A link to a document not registered yet
+    keeps its placeholder, which is at least as long as any resolved href;
+    patch_links() overwrites those in place once anchor_map is complete,
+    padding with spaces inside the tag, so no offset in the store moves.
+    """
+
+    def __init__(self, output_dir: str, anchor_map: Optional[AnchorTable] = None):
+        self.path = os.path.join(output_dir, CHAPTERS_FILE)
+        self._f = open(self.path, 'wb')
+        self._offset = 0
+        self._count = 0
+        self.anchor_map = anchor_map
+        # (offset in chapters.bin, chapter index, placeholder attribute)
+        self._pending_links: List[Tuple[int, int, bytes]] = []
+
+    def _resolve_links(self, content: bytes, index: int) -> bytes:
+        parts = []
+        pos = 0
+        length = 0
+        for m in _LINK_RE.finditer(content):
+            resolved = resolve_link(m.group(1), self.anchor_map, index)
+            parts.append(content[pos:m.start()])
+            length += m.start() - pos
+            if resolved is None:
+                self._pending_links.append((self._offset + length, index, m.group(0)))
+                resolved = m.group(0)
+            parts.append(resolved)
+            length += len(resolved)
+            pos = m.end()
+        parts.append(content[pos:])
+        return b"".join(parts)
+
+    def patch_links(self) -> int:
+        """Resolve the links left pending; returns how many were patched."""
+        for offset, index, placeholder in self._pending_links:
+            resolved = resolve_link(_LINK_RE.match(placeholder).group(1), self.anchor_map, index, final=True)
+            self._f.seek(offset)
+            self._f.write(resolved.ljust(len(placeholder)))
+        self._f.seek(self._offset)
+        patched = len(self._pending_links)
+        self._pending_links = []
+        return patched
+
+    def add(self, chapter: ChapterContent) -> ChapterContent:
+        content = chapter.content.encode('utf-8')
+        if self.anchor_map is not None and _LINK_PREFIX_BYTES in content:
+            content = self._resolve_links(content, self._count)
+        text = chapter.text.encode('utf-8')
+        self._f.write(content)
+        self._f.write(text)
+        stub = replace(
+            chapter,
+            content="",
+            text="",
+            anchors=None,
+            breaks=None,
+            offset=self._offset,
+            content_size=len(content),
+            text_size=len(text),
+        )
+        self._offset += len(content) + len(text)
+        self._count += 1
+        return stub
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_chapter_store(
+    chapters: Iterable[ChapterContent],
+    output_dir: str,
+    title: str,
+    anchor_map: Optional[AnchorTable] = None,
+) -> List[ChapterContent]:
+    """Write chapters to chapters.bin, the search index and the context index
+    as they arrive.
+
+    chapters may be a generator: each chapter's content and text are dropped
+    once written, and only the body-less stubs are returned. Internal links
+    are resolved against anchor_map, which must be complete once chapters
+    is exhausted.
+    """
+    # search and context import this module for CHAPTERS_FILE.
+    from search import IndexedChapter, build_book_index, write_book_index
+    from context import ContextIndexBuilder, write_context_index
+
+    stubs: List[ChapterContent] = []
+    context = ContextIndexBuilder()
+
+    with ChapterStoreWriter(output_dir, anchor_map) as writer:
+        def indexed():
+            for ch in chapters:
+                ch = _with_inline_text(ch)
+                stub = writer.add(ch)
+                stubs.append(stub)
+                context.add(stub.offset + stub.content_size, stub.text_size, ch.text, ch.breaks, ch.anchors)
+                yield IndexedChapter(
+                    order=stub.order,
+                    title=stub.title,
+                    text_offset=stub.offset + stub.content_size,
+                    text_size=stub.text_size,
+                    length=0,
+                    anchors=[(offset, anchor_id) for anchor_id, offset in (ch.anchors or [])],
+                ), ch.text
+
+        index = build_book_index(title, indexed())
+        with span("save.links") as sp:
+            sp.set(patched=writer.patch_links())
+
+    with span("save.search_index"):
+        write_book_index(index, output_dir)
+    with span("save.context_index"):
+        write_context_index(context.finish(), output_dir)
+    return stubs
+
+
+def write_manifest(book: Book, output_dir: str):
+    """Write manifest.pkl, summary.json and the nav assets for a book whose
+    spine already holds chapters.bin stubs."""
+    with span("save.nav_assets"):
+        write_nav_assets(book, output_dir)
+
+    with span("save.manifest") as sp:
+        m_path = os.path.join(output_dir, MANIFEST_FILE)
+        tmp_path = m_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(book, f)
+        os.replace(tmp_path, m_path)
+        write_summary(book, output_dir)
+        sp.set(bytes=os.path.getsize(m_path))
+
+    # A stale monolithic pickle would only confuse older tooling.
+    legacy_path = os.path.join(output_dir, LEGACY_PICKLE_FILE)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+    print(f"Saved structured data to {m_path}")
+
+
+def write_book_files(book: Book, output_dir: str) -> Book:
+    """Write chapters.bin, the indexes and the manifest of a book with inline
+    chapters into output_dir as it is. Returns the saved manifest."""
+    with span("save.chapters", chapters=len(book.spine)) as sp:
+        stubs = write_chapter_store(book.spine, output_dir, book.metadata.title, book.anchor_map)
+        sp.set(bytes=os.path.getsize(os.path.join(output_dir, CHAPTERS_FILE)))
+
+    manifest = replace(book, spine=stubs)
+    write_manifest(manifest, output_dir)
+    return manifest
+
+
+def save_book(book: Book, output_dir: str) -> Book:
+    """Write the book in the split layout (manifest.pkl + chapters.bin),
+    plus its summary.json and search index. Returns the saved manifest.
+
+    The book is published as a new generation of output_dir, keeping the
+    current generation's images and layout.pkl. A book whose spine already
+    holds chapters.bin stubs (as returned by process_epub / process_markdown)
+    only has the manifest of its own generation rewritten.
+    """
+    if book.spine and all(ch.offset >= 0 for ch in book.spine):
+        files_dir = book_files_dir(output_dir, book)
+        if os.path.exists(os.path.join(files_dir, CHAPTERS_FILE)):
+            write_manifest(book, files_dir)
+            return book
+
+    with BookStaging(output_dir, inherit=("images", LAYOUT_FILE)) as staging:
+        return write_book_files(replace(book, generation=staging.generation), staging.path)
 
-if __name__ == "__main__":
 
-    import sys
-    if len(sys.argv) < 2:
-        print("Usage: python reader3.py <file.epub>")
-        sys.exit(1)
+def _toc_active_index(entry: TOCEntry, anchor_map: AnchorTable) -> Optional[int]:
+    """The spine index for which the reader highlights this TOC entry."""
+    if entry.chapter_index is not None:
+        return entry.chapter_index
+    if not anchor_map:
+        return None
+    idx = anchor_map.get(entry.href)
+    if idx is None:
+        idx = anchor_map.get(entry.file_href)
+    return idx
 
-    epub_file = sys.argv[1]
+
+def render_toc_html(book: Book) -> str:
+    """The reader's sidebar TOC as static HTML.
+
+    Links point straight at their chapter page, relative to /read/<book_id>/
+    ("12#anchor"), and carry data-idx (the chapter they highlight for), so
+    the same HTML serves every chapter of the book and the reader resolves
+    nothing on the client.
+    """
+    parts: List[str] = []
+    spine_files: Dict[str, int] = {}
+    if not book.anchor_map:
+        # Older data without anchor_map: resolve TOC links by file name.
+        for i, ch in enumerate(book.spine):
+            spine_files.setdefault(ch.href, i)
+        for i, ch in enumerate(book.spine):
+            spine_files.setdefault(os.path.basename(ch.href), i)
+
+    def walk(items: List[TOCEntry]):
+        parts.append('<ul class="toc-list">')
+        for item in items:
+            idx = _toc_active_index(item, book.anchor_map)
+            target = idx
+            attrs = ""
+            if idx is not None:
+                attrs += f' data-idx="{idx}"'
+            elif not book.anchor_map:
+                target = spine_files.get(item.file_href, spine_files.get(os.path.basename(item.file_href)))
+                # Highlight by file name.
+                attrs += f' data-file="{html.escape(item.file_href)}"'
+            if target is not None:
+                link = f"{target}#{item.anchor}" if item.anchor else str(target)
+                attrs = f' href="{html.escape(link)}"' + attrs
+            parts.append(f'<li class="toc-item"><a class="toc-link"{attrs}>{html.escape(item.title)}</a>')
+            if item.children:
+                walk(item.children)
+            parts.append('</li>')
+        parts.append('</ul>')
+
+    walk(book.toc)
+    return "".join(parts)
+
+
+def write_nav_assets(book: Book, output_dir: str):
+    """Write toc.html, rendered once per book and split level, with its
+    precompressed variants."""
+    from httpcache import write_variants
+
+    path = os.path.join(output_dir, TOC_HTML_FILE)
+    tmp_path = path + ".tmp"
+    body = render_toc_html(book).encode('utf-8')
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    write_variants(path, body)
+
+
+def book_summary(book: Book) -> Dict[str, Any]:
+    """The handful of fields the library page needs, without chapter data."""
+    return {
+        "title": book.metadata.title,
+        "authors": list(book.metadata.authors),
+        "chapters": len(book.spine),
+        "split_level": getattr(book, "split_level", 1),
+        "max_chapter_kb": getattr(book, "max_chapter_kb", None),
+        "source_file": book.source_file,
+        "processed_at": book.processed_at,
+        "version": book.version,
+        "source_hash": getattr(book, "source_hash", None),
+        "source_stat": getattr(book, "source_stat", None),
+        "image_mode": "archive" if getattr(book, "image_archive", None) else "extract",
+        "generation": getattr(book, "generation", 0),
+    }
+
+
+def write_summary(book: Book, output_dir: str):
+    s_path = os.path.join(output_dir, SUMMARY_FILE)
+    tmp_path = s_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(book_summary(book), f, ensure_ascii=False)
+    os.replace(tmp_path, s_path)
+
+
+def read_summary(output_dir: str) -> Optional[Dict[str, Any]]:
+    s_path = os.path.join(output_dir, SUMMARY_FILE)
+    if not os.path.exists(s_path):
+        return None
+    with open(s_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def book_data_path(output_dir: str) -> Optional[str]:
+    """The pickle load_book() reads: manifest.pkl, else a legacy book.pkl."""
+    for name in (MANIFEST_FILE, LEGACY_PICKLE_FILE):
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_book(output_dir: str) -> Optional[Book]:
+    """Load a book's manifest, falling back to a legacy book.pkl.
+
+    For split-layout books the returned spine holds stubs; use load_chapter()
+    to get a chapter with its content and text.
+    """
+    path = book_data_path(output_dir)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        book = pickle.load(f)
+    # Legacy books hold every chapter inline; keep only the HTML; load_chapter()
+    # derives the text again when it is asked for.
+    for chapter in book.spine:
+        if chapter.offset < 0 and chapter.text:
+            chapter.text = ""
+            chapter.text_size = -1
+    return book
+
+
+def _with_inline_text(chapter: ChapterContent) -> ChapterContent:
+    """An inline chapter with its text, derived from content if it was dropped."""
+    if chapter.text_size == -1:
+        return replace(chapter, text=extract_plain_text(BeautifulSoup(chapter.content, 'html.parser')), text_size=0)
+    return chapter
+
+
+def book_files_dir(output_dir: str, book: Book) -> str:
+    """Directory holding the files of the generation a book was loaded from.
+
+    output_dir may meanwhile link to a newer generation; chapter offsets and
+    the per-book indexes of this manifest are only valid in its own. A book
+    loaded from a plain folder (generation 0) is found in generation 0 once
+    that folder has been moved aside by a publication.
+    """
+    if os.path.islink(output_dir):
+        return generation_dir(output_dir, book.generation)
+    return output_dir
+
+
+def load_chapter(output_dir: str, book: Book, index: int) -> ChapterContent:
+    """Return spine[index] with content and text, reading only its bytes."""
+    chapter = book.spine[index]
+    if chapter.offset < 0:
+        return _with_inline_text(chapter)
+
+    with open(os.path.join(book_files_dir(output_dir, book), CHAPTERS_FILE), 'rb') as f:
+        f.seek(chapter.offset)
+        data = f.read(chapter.content_size + chapter.text_size)
+
+    return replace(
+        chapter,
+        content=data[:chapter.content_size].decode('utf-8'),
+        text=data[chapter.content_size:].decode('utf-8'),
+    )
+
+
+# layout.pkl is a header followed by one pickle per SpineDocument, so it can
+# be written while documents stream through ingestion. Books saved before
+# held a single pickled BookLayout.
+LAYOUT_FORMAT = 2
+
+
+class LayoutWriter:
+    """Appends SpineDocuments to layout.pkl; the file is replaced on close."""
+
+    def __init__(self, output_dir: str, kind: str):
+        self.path = os.path.join(output_dir, LAYOUT_FILE)
+        self._tmp_path = self.path + ".tmp"
+        self._f = open(self._tmp_path, 'wb')
+        pickle.dump({"format": LAYOUT_FORMAT, "kind": kind}, self._f)
+
+    def add(self, document: SpineDocument):
+        pickle.dump(document, self._f)
+
+    def close(self):
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+            os.remove(self._tmp_path)
+
+
+def save_layout(layout: BookLayout, output_dir: str):
+    with LayoutWriter(output_dir, layout.kind) as writer:
+        for document in layout.documents:
+            writer.add(document)
+
+
+def load_layout(output_dir: str) -> Optional[BookLayout]:
+    path = os.path.join(output_dir, LAYOUT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        if isinstance(header, BookLayout):
+            return header
+        documents = []
+        while True:
+            try:
+                documents.append(pickle.load(f))
+            except EOFError:
+                break
+    return BookLayout(kind=header["kind"], documents=documents)
+
+
+def resplit_saved_book(output_dir: str, split_level: int, max_chapter_kb: Optional[int] = None) -> Optional[Book]:
+    """Re-cut a saved book at another heading level (and chapter size limit)
+    from its layout.pkl.
+
+    max_chapter_kb defaults to the limit the book was saved with, or to
+    resolve_max_chapter_kb() for books saved before size cuts existed.
+    Only re-segments the stored per-document layouts: no source file, HTML
+    parsing or image I/O. Returns None for books saved without a layout
+    (older versions), which need a full re-import instead.
+    """
+    try:
+        split_level = int(split_level)
+    except (TypeError, ValueError):
+        split_level = 2
+    split_level = max(1, min(6, split_level))
+
+    with span("resplit.load"):
+        book = load_book(output_dir)
+        layout = load_layout(output_dir)
+    if book is None or layout is None:
+        return None
+    if max_chapter_kb is None:
+        max_chapter_kb = book.max_chapter_kb
+    max_chapter_kb = resolve_max_chapter_kb(max_chapter_kb)
+
+    with span("resplit.assemble", split_level=split_level) as sp:
+        if layout.kind == "markdown":
+            spine_chapters, toc, anchor_map = assemble_markdown(
+                layout.documents[0].layout, split_level, book.metadata.title, max_chapter_kb=max_chapter_kb,
+            )
+        else:
+            spine_chapters, anchor_map = assemble_epub_spine(layout.documents, split_level, max_chapter_kb)
+            toc = book.toc
+        attach_chapter_indices_to_toc(toc, anchor_map, max_depth=split_level)
+        sp.set(chapters=len(spine_chapters))
+        if collecting():
+            sp.set(anchors=len(anchor_map))
+
+    return replace(
+        book,
+        spine=spine_chapters,
+        toc=toc,
+        anchor_map=anchor_map,
+        split_level=split_level,
+        max_chapter_kb=max_chapter_kb,
+        processed_at=datetime.now().isoformat(),
+    )
+
+
+# --- Ingestion cache ---
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# Source file extensions the ingestion pipeline understands.
+SOURCE_KINDS = {".epub": "epub", ".md": "markdown", ".markdown": "markdown"}
+
+
+def source_kind(path: str) -> Optional[str]:
+    return SOURCE_KINDS.get(os.path.splitext(path)[1].lower())
+
+
+def hash_source_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_stat(path: str) -> List[int]:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def is_ingest_current(
+    output_dir: str,
+    source_path: str,
+    split_level: int,
+    source_hash: Optional[str] = None,
+    image_mode: Optional[str] = None,
+    max_chapter_kb: Optional[int] = None,
+) -> bool:
+    """True if output_dir already holds source_path processed at split_level
+    and max_chapter_kb (and, for EPUBs, image_mode) by this version of reader3.
+
+    The cache key is (source sha256, split_level, max_chapter_kb,
+    BOOK_VERSION). An unchanged size/mtime is trusted without hashing;
+    otherwise the file is hashed (unless the caller already did, e.g. while
+    receiving an upload) and, if only its mtime moved (re-upload, copy), the
+    recorded stat is refreshed.
+    """
+    summary = read_summary(output_dir)
+    if not summary or not summary.get("source_hash"):
+        return False
+    if (summary.get("version") != BOOK_VERSION
+            or summary.get("split_level") != split_level
+            or summary.get("max_chapter_kb", 0) != resolve_max_chapter_kb(max_chapter_kb)
+            or summary.get("source_file") != os.path.basename(source_path)):
+        return False
+    if (source_kind(source_path) == "epub"
+            and summary.get("image_mode", "extract") != resolve_image_mode(image_mode)):
+        return False
+
+    stat = source_stat(source_path)
+    if summary.get("source_stat") == stat:
+        return True
+    if source_hash is None:
+        source_hash = hash_source_file(source_path)
+    if summary["source_hash"] != source_hash:
+        return False
+
+    summary["source_stat"] = stat
+    s_path = os.path.join(output_dir, SUMMARY_FILE)
+    tmp_path = s_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False)
+    os.replace(tmp_path, s_path)
+    return True
+
+
+def ingest_source(
+    source_path: str,
+    output_dir: str,
+    split_level: Optional[int] = None,
+    workers: Optional[int] = None,
+    progress: Optional[ProgressCallback] = None,
+    force: bool = False,
+    source_hash: Optional[str] = None,
+    image_mode: Optional[str] = None,
+    max_chapter_kb: Optional[int] = None,
+) -> Tuple[Dict[str, Any], bool]:
+    """Process and save one EPUB/Markdown file unless an identical result exists.
+
+    Returns (summary, processed); processed is False on a cache hit.
+    source_hash, if given, is the sha256 of source_path and saves re-reading it.
+    """
+    kind = source_kind(source_path)
+    if kind is None:
+        raise ValueError(f"Unsupported source file type: {source_path}")
+    split_level = resolve_split_level(split_level)
+
+    if not force and is_ingest_current(output_dir, source_path, split_level, source_hash, image_mode,
+                                       max_chapter_kb):
+        print(f"Unchanged, skipping {source_path}")
+        return read_summary(output_dir), False
+
+    if kind == "epub":
+        book = process_epub(
+            source_path, output_dir, split_level=split_level, progress=progress,
+            workers=workers, source_hash=source_hash, image_mode=image_mode, max_chapter_kb=max_chapter_kb,
+        )
+    else:
+        book = process_markdown(
+            source_path, output_dir, split_level=split_level, progress=progress, source_hash=source_hash,
+            max_chapter_kb=max_chapter_kb,
+        )
+    return book_summary(book), True
+
+
+def sync_hub(
+    hub_dir: str,
+    shelf_dir: str,
+    split_level: Optional[int] = None,
+    workers: Optional[int] = None,
+    progress: Optional[ProgressCallback] = None,
+    force: bool = False,
+    image_mode: Optional[str] = None,
+    max_chapter_kb: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Import every EPUB/Markdown file in hub_dir into shelf_dir/<name>_data,
+    processing only files that are new or changed since their last import.
+
+    With split_level (max_chapter_kb) None, books already on the shelf keep
+    their current split level (chapter size limit) and new ones get the
+    default.
+    """
+    names = sorted(n for n in os.listdir(hub_dir) if source_kind(n)) if os.path.isdir(hub_dir) else []
+    imported, unchanged, failed = [], [], []
+
+    for i, name in enumerate(names):
+        if progress:
+            progress("files", i, len(names), name)
+        book_id = os.path.splitext(name)[0] + "_data"
+        output_dir = os.path.join(shelf_dir, book_id)
+        level, limit = split_level, max_chapter_kb
+        if level is None or limit is None:
+            summary = read_summary(output_dir) or {}
+            if level is None:
+                level = summary.get("split_level")
+            if limit is None:
+                limit = summary.get("max_chapter_kb")
+        try:
+            _, processed = ingest_source(
+                os.path.join(hub_dir, name),
+                output_dir,
+                split_level=level,
+                workers=workers,
+                force=force,
+                image_mode=image_mode,
+                max_chapter_kb=limit,
+            )
+        except Exception as e:
+            print(f"Error importing {name}: {e}")
+            failed.append({"file": name, "book_id": book_id, "error": f"{type(e).__name__}: {e}"})
+            continue
+        (imported if processed else unchanged).append(book_id)
+
+    if progress:
+        progress("files", len(names), len(names), None)
+    return {"imported": imported, "unchanged": unchanged, "failed": failed}
+
+
+# --- CLI ---
+
+def main(argv: Optional[List[str]] = None):
+    """Command-line entry point; see --help."""
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert an EPUB into a reader3 data folder.")
+    parser.add_argument("epub_file", nargs="?", help="path to the .epub file")
+    parser.add_argument("--split-level", type=int, default=None,
+                        help="heading level (1-6) to split chapters at (default: $READER3_SPLIT_HEADING_LEVEL or 2)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes used to parse spine documents (default: $READER3_SPINE_WORKERS or 1); "
+                             "with --export-jsonl, books read in parallel (default: $READER3_EXPORT_WORKERS or 4)")
+    parser.add_argument("--sync-hub", action="store_true",
+                        help="import every new or changed EPUB/Markdown file from --hub into --shelf")
+    parser.add_argument("--hub", default=os.path.join("books", "hub"), help="source directory for --sync-hub")
+    parser.add_argument("--shelf", default=os.path.join("books", "shelf"),
+                        help="output directory for --sync-hub, source for --export-jsonl")
+    parser.add_argument("--export-jsonl", metavar="PATH",
+                        help="write the text of every book in --shelf as JSON Lines, one record per chapter "
+                             "('-' for stdout)")
+    parser.add_argument("--since", default=None,
+                        help="with --export-jsonl, only books processed after this time (ISO 8601 or Unix seconds)")
+    parser.add_argument("--image-mode", choices=IMAGE_MODES, default=None,
+                        help="extract images into the data folder, or serve them from the source EPUB "
+                             "(default: $READER3_IMAGE_MODE or extract)")
+    parser.add_argument("--max-chapter-kb", type=int, default=None,
+                        help="cut chapters larger than this many KB of HTML at block boundaries, 0 for no limit "
+                             f"(default: $READER3_MAX_CHAPTER_KB or {DEFAULT_MAX_CHAPTER_KB})")
+    parser.add_argument("--force", action="store_true",
+                        help="reprocess even if an identical processed result already exists")
+    parser.add_argument("--timings", action="store_true", help="print the time spent in each ingestion stage")
+    args = parser.parse_args(argv)
+
+    spans = None
+    if args.timings:
+        from metrics import SpanCollector, add_sink
+        spans = SpanCollector()
+        add_sink(spans)
+
+    def print_timings():
+        if spans is None:
+            return
+        print("\n--- Stage timings ---")
+        for s in spans.spans:
+            counts = ", ".join(f"{k}={v}" for k, v in s.items() if k not in ("name", "seconds"))
+            print(f"{s['name']:<22} {s['seconds'] * 1000:>10.1f} ms  {counts}")
+
+    if args.sync_hub:
+        report = sync_hub(
+            args.hub, args.shelf, split_level=args.split_level, workers=args.workers, force=args.force,
+            image_mode=args.image_mode, max_chapter_kb=args.max_chapter_kb,
+        )
+        print("\n--- Hub Sync ---")
+        print(f"Imported: {len(report['imported'])}")
+        print(f"Unchanged: {len(report['unchanged'])}")
+        for failure in report["failed"]:
+            print(f"Failed: {failure['file']} ({failure['error']})")
+        print_timings()
+        raise SystemExit(1 if report["failed"] else 0)
+
+    if args.export_jsonl:
+        from export import export_shelf, parse_since
+        try:
+            since = parse_since(args.since)
+        except ValueError:
+            parser.error("--since must be an ISO 8601 time or Unix seconds")
+        out = sys.stdout.buffer if args.export_jsonl == "-" else open(args.export_jsonl, "wb")
+        records = 0
+        try:
+            for line in export_shelf(args.shelf, since=since, workers=args.workers):
+                out.write(line)
+                records += 1
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        print(f"Exported {records} chapters", file=sys.stderr)
+        raise SystemExit(0)
+
+    if not args.epub_file:
+        parser.error("epub_file is required unless --sync-hub or --export-jsonl is given")
+    epub_file = args.epub_file
     assert os.path.exists(epub_file), "File not found."
     out_dir = os.path.splitext(epub_file)[0] + "_data"
 
-    book_obj = process_epub(epub_file, out_dir)
-    save_to_pickle(book_obj, out_dir)
+    split_level = resolve_split_level(args.split_level)
+    if not args.force and is_ingest_current(out_dir, epub_file, split_level, image_mode=args.image_mode,
+                                            max_chapter_kb=args.max_chapter_kb):
+        print(f"{out_dir} is up to date (use --force to reprocess).")
+        raise SystemExit(0)
+
+    book_obj = process_epub(
+        epub_file, out_dir, split_level=split_level, workers=args.workers, image_mode=args.image_mode,
+        max_chapter_kb=args.max_chapter_kb,
+    )
     print("\n--- Summary ---")
     print(f"Title: {book_obj.metadata.title}")
     print(f"Authors: {', '.join(book_obj.metadata.authors)}")
     print(f"Physical Files (Spine): {len(book_obj.spine)}")
     print(f"TOC Root Items: {len(book_obj.toc)}")
     print(f"Images extracted: {len(book_obj.images)}")
+    print_timings()
+
+
+if __name__ == "__main__":
+    # Run the CLI from the imported module rather than __main__: manifests
+    # pickle their records by module name, and the server loads them from
+    # reader3.
+    import reader3
+    reader3.main()
@@ -0,0 +1,265 @@
+"""
+Full-text search over the shelf.
+
+Each book gets a small inverted index (search.pkl) written next to its
+manifest at save time. The server merges them into one in-memory shelf index
+and answers ranked (BM25) queries without loading any book pickles; snippets
+are read straight from the hit chapters' text in chapters.bin.
+
+Tokenization: Latin/digit runs become lowercase words, CJK runs become
+overlapping character bigrams, so Chinese text is searchable without a
+segmentation dictionary. Indexed text also gets every CJK character as a
+unigram, which is what a one-character query looks up.
+"""
+
+import math
+import os
+import pickle
+import re
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from reader3 import CHAPTERS_FILE
+
+SEARCH_INDEX_FILE = "search.pkl"
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W_{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str, unigrams: bool = False) -> List[str]:
+    """Split text into search terms; unigrams=True (used for indexing) adds
+    each character of multi-character CJK runs."""
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+                if unigrams:
+                    tokens.extend(run)
+        else:
+            tokens.append(run)
+    return tokens
+
+
+@dataclass
+class IndexedChapter:
+    order: int
+    title: str
+    text_offset: int      # byte offset of the chapter text in chapters.bin
+    text_size: int
+    length: int           # number of tokens
+    anchors: List[Tuple[int, str]] = field(default_factory=list)  # (text char offset, id), sorted
+
+
+@dataclass
+class BookIndex:
+    title: str
+    chapters: List[IndexedChapter]
+    postings: Dict[str, List[Tuple[int, int]]]   # term -> [(chapter position, term frequency)]
+
+
+def build_book_index(title: str, chapters: Iterable[Tuple[IndexedChapter, str]]) -> BookIndex:
+    """Build an index from (chapter entry, chapter text) pairs."""
+    entries = []
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    for pos, (entry, text) in enumerate(chapters):
+        counts = Counter(tokenize(entry.title + " " + text, unigrams=True))
+        entry.length = sum(counts.values())
+        entry.anchors = sorted(entry.anchors)
+        entries.append(entry)
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((pos, tf))
+    return BookIndex(title=title, chapters=entries, postings=postings)
+
+
+def write_book_index(index: BookIndex, output_dir: str):
+    path = os.path.join(output_dir, SEARCH_INDEX_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def read_book_index(output_dir: str) -> Optional[BookIndex]:
+    path = os.path.join(output_dir, SEARCH_INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _read_text(output_dir: str, chapter: IndexedChapter) -> str:
+    with open(os.path.join(output_dir, CHAPTERS_FILE), "rb") as f:
+        f.seek(chapter.text_offset)
+        return f.read(chapter.text_size).decode("utf-8", errors="ignore")
+
+
+def make_snippet(text: str, query: str, terms: List[str], width: int = 80) -> Tuple[str, int]:
+    """Return (snippet, match offset) around the first occurrence of the query."""
+    lower = text.lower()
+    pos = lower.find(query.lower().strip())
+    if pos < 0:
+        hits = [p for p in (lower.find(t) for t in terms) if p >= 0]
+        pos = min(hits) if hits else 0
+    start = max(0, pos - width // 2)
+    end = min(len(text), pos + width)
+    snippet = text[start:end]
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(text):
+        snippet = snippet + "…"
+    return snippet, pos
+
+
+class ShelfIndex:
+    """All per-book indexes of a shelf merged for querying.
+
+    The merged postings are rebuilt lazily when a book's search.pkl changes
+    (checked at most every `check_interval` seconds) or after invalidate().
+    """
+
+    def __init__(self, shelf_dir: str, check_interval: float = 2.0):
+        self.shelf_dir = shelf_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # book_id -> (mtime_ns, index, directory it was read from)
+        self._books: Dict[str, Tuple[int, BookIndex, str]] = {}
+        self._postings: Dict[str, List[Tuple[str, int, int]]] = {}
+        self._total_length = 0
+        self._total_chapters = 0
+        self._checked_at = 0.0
+        self._dirty = True
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _refresh(self):
+        now = time.monotonic()
+        if not self._dirty and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        self._dirty = False
+
+        changed = False
+        seen = set()
+        if os.path.exists(self.shelf_dir):
+            for book_id in os.listdir(self.shelf_dir):
+                if not book_id.endswith("_data"):
+                    continue
+                # Resolved to the book's current generation, so snippets are
+                # read from the chapters.bin this index describes.
+                folder = os.path.realpath(os.path.join(self.shelf_dir, book_id))
+                try:
+                    mtime = os.stat(os.path.join(folder, SEARCH_INDEX_FILE)).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(book_id)
+                cached = self._books.get(book_id)
+                if cached and cached[0] == mtime and cached[2] == folder:
+                    continue
+                try:
+                    index = read_book_index(folder)
+                except Exception as e:
+                    print(f"Error reading search index for {book_id}: {e}")
+                    continue
+                self._books[book_id] = (mtime, index, folder)
+                changed = True
+
+        for book_id in [b for b in self._books if b not in seen]:
+            del self._books[book_id]
+            changed = True
+
+        if changed or not self._postings:
+            self._merge()
+
+    def _merge(self):
+        postings: Dict[str, List[Tuple[str, int, int]]] = {}
+        total_length = 0
+        total_chapters = 0
+        for book_id, (_, index, _) in self._books.items():
+            total_chapters += len(index.chapters)
+            total_length += sum(ch.length for ch in index.chapters)
+            for term, plist in index.postings.items():
+                merged = postings.setdefault(term, [])
+                merged.extend((book_id, pos, tf) for pos, tf in plist)
+        self._postings = postings
+        self._total_length = total_length
+        self._total_chapters = total_chapters
+
+    def search(self, query: str, limit: int = 20, book_id: Optional[str] = None) -> List[Dict]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            self._refresh()
+            books = dict(self._books)
+            n = self._total_chapters
+            avgdl = (self._total_length / n) if n else 0.0
+            term_postings = [self._postings.get(t, []) for t in terms]
+
+        if not n or any(not p for p in term_postings):
+            return []
+
+        # Every term must occur in the chapter; score the survivors with BM25.
+        scores: Optional[Dict[Tuple[str, int], float]] = None
+        for plist in sorted(term_postings, key=len):
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            next_scores: Dict[Tuple[str, int], float] = {}
+            for b_id, pos, tf in plist:
+                if book_id is not None and b_id != book_id:
+                    continue
+                key = (b_id, pos)
+                if scores is not None and key not in scores:
+                    continue
+                dl = books[b_id][1].chapters[pos].length
+                score = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * dl / (avgdl or 1)))
+                next_scores[key] = (scores[key] if scores is not None else 0.0) + score
+            scores = next_scores
+            if not scores:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+        results = []
+        for (b_id, pos), score in ranked:
+            index = books[b_id][1]
+            chapter = index.chapters[pos]
+            try:
+                text = _read_text(books[b_id][2], chapter)
+            except OSError:
+                continue
+            snippet, match_pos = make_snippet(text, query, terms)
+
+            # Nearest element id at or before the match, for jump-to links.
+            anchor = None
+            i = bisect_right(chapter.anchors, (match_pos, "\uffff"))
+            if i > 0:
+                anchor = chapter.anchors[i - 1][1]
+
+            url = f"/read/{b_id}/{chapter.order}"
+            if anchor:
+                url += f"#{anchor}"
+            results.append({
+                "book_id": b_id,
+                "book_title": index.title,
+                "chapter_index": chapter.order,
+                "chapter_title": chapter.title,
+                "score": round(score, 4),
+                "snippet": snippet,
+                "anchor": anchor,
+                "url": url,
+            })
+        return results
@@ -1,16 +1,37 @@
+import hashlib
+import json
+import mimetypes
 import os
-import pickle
-import shutil
-from functools import lru_cache
-from typing import Optional
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
-from reader3 import Book, BookMetadata, ChapterContent, TOCEntry, process_epub, process_markdown, save_to_pickle
+from reader3 import (
+    BOOK_VERSION, Book, BookMetadata, ChapterContent, TOCEntry,
+    book_files_dir, load_book, load_chapter, read_summary, write_summary, SUMMARY_FILE, LAYOUT_FILE,
+    TOC_HTML_FILE, render_toc_html,
+)
+from archive import ArchivePool
+from bookcache import BookCache
+from context import MAX_PARAGRAPH_TOKENS, ContextIndex, read_context_index
+from export import export_shelf, parse_since
+from httpcache import (
+    CachedBody, RenderCache, cached_response, compress_variants, etag_matches, read_variants,
+)
+from images import archive_image_name, is_content_addressed
+from jobs import ALL_BOOKS, Job, JobManager, JobConflictError, QueueFullError
+from metrics import Registry, RequestMetricsMiddleware
+from publish import remove_book
+from search import ShelfIndex
 
 app = FastAPI()
 app.add_middleware(
@@ -31,27 +52,376 @@ BOOKS_SHELF_DIR = os.path.join(BASE_BOOKS_DIR, "shelf")
 os.makedirs(BOOKS_HUB_DIR, exist_ok=True)
 os.makedirs(BOOKS_SHELF_DIR, exist_ok=True)
 
-@lru_cache(maxsize=10)
+# Uploads are copied into books/hub in chunks of this size; larger files are
+# rejected with 413.
+UPLOAD_CHUNK_SIZE = 1 << 20
+try:
+    MAX_UPLOAD_BYTES = int(os.getenv("READER3_MAX_UPLOAD_MB", "512")) * 1024 * 1024
+except ValueError:
+    MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+# Request bodies of the upload endpoints may exceed MAX_UPLOAD_BYTES by this
+# much: multipart framing and the small form fields sent with the file.
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+UPLOAD_PATHS = ("/api/upload_epub", "/api/upload_md")
+
+book_cache = BookCache(BOOKS_SHELF_DIR)
+# Open source EPUBs of books imported in zero-copy image mode.
+archive_pool = ArchivePool()
+
+
 def load_book_cached(folder_name: str) -> Optional[Book]:
-    """Loads the book from the pickle file under books/shelf.
-    Cached so we don't re-read the disk on every click.
+    """Loads the book manifest (or legacy book.pkl) under books/shelf.
+    Cached (bounded by READER3_BOOK_CACHE_MB) so we don't re-read the disk on
+    every click; a manifest rewritten on disk is picked up automatically.
+    Chapter bodies are read on demand via load_chapter().
     """
-    file_path = os.path.join(BOOKS_SHELF_DIR, folder_name, "book.pkl")
-    if not os.path.exists(file_path):
+    return book_cache.get(folder_name)
+
+
+# --- Shelf catalog ---
+# books/shelf/catalog.json aggregates every book's summary.json keyed by folder
+# name, together with the summary's mtime. The library page only needs one
+# stat() per folder to validate it instead of unpickling every book.
+
+CATALOG_PATH = os.path.join(BOOKS_SHELF_DIR, "catalog.json")
+_catalog: Optional[Dict[str, Dict[str, Any]]] = None
+# Ingestion jobs refresh entries from a pool thread.
+_catalog_lock = threading.Lock()
+
+
+def _read_catalog() -> Dict[str, Dict[str, Any]]:
+    global _catalog
+    if _catalog is None:
+        _catalog = {}
+        if os.path.exists(CATALOG_PATH):
+            try:
+                with open(CATALOG_PATH, "r", encoding="utf-8") as f:
+                    _catalog = json.load(f)
+            except Exception as e:
+                print(f"Error reading shelf catalog: {e}")
+    return _catalog
+
+
+def _write_catalog(catalog: Dict[str, Dict[str, Any]]):
+    tmp_path = CATALOG_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    os.replace(tmp_path, CATALOG_PATH)
+
+
+def _summary_mtime(folder_name: str) -> Optional[int]:
+    try:
+        return os.stat(os.path.join(BOOKS_SHELF_DIR, folder_name, SUMMARY_FILE)).st_mtime_ns
+    except OSError:
         return None
 
+
+def _build_catalog_entry(folder_name: str) -> Optional[Dict[str, Any]]:
+    """Read (or backfill, for books without summary.json) one book's summary."""
+    folder_path = os.path.join(BOOKS_SHELF_DIR, folder_name)
     try:
-        with open(file_path, "rb") as f:
-            book = pickle.load(f)
-        return book
+        summary = read_summary(folder_path)
     except Exception as e:
-        print(f"Error loading book {folder_name}: {e}")
-        return None
+        print(f"Error reading summary for {folder_name}: {e}")
+        summary = None
+
+    if summary is None:
+        # Legacy folder: load it once (bypassing the book cache) to backfill.
+        try:
+            book = load_book(folder_path)
+        except Exception as e:
+            print(f"Error loading book {folder_name}: {e}")
+            book = None
+        if not book:
+            return None
+        write_summary(book, folder_path)
+        summary = read_summary(folder_path)
+
+    return dict(summary, mtime=_summary_mtime(folder_name))
+
+
+def refresh_catalog_entry(folder_name: str):
+    """Re-read one book's summary after upload/resplit/import, or drop it after delete."""
+    with _catalog_lock:
+        catalog = _read_catalog()
+        entry = None
+        if os.path.isdir(os.path.join(BOOKS_SHELF_DIR, folder_name)):
+            entry = _build_catalog_entry(folder_name)
+        if entry is None:
+            catalog.pop(folder_name, None)
+        else:
+            catalog[folder_name] = entry
+        _write_catalog(catalog)
+
+
+def list_shelf() -> List[Dict[str, Any]]:
+    """Return catalog entries for every book on the shelf.
+
+    Entries whose summary.json changed on disk (e.g. a CLI re-import) are
+    re-read; folders that disappeared are dropped.
+    """
+    with _catalog_lock:
+        catalog = _read_catalog()
+        changed = False
+        seen = set()
+        result = []
+
+        if os.path.exists(BOOKS_SHELF_DIR):
+            for item in os.listdir(BOOKS_SHELF_DIR):
+                if not item.endswith("_data"):
+                    continue
+                if not os.path.isdir(os.path.join(BOOKS_SHELF_DIR, item)):
+                    continue
+
+                seen.add(item)
+                entry = catalog.get(item)
+                if entry is None or entry.get("mtime") != _summary_mtime(item):
+                    entry = _build_catalog_entry(item)
+                    if entry is None:
+                        if catalog.pop(item, None) is not None:
+                            changed = True
+                        continue
+                    catalog[item] = entry
+                    changed = True
+                result.append(dict(entry, id=item))
+
+        for item in [k for k in catalog if k not in seen]:
+            del catalog[item]
+            changed = True
+
+        if changed:
+            _write_catalog(catalog)
+    return result
+
+
+search_index = ShelfIndex(BOOKS_SHELF_DIR)
+
+
+def _on_job_complete(job: Job):
+    for stage, seconds in (job.result or {}).get("timings", {}).items():
+        ingest_stage_seconds.observe(seconds, kind=job.kind, stage=stage)
+    if job.result and job.result.get("cached"):
+        # Source unchanged, nothing was rewritten.
+        return
+    if job.book_id == ALL_BOOKS:
+        for book_id in job.result["imported"]:
+            book_cache.invalidate(book_id)
+            refresh_catalog_entry(book_id)
+    else:
+        book_cache.invalidate(job.book_id)
+        refresh_catalog_entry(job.book_id)
+    search_index.invalidate()
+
+
+jobs = JobManager(on_complete=_on_job_complete)
+
+
+# --- Metrics ---
+# Request latency per handler is recorded by middleware; ingestion stage
+# timings come back with each job's result; cache and queue counters are read
+# from their stats() when /metrics is scraped. READER3_METRICS=0 turns off the
+# per-request middleware.
+
+METRICS_ENABLED = os.getenv("READER3_METRICS", "1") != "0"
+INGEST_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+metrics = Registry()
+request_seconds = metrics.histogram(
+    "reader3_request_duration_seconds", "HTTP request latency by handler.", ("handler", "method", "status"),
+)
+ingest_stage_seconds = metrics.histogram(
+    "reader3_ingest_stage_seconds", "Time spent per ingestion stage, per job.", ("kind", "stage"),
+    buckets=INGEST_BUCKETS,
+)
+
+
+# (stats() key, metric name, type, help) for the book and page caches.
+CACHE_METRICS = (
+    ("hits", "reader3_cache_hits_total", "counter", "Cache lookups served from memory."),
+    ("misses", "reader3_cache_misses_total", "counter", "Cache lookups that had to load or render."),
+    ("evictions", "reader3_cache_evictions_total", "counter", "Entries evicted to stay within the byte budget."),
+    ("entries", "reader3_cache_entries", "gauge", "Entries currently cached."),
+    ("bytes", "reader3_cache_bytes", "gauge", "Bytes currently cached."),
+    ("max_bytes", "reader3_cache_max_bytes", "gauge", "Cache byte budget."),
+)
+
+
+def _cache_samples(key: str):
+    def collect():
+        return [({"cache": "books"}, book_cache.stats()[key]), ({"cache": "pages"}, page_cache.stats()[key])]
+    return collect
+
+
+for _key, _name, _type, _help in CACHE_METRICS:
+    metrics.callback(_name, _help, _cache_samples(_key), _type, ("cache",))
+metrics.callback(
+    "reader3_book_cache_hit_ratio", "Share of book lookups served from the cache.",
+    lambda: book_cache.stats()["hit_ratio"],
+)
+metrics.callback("reader3_open_archives", "Source EPUBs held open for zero-copy images.",
+                 lambda: archive_pool.stats()["open"])
+metrics.callback(
+    "reader3_ingest_jobs", "Ingestion jobs waiting or running.",
+    lambda: [({"state": state}, jobs.stats()[state]) for state in ("queued", "running")],
+    labelnames=("state",),
+)
+metrics.callback(
+    "reader3_ingest_jobs_finished_total", "Finished ingestion jobs by kind and outcome.",
+    lambda: [({"kind": f["kind"], "status": f["status"]}, f["count"]) for f in jobs.stats()["finished"]],
+    type="counter", labelnames=("kind", "status"),
+)
+
+if METRICS_ENABLED:
+    app.add_middleware(RequestMetricsMiddleware, histogram=request_seconds)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Counters and latency histograms in the Prometheus text format."""
+    return Response(content=metrics.render(), media_type=Registry.CONTENT_TYPE)
+
+
+def _ensure_no_active_job(book_id: str):
+    job = jobs.active_job(book_id)
+    if job is not None:
+        raise HTTPException(status_code=409, detail=str(JobConflictError(job)))
+
+
+def _submit_job(
+    kind: str,
+    book_id: str,
+    source_path: str,
+    split_level: int,
+    workers: Optional[int] = None,
+    force: bool = False,
+    out_dir: Optional[str] = None,
+    source_hash: Optional[str] = None,
+) -> JSONResponse:
+    """Queue an ingestion job and answer 202 with its id for polling.
+
+    workers (EPUB only) is the number of processes parsing spine documents
+    inside the job; None falls back to READER3_SPINE_WORKERS. Unless force is
+    set, the job skips sources whose processed result is already current.
+    """
+    if out_dir is None:
+        out_dir = os.path.join(BOOKS_SHELF_DIR, book_id)
+    try:
+        job = jobs.submit(
+            kind, book_id, source_path, out_dir, split_level,
+            workers=workers, force=force, source_hash=source_hash,
+        )
+    except JobConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return JSONResponse(status_code=202, content={
+        "status": "queued",
+        "job_id": job.id,
+        "book_id": book_id,
+        "split_level": split_level,
+    })
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+def _upload_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+
+
+class UploadLimitMiddleware:
+    """ASGI middleware bounding the request body of the upload endpoints.
+
+    FastAPI spools a multipart body to a temp file before the endpoint runs,
+    so the limit has to hold while the body is received: a Content-Length
+    over max_bytes is answered with 413 without reading the body, and a body
+    that grows past it (chunked) is cut off there.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in UPLOAD_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                error = _upload_too_large()
+                await JSONResponse(status_code=error.status_code, content={"detail": error.detail})(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Re-raised by FastAPI's body parsing, answered as 413.
+                    raise _upload_too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD)
+
+
+def _copy_upload(src, dest_path: str) -> str:
+    """Stream an uploaded file into dest_path and return its sha256.
+
+    Data goes to a hidden temp file next to dest_path (ignored by the hub
+    listing) that is renamed into place only once complete, so an aborted or
+    oversized upload never replaces a good source file.
+    """
+    dest_dir, name = os.path.split(dest_path)
+    tmp_path = os.path.join(dest_dir, f".{name}.{uuid.uuid4().hex}.part")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadTooLargeError()
+                h.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return h.hexdigest()
+
+
+async def save_upload(file: UploadFile, dest_path: str) -> str:
+    """Write an upload to dest_path without holding it in memory; returns its sha256.
+
+    UploadLimitMiddleware has already bounded the request body; this enforces
+    the exact limit on the file itself.
+    """
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise _upload_too_large()
+    try:
+        return await run_in_threadpool(_copy_upload, file.file, dest_path)
+    except UploadTooLargeError:
+        raise _upload_too_large()
+
 
 @app.post("/api/upload_epub")
 async def upload_epub(
     file: UploadFile = File(...),
     split_level: int = Form(2),
+    workers: Optional[int] = Form(None),
 ):
     filename = os.path.basename(file.filename) if file.filename else "uploaded.epub"
     if not filename.lower().endswith(".epub"):
@@ -59,11 +429,11 @@ async def upload_epub(
     base_name, _ = os.path.splitext(filename)
     folder_name = base_name + "_data"
     epub_path = os.path.join(BOOKS_HUB_DIR, filename)
-    out_dir = os.path.join(BOOKS_SHELF_DIR, folder_name)
 
-    content = await file.read()
-    with open(epub_path, "wb") as f:
-        f.write(content)
+    # Do not overwrite a source file a running job is still reading.
+    _ensure_no_active_job(folder_name)
+
+    source_hash = await save_upload(file, epub_path)
 
     # Clamp split_level to [1, 6]
     if split_level < 1:
@@ -71,17 +441,7 @@ async def upload_epub(
     elif split_level > 6:
         split_level = 6
 
-    # Call process_epub with explicit split_level so it does not rely on env.
-    book = process_epub(epub_path, out_dir, split_level=split_level)
-    save_to_pickle(book, out_dir)
-    load_book_cached.cache_clear()
-
-    return {
-        "status": "ok",
-        "book_id": folder_name,
-        "title": book.metadata.title,
-        "split_level": book.split_level,
-    }
+    return _submit_job("epub", folder_name, epub_path, split_level, workers=workers, source_hash=source_hash)
 
 
 @app.post("/api/upload_md")
@@ -96,29 +456,66 @@ async def upload_md(
     base_name, _ = os.path.splitext(filename)
     folder_name = base_name + "_data"
     md_path = os.path.join(BOOKS_HUB_DIR, filename)
-    out_dir = os.path.join(BOOKS_SHELF_DIR, folder_name)
 
-    content = await file.read()
-    with open(md_path, "wb") as f:
-        f.write(content)
+    _ensure_no_active_job(folder_name)
+
+    source_hash = await save_upload(file, md_path)
 
     if split_level < 1:
         split_level = 1
     elif split_level > 6:
         split_level = 6
 
-    book = process_markdown(md_path, out_dir, split_level=split_level)
-    save_to_pickle(book, out_dir)
-    load_book_cached.cache_clear()
+    return _submit_job("markdown", folder_name, md_path, split_level, source_hash=source_hash)
+
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Status and progress of an ingestion job (queued/running/done/error)."""
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return jobs.status(job)
+
 
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Book and page cache counters, for sizing READER3_BOOK_CACHE_MB and
+    READER3_PAGE_CACHE_MB."""
+    return {"books": book_cache.stats(), "pages": page_cache.stats(), "archives": archive_pool.stats()}
+
+
+@app.get("/api/search")
+async def search_shelf(q: str, limit: int = 20, book_id: Optional[str] = None):
+    """Ranked full-text search over every book on the shelf (or one book)."""
+    limit = max(1, min(limit, 100))
+    start = time.perf_counter()
+    results = search_index.search(q, limit=limit, book_id=book_id)
     return {
-        "status": "ok",
-        "book_id": folder_name,
-        "title": book.metadata.title,
-        "split_level": book.split_level,
+        "query": q,
+        "results": results,
+        "took_ms": round((time.perf_counter() - start) * 1000, 2),
     }
 
 
+@app.get("/api/export.jsonl")
+async def export_jsonl(since: Optional[str] = None, book_id: Optional[str] = None):
+    """Stream the shelf's text as JSON Lines, one record per chapter.
+
+    since (ISO 8601 or Unix seconds) keeps books processed after it;
+    book_id exports a single book.
+    """
+    try:
+        cutoff = parse_since(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since must be an ISO 8601 time or Unix seconds")
+    book_ids = [book_id] if book_id else None
+    return StreamingResponse(
+        export_shelf(BOOKS_SHELF_DIR, since=cutoff, book_ids=book_ids),
+        media_type="application/x-ndjson",
+    )
+
+
 @app.post("/api/books/{book_id}/delete")
 async def delete_book(book_id: str):
     safe_id = os.path.basename(book_id)
@@ -130,18 +527,22 @@ async def delete_book(book_id: str):
     if not safe_id.endswith("_data"):
         raise HTTPException(status_code=400, detail="Refusing to delete non-data folder")
 
+    _ensure_no_active_job(safe_id)
+
     try:
-        shutil.rmtree(folder_path)
+        remove_book(folder_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete book folder: {e}")
 
-    load_book_cached.cache_clear()
+    book_cache.invalidate(safe_id)
+    refresh_catalog_entry(safe_id)
+    search_index.invalidate()
 
     return {"status": "ok", "book_id": safe_id}
 
 
 @app.post("/api/books/{book_id}/resplit")
-async def resplit_book(book_id: str, split_level: int = Form(2)):
+async def resplit_book(book_id: str, split_level: int = Form(2), workers: Optional[int] = Form(None)):
     safe_id = os.path.basename(book_id)
     folder_path = os.path.join(BOOKS_SHELF_DIR, safe_id)
 
@@ -152,37 +553,39 @@ async def resplit_book(book_id: str, split_level: int = Form(2)):
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
+    if split_level < 1:
+        split_level = 1
+    elif split_level > 6:
+        split_level = 6
+
     source_path = os.path.join(BOOKS_HUB_DIR, book.source_file)
+
+    # Books saved with a layout.pkl are re-cut without touching the source.
+    if os.path.exists(os.path.join(folder_path, LAYOUT_FILE)):
+        return _submit_job("resplit", safe_id, source_path, split_level, workers=workers)
+
     if not os.path.exists(source_path):
         raise HTTPException(status_code=404, detail="Source file not found in hub")
 
     ext = os.path.splitext(book.source_file)[1].lower()
 
     if ext == ".epub":
-        if split_level < 1:
-            split_level = 1
-        elif split_level > 6:
-            split_level = 6
-        new_book = process_epub(source_path, folder_path, split_level=split_level)
+        kind = "epub"
     elif ext in (".md", ".markdown"):
-        new_book = process_markdown(source_path, folder_path, split_level=split_level)
+        kind = "markdown"
     else:
         raise HTTPException(status_code=400, detail="Unsupported source file type for resplit")
 
-    save_to_pickle(new_book, folder_path)
-    load_book_cached.cache_clear()
-
-    return {
-        "status": "ok",
-        "book_id": safe_id,
-        "title": new_book.metadata.title,
-        "split_level": new_book.split_level,
-        "chapters": len(new_book.spine),
-    }
+    return _submit_job(kind, safe_id, source_path, split_level, workers=workers)
 
 
 @app.post("/api/hub/import")
-async def import_from_hub(filename: str = Form(...), split_level: int = Form(2)):
+async def import_from_hub(
+    filename: str = Form(...),
+    split_level: int = Form(2),
+    workers: Optional[int] = Form(None),
+    force: bool = Form(False),
+):
     """Import or re-import an EPUB that already exists in books/hub into books/shelf."""
     safe_name = os.path.basename(filename)
     if not safe_name.lower().endswith(".epub"):
@@ -194,51 +597,47 @@ async def import_from_hub(filename: str = Form(...), split_level: int = Form(2))
 
     base_name, _ = os.path.splitext(safe_name)
     folder_name = base_name + "_data"
-    out_dir = os.path.join(BOOKS_SHELF_DIR, folder_name)
 
     if split_level < 1:
         split_level = 1
     elif split_level > 6:
         split_level = 6
 
-    book = process_epub(epub_path, out_dir, split_level=split_level)
+    return _submit_job("epub", folder_name, epub_path, split_level, workers=workers, force=force)
 
-    save_to_pickle(book, out_dir)
-    load_book_cached.cache_clear()
 
-    return {
-        "status": "ok",
-        "book_id": folder_name,
-        "title": book.metadata.title,
-        "split_level": book.split_level,
-        "chapters": len(book.spine),
-    }
+@app.post("/api/hub/sync")
+async def sync_hub_to_shelf(
+    split_level: Optional[int] = Form(None),
+    workers: Optional[int] = Form(None),
+    force: bool = Form(False),
+):
+    """Import every EPUB/Markdown file in books/hub that is new or changed.
+
+    Without split_level, books already on the shelf keep their split level.
+    """
+    if split_level is not None:
+        split_level = max(1, min(6, split_level))
+
+    return _submit_job(
+        "hub_sync", ALL_BOOKS, BOOKS_HUB_DIR, split_level,
+        workers=workers, force=force, out_dir=BOOKS_SHELF_DIR,
+    )
 
 @app.get("/", response_class=HTMLResponse)
 async def library_view(request: Request):
     """Lists all available processed books."""
+    # Rendered from the shelf catalog (summary.json per book), so no book
+    # pickles are loaded just to show the library.
     books = []
-
-    # Scan books/shelf for folders ending in '_data' that have a book.pkl
-    if os.path.exists(BOOKS_SHELF_DIR):
-        for item in os.listdir(BOOKS_SHELF_DIR):
-            if not item.endswith("_data"):
-                continue
-
-            folder_path = os.path.join(BOOKS_SHELF_DIR, item)
-            if not os.path.isdir(folder_path):
-                continue
-
-            # Try to load it to get the title
-            book = load_book_cached(item)
-            if book:
-                books.append({
-                    "id": item,
-                    "title": book.metadata.title,
-                    "author": ", ".join(book.metadata.authors),
-                    "chapters": len(book.spine),
-                    "split_level": getattr(book, "split_level", 1),
-                })
+    for entry in list_shelf():
+        books.append({
+            "id": entry["id"],
+            "title": entry["title"],
+            "author": ", ".join(entry.get("authors") or []),
+            "chapters": entry["chapters"],
+            "split_level": entry.get("split_level", 1),
+        })
 
     # List EPUB files in books/hub for management
     hub_files = []
@@ -258,14 +657,270 @@ async def library_view(request: Request):
 
     return templates.TemplateResponse("library.html", {"request": request, "books": books, "hub_files": hub_files})
 
-@app.get("/read/{book_id}", response_class=HTMLResponse)
+# --- Navigation assets ---
+# The sidebar TOC is rendered once per book (at save time, see
+# reader3.write_nav_assets) and served as a separate asset the browser
+# caches across chapters. Pages reference them with ?v=<etag>, so a
+# versioned URL never changes content and can be cached as immutable.
+
+MAX_NAV_ASSET_BOOKS = 64
+_nav_assets: "OrderedDict[str, Tuple[str, Dict[str, CachedBody]]]" = OrderedDict()
+_nav_assets_lock = threading.Lock()
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Unversioned URLs (chapter pages) are revalidated on every use; the ETag
+# makes that a cheap 304.
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# Images of books imported before content-hash names are cached for a day and
+# then revalidated; content-addressed ones never change.
+IMAGE_CACHE_CONTROL = "public, max-age=86400"
+
+
+def get_nav_assets(book_id: str, book: Book) -> Dict[str, CachedBody]:
+    """Return the cached toc.html body of a book, by file name."""
+    with _nav_assets_lock:
+        cached = _nav_assets.get(book_id)
+        if cached and cached[0] == book.processed_at:
+            _nav_assets.move_to_end(book_id)
+            return cached[1]
+
+    folder = book_files_dir(os.path.join(BOOKS_SHELF_DIR, book_id), book)
+    path = os.path.join(folder, TOC_HTML_FILE)
+    try:
+        if book.version != BOOK_VERSION:
+            # Saved before TOC links pointed at chapter pages.
+            raise FileNotFoundError(path)
+        with open(path, "rb") as f:
+            body = f.read()
+        variants = read_variants(path)
+    except OSError:
+        # Books saved before toc.html existed.
+        body = render_toc_html(book).encode("utf-8")
+        variants = compress_variants(body)
+    assets = {TOC_HTML_FILE: CachedBody(
+        body, hashlib.sha256(body).hexdigest()[:20], "text/html; charset=utf-8", variants,
+    )}
+
+    with _nav_assets_lock:
+        _nav_assets[book_id] = (book.processed_at, assets)
+        while len(_nav_assets) > MAX_NAV_ASSET_BOOKS:
+            _nav_assets.popitem(last=False)
+    return assets
+
+
+def _versioned_asset(request: Request, entry: CachedBody) -> Response:
+    """Serve an asset; immutable when requested by its current version."""
+    if request.query_params.get("v") == entry.etag:
+        return cached_response(request, entry, IMMUTABLE_CACHE_CONTROL)
+    return cached_response(request, entry, REVALIDATE_CACHE_CONTROL)
+
+
+@app.get("/read/{book_id}/nav/toc.html")
+async def serve_toc(request: Request, book_id: str):
+    safe_id = os.path.basename(book_id)
+    book = load_book_cached(safe_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return _versioned_asset(request, get_nav_assets(safe_id, book)[TOC_HTML_FILE])
+
+
+# --- Chapter pages ---
+# Rendered chapter pages are cached (with their compressed variants) under
+# (book_id, processed_at, chapter_index, template version). The ETag is
+# derived from that key, so a conditional request is answered with 304
+# without rendering or reading the chapter. Themes are applied client-side,
+# so one rendering serves every reader.
+
+page_cache = RenderCache()
+_template_versions: Dict[str, Tuple[int, str]] = {}
+
+
+def _template_version(name: str) -> str:
+    """Content hash of a template, re-read when the file changes."""
+    path = os.path.join("templates", name)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _template_versions.get(name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:12]
+    _template_versions[name] = (mtime, version)
+    return version
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={
+        "ETag": f'"{etag}"',
+        "Cache-Control": REVALIDATE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    })
+
+
+@app.get("/api/books/{book_id}/chapters/{chapter_index}")
+async def chapter_json(request: Request, book_id: str, chapter_index: int):
+    """One chapter's content, title and neighbours, for in-place page turns.
+
+    Cached and validated like chapter pages (key-derived ETag, 304 without
+    reading chapters.bin), so a prefetch that is already cached costs one
+    manifest lookup.
+    """
+    book_id = os.path.basename(book_id)
+    book = load_book_cached(book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    if chapter_index < 0 or chapter_index >= len(book.spine):
+        raise HTTPException(status_code=404, detail="Chapter not found")
+
+    key = ("chapter.json", book_id, book.processed_at, chapter_index)
+    etag = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:20]
+    if etag_matches(request, etag):
+        return _not_modified(etag)
+
+    entry = page_cache.get(key)
+    if entry is None:
+        chapter = load_chapter(os.path.join(BOOKS_SHELF_DIR, book_id), book, chapter_index)
+        body = json.dumps({
+            "book_id": book_id,
+            "index": chapter_index,
+            "id": chapter.id,
+            "href": chapter.href,
+            "title": chapter.title,
+            "content": chapter.content,
+            "prev": chapter_index - 1 if chapter_index > 0 else None,
+            "next": chapter_index + 1 if chapter_index < len(book.spine) - 1 else None,
+            "total": len(book.spine),
+        }, ensure_ascii=False).encode("utf-8")
+        entry = CachedBody(body, etag, "application/json", compress_variants(body))
+        page_cache.put(key, entry)
+
+    return cached_response(request, entry, REVALIDATE_CACHE_CONTROL)
+
+
+# --- LLM context ---
+# Token-budgeted text windows over a book, answered from its context.pkl
+# (paragraph token prefix sums, see context.py) and byte-range reads of
+# chapters.bin. Indexes are kept per book like the nav assets.
+
+MAX_CONTEXT_INDEX_BOOKS = 16
+MIN_CONTEXT_TOKENS = MAX_PARAGRAPH_TOKENS
+MAX_CONTEXT_TOKENS = 1_000_000
+MAX_CONTEXT_CHUNKS = 64
+_context_indexes: "OrderedDict[str, Tuple[str, ContextIndex]]" = OrderedDict()
+_context_indexes_lock = threading.Lock()
+
+
+def get_context_index(book_id: str, book: Book) -> ContextIndex:
+    with _context_indexes_lock:
+        cached = _context_indexes.get(book_id)
+        if cached and cached[0] == book.processed_at:
+            _context_indexes.move_to_end(book_id)
+            return cached[1]
+
+    index = read_context_index(book_files_dir(os.path.join(BOOKS_SHELF_DIR, book_id), book))
+    if index is None or len(index.text_offsets) != len(book.spine):
+        raise HTTPException(status_code=404, detail="Book has no context index; re-import it")
+
+    with _context_indexes_lock:
+        _context_indexes[book_id] = (book.processed_at, index)
+        while len(_context_indexes) > MAX_CONTEXT_INDEX_BOOKS:
+            _context_indexes.popitem(last=False)
+    return index
+
+
+@app.get("/api/books/{book_id}/context")
+async def book_context(
+    book_id: str,
+    tokens: int = 4000,
+    chapter: int = 0,
+    paragraph: int = 0,
+    anchor: Optional[str] = None,
+    end_chapter: Optional[int] = None,
+    chunks: int = 1,
+    overlap: int = 0,
+):
+    """Plain text for an LLM prompt, bounded by an (estimated) token budget.
+
+    Starts at a chapter and a paragraph or element id inside it. With
+    chunks=1 returns the largest run of whole paragraphs that fits `tokens`;
+    with chunks=N returns up to N consecutive windows of that size, each
+    repeating at most `overlap` tokens of the previous one. end_chapter
+    (inclusive) stops the windows early. `next` is where to continue.
+    """
+    book_id = os.path.basename(book_id)
+    book = load_book_cached(book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    index = get_context_index(book_id, book)
+
+    tokens = max(MIN_CONTEXT_TOKENS, min(tokens, MAX_CONTEXT_TOKENS))
+    chunks = max(1, min(chunks, MAX_CONTEXT_CHUNKS))
+    overlap = max(0, min(overlap, tokens // 2))
+    try:
+        start = index.locate(chapter, paragraph, anchor)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Anchor not found")
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Chapter or paragraph not found")
+    end = None
+    if end_chapter is not None:
+        end_chapter = max(chapter, min(end_chapter, len(book.spine) - 1))
+        end = index.chapter_paragraphs[end_chapter + 1]
+
+    folder = book_files_dir(os.path.join(BOOKS_SHELF_DIR, book_id), book)
+    spans = index.chunks(start, tokens, overlap, chunks, end)
+    windows = []
+    for lo, hi in spans:
+        windows.append({
+            "start": index.position(lo),
+            "paragraphs": hi - lo,
+            "tokens": index.token_prefix[hi] - index.token_prefix[lo],
+            "chars": index.char_prefix[hi] - index.char_prefix[lo],
+            "text": index.read(folder, lo, hi),
+        })
+    last = spans[-1][1] if spans else start
+    return {
+        "book_id": book_id,
+        "budget": tokens,
+        "overlap": overlap,
+        "windows": windows,
+        "next": index.position(last) if last < index.paragraphs else None,
+    }
+
+
+@app.get("/api/books/{book_id}/context/stats")
+async def book_context_stats(book_id: str):
+    """Estimated tokens, characters and paragraphs per chapter and in total."""
+    book_id = os.path.basename(book_id)
+    book = load_book_cached(book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    index = get_context_index(book_id, book)
+    return {
+        "book_id": book_id,
+        "tokens": index.tokens,
+        "chars": index.char_prefix[-1],
+        "paragraphs": index.paragraphs,
+        "chapters": [
+            {"index": i, "title": chapter.title, **index.chapter_stats(i)}
+            for i, chapter in enumerate(book.spine)
+        ],
+    }
+
+
+@app.get("/read/{book_id}")
 async def redirect_to_first_chapter(book_id: str):
-    """Helper to just go to chapter 0."""
-    return await read_chapter(book_id=book_id, chapter_index=0)
+    """Helper to just go to chapter 0.
+
+    A redirect rather than rendering chapter 0 here: chapter links and the
+    TOC are relative to /read/{book_id}/{index}.
+    """
+    return RedirectResponse(f"/read/{book_id}/0")
 
 @app.get("/read/{book_id}/{chapter_index}", response_class=HTMLResponse)
 async def read_chapter(request: Request, book_id: str, chapter_index: int):
     """The main reader interface."""
+    book_id = os.path.basename(book_id)
     book = load_book_cached(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
@@ -273,24 +928,38 @@ async def read_chapter(request: Request, book_id: str, chapter_index: int):
     if chapter_index < 0 or chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
 
-    current_chapter = book.spine[chapter_index]
+    key = (book_id, book.processed_at, chapter_index, _template_version("reader.html"))
+    etag = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:20]
+    if etag_matches(request, etag):
+        return _not_modified(etag)
 
-    # Calculate Prev/Next links
-    prev_idx = chapter_index - 1 if chapter_index > 0 else None
-    next_idx = chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
+    entry = page_cache.get(key)
+    if entry is None:
+        current_chapter = load_chapter(os.path.join(BOOKS_SHELF_DIR, book_id), book, chapter_index)
 
-    return templates.TemplateResponse("reader.html", {
-        "request": request,
-        "book": book,
-        "current_chapter": current_chapter,
-        "chapter_index": chapter_index,
-        "book_id": book_id,
-        "prev_idx": prev_idx,
-        "next_idx": next_idx
-    })
+        # Calculate Prev/Next links
+        prev_idx = chapter_index - 1 if chapter_index > 0 else None
+        next_idx = chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
+
+        nav_assets = get_nav_assets(book_id, book)
+
+        body = templates.get_template("reader.html").render({
+            "request": request,
+            "book": book,
+            "current_chapter": current_chapter,
+            "chapter_index": chapter_index,
+            "book_id": book_id,
+            "prev_idx": prev_idx,
+            "next_idx": next_idx,
+            "toc_version": nav_assets[TOC_HTML_FILE].etag,
+        }).encode("utf-8")
+        entry = CachedBody(body, etag, "text/html; charset=utf-8", compress_variants(body))
+        page_cache.put(key, entry)
+
+    return cached_response(request, entry, REVALIDATE_CACHE_CONTROL)
 
 @app.get("/read/{book_id}/images/{image_name}")
-async def serve_image(book_id: str, image_name: str):
+async def serve_image(request: Request, book_id: str, image_name: str):
     """
     Serves images specifically for a book.
     The HTML contains <img src="images/pic.jpg">.
@@ -301,11 +970,39 @@ async def serve_image(book_id: str, image_name: str):
     safe_image_name = os.path.basename(image_name)
 
     img_path = os.path.join(BOOKS_SHELF_DIR, safe_book_id, "images", safe_image_name)
+    cache_control = IMMUTABLE_CACHE_CONTROL if is_content_addressed(safe_image_name) else IMAGE_CACHE_CONTROL
 
-    if not os.path.exists(img_path):
+    try:
+        st = os.stat(img_path)
+    except OSError:
+        return await run_in_threadpool(serve_archive_image, request, safe_book_id, safe_image_name, cache_control)
+
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    headers = {"ETag": f'"{etag}"', "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(img_path, headers=headers)
+
+
+def serve_archive_image(request: Request, book_id: str, image_name: str, cache_control: str) -> Response:
+    """Stream an image of a book imported in zero-copy mode out of its EPUB."""
+    book = load_book_cached(book_id)
+    member = book.image_members.get(image_name) if book and getattr(book, "image_archive", None) else None
+    info = archive_pool.member(book.image_archive, member) if member else None
+    # The name encodes the member's CRC and size: a replaced source file whose
+    # member no longer matches must not serve different bytes under it.
+    if info is None or archive_image_name(info) != image_name:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    return FileResponse(img_path)
+    etag = image_name.rsplit(".", 1)[0]
+    headers = {"ETag": f'"{etag}"', "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    headers["Content-Length"] = str(info.file_size)
+    media_type = mimetypes.guess_type(image_name)[0] or "application/octet-stream"
+    return StreamingResponse(
+        archive_pool.iter_member(book.image_archive, member), media_type=media_type, headers=headers,
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CliImportTest(unittest.TestCase):
+    """Books written by the reader3.py CLI must be readable by the server."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        os.makedirs(os.path.join("books", "hub"))
+        with open(os.path.join("books", "hub", "notes.md"), "w", encoding="utf-8") as f:
+            f.write("# One\n\nFirst chapter.\n\n## Two\n\nSecond chapter.\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_sync_hub_book_loads_in_server(self):
+        subprocess.run(
+            [sys.executable, os.path.join(REPO_DIR, "reader3.py"), "--sync-hub"],
+            check=True, capture_output=True,
+        )
+
+        import server
+        from reader3 import load_chapter, resplit_saved_book
+
+        book = server.load_book_cached("notes_data")
+        self.assertIsNotNone(book)
+        self.assertEqual(type(book).__module__, "reader3")
+        self.assertIn("Second chapter.", load_chapter(os.path.join(server.BOOKS_SHELF_DIR, "notes_data"), book, 1).text)
+
+        resplit = resplit_saved_book(os.path.join(server.BOOKS_SHELF_DIR, "notes_data"), 1)
+        self.assertIsNotNone(resplit)
+        self.assertEqual(len(resplit.spine), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
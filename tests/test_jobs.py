@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from jobs import Job, JobManager
+
+
+class JobStateTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = JobManager(max_workers=1)
+        self.job = Job(id="j1", kind="epub", book_id="b_data", source_path="b.epub",
+                       output_dir="b_data", split_level=2)
+        self.manager._jobs[self.job.id] = self.job
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def _watch(self, *job_ids):
+        events = [*job_ids, None]
+        self.manager._watch_started(type("Queue", (), {"get": lambda _: events.pop(0)})())
+
+    def test_finish_waits_for_the_status_lock(self):
+        future = Future()
+        future.set_result({"title": "B"})
+        # Hold the lock as _watch_started does between its check and its update.
+        with self.manager._lock:
+            finisher = threading.Thread(target=self.manager._finish, args=(self.job, future))
+            finisher.start()
+            finisher.join(0.2)
+            self.assertEqual(self.job.status, "queued")
+            self.job.status = "running"
+        finisher.join()
+        self.assertEqual(self.job.status, "done")
+        self.assertIsNone(self.manager.active_job("b_data"))
+
+    def test_start_event_after_finish_is_ignored(self):
+        self.job.finished_at = time.time()
+        self._watch(self.job.id)
+        self.assertEqual(self.job.status, "queued")
+        self.assertIsNone(self.job.started_at)
+
+    def test_job_runs_and_fails_without_polling(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            job = self.manager.submit("epub", "missing_data", os.path.join(tmp, "missing.epub"),
+                                      os.path.join(tmp, "missing_data"), 2)
+            deadline = time.monotonic() + 30
+            while job.active and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self.assertEqual(job.status, "error")
+        self.assertIsNotNone(job.started_at)
+        self.assertEqual(self.manager.stats()["running"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from dataclasses import replace
+from unittest import mock
+
+import publish
+from reader3 import ingest_source, load_book, load_chapter, resplit_saved_book, save_book, write_manifest
+
+
+def make_legacy_book(source: str, book_dir: str):
+    """Ingest source, then turn the result into a plain pre-generation folder."""
+    ingest_source(source, book_dir)
+    current = os.path.realpath(book_dir)
+    os.unlink(book_dir)
+    shutil.move(current, book_dir)
+    shutil.rmtree(publish.generations_dir(book_dir))
+    write_manifest(replace(load_book(book_dir), generation=0), book_dir)
+
+
+@unittest.skipIf(publish._renameat2 is None, "renameat2 is not available")
+class LegacyMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        source = os.path.join(self.tmp.name, "notes.md")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write("".join(f"# Part {i}\n\n## Section {i}\n\nText {i}.\n\n" for i in range(5)))
+        self.book_dir = os.path.join(self.tmp.name, "notes_data")
+        make_legacy_book(source, self.book_dir)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_book_stays_readable_during_first_publish(self):
+        old = load_book(self.book_dir)
+        reads = []
+
+        def read():
+            # A fresh manifest, and the generation-0 one loaded before publishing.
+            book = load_book(self.book_dir)
+            load_chapter(self.book_dir, book, len(book.spine) - 1)
+            load_chapter(self.book_dir, old, len(old.spine) - 1)
+            reads.append(book.generation)
+
+        def reading_after(fn):
+            def step(*args, **kwargs):
+                result = fn(*args, **kwargs)
+                read()
+                return result
+            return step
+
+        book = resplit_saved_book(self.book_dir, 1)
+        with mock.patch.object(os, "rename", reading_after(os.rename)), \
+                mock.patch.object(os, "replace", reading_after(os.replace)), \
+                mock.patch.object(publish, "exchange_paths", reading_after(publish.exchange_paths)):
+            save_book(book, self.book_dir)
+
+        self.assertEqual(reads[-1], 1)
+        self.assertTrue(os.path.islink(self.book_dir))
+        self.assertEqual(sorted(os.listdir(publish.generations_dir(self.book_dir))), ["0", "1"])
+        self.assertFalse(os.path.islink(publish.generation_dir(self.book_dir, 0)))
+        self.assertEqual(len(load_book(self.book_dir).spine), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from reader3 import ingest_source
+from search import ShelfIndex, tokenize
+
+
+class CJKSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.shelf = os.path.join(self.tmp.name, "shelf")
+        source = os.path.join(self.tmp.name, "notes.md")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write("# 第一章\n\n今天天气很好，我们去公园散步。\n")
+        ingest_source(source, os.path.join(self.shelf, "notes_data"))
+        self.index = ShelfIndex(self.shelf)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_query_tokens_stay_bigrams(self):
+        self.assertEqual(tokenize("天气很好"), ["天气", "气很", "很好"])
+        self.assertEqual(tokenize("园"), ["园"])
+
+    def test_single_character_query_matches(self):
+        for query in ("园", "公园", "散"):
+            with self.subTest(query=query):
+                results = self.index.search(query)
+                self.assertEqual(len(results), 1)
+                self.assertIn(query, results[0]["snippet"])
+
+    def test_missing_character_does_not_match(self):
+        self.assertEqual(self.index.search("猫"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()